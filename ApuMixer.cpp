@@ -0,0 +1,12 @@
+#include "ApuMixer.hpp"
+
+ApuMixer::ApuMixer() {
+  pulseTable[0] = 0.0;
+  for (int n = 1; n < PULSE_MIX_TABLE_SIZE; n++) {
+    pulseTable[n] = 95.52 / (8128.0 / n + 100.0);
+  }
+  tndTable[0] = 0.0;
+  for (int n = 1; n < TND_MIX_TABLE_SIZE; n++) {
+    tndTable[n] = 163.67 / (24329.0 / n + 100.0);
+  }
+}
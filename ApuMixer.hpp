@@ -0,0 +1,31 @@
+#ifndef APU_MIXER_H
+#define APU_MIXER_H
+
+// Sums of channel outputs the tables cover: both pulses (0-15 each),
+// and 3 * triangle + 2 * noise + DMC (0-15, 0-15 and 0-127)
+const int PULSE_MIX_TABLE_SIZE = 31;
+const int TND_MIX_TABLE_SIZE = 203;
+
+/* The NES's nonlinear mixer, as lookup tables: see
+ * http://wiki.nesdev.com/w/index.php/APU_Mixer
+ *
+ * The pulses share one DAC and the triangle, noise and DMC share
+ * another, so a loud channel turns down the others on its DAC. The
+ * output's between 0 and 1, and 0 when everything is.
+ */
+class ApuMixer {
+public:
+  ApuMixer();
+
+  float output(unsigned int pulse1, unsigned int pulse2,
+               unsigned int triangle, unsigned int noise, unsigned int dmc) {
+    return pulseTable[pulse1 + pulse2] +
+      tndTable[3 * triangle + 2 * noise + dmc];
+  }
+
+private:
+  float pulseTable[PULSE_MIX_TABLE_SIZE];
+  float tndTable[TND_MIX_TABLE_SIZE];
+};
+
+#endif
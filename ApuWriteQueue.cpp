@@ -0,0 +1,50 @@
+#include "ApuWriteQueue.hpp"
+
+ApuWriteQueue::ApuWriteQueue()
+  : writes(APU_WRITE_QUEUE_SIZE), head(0), tail(0), newest(0),
+    droppedWrites(0)
+{
+}
+
+bool ApuWriteQueue::push(const apuWrite &write) {
+  unsigned long h = head.load(std::memory_order_relaxed);
+  if (h - tail.load(std::memory_order_acquire) >= APU_WRITE_QUEUE_SIZE) {
+    droppedWrites.fetch_add(1, std::memory_order_relaxed);
+    return false;
+  }
+  writes[h & (APU_WRITE_QUEUE_SIZE - 1)] = write;
+  advanceTo(write.cycle);
+  // Publish the write only once it's in its slot
+  head.store(h + 1, std::memory_order_release);
+  return true;
+}
+
+bool ApuWriteQueue::peek(apuWrite &write) {
+  unsigned long t = tail.load(std::memory_order_relaxed);
+  if (t == head.load(std::memory_order_acquire)) {
+    return false;
+  }
+  write = writes[t & (APU_WRITE_QUEUE_SIZE - 1)];
+  return true;
+}
+
+void ApuWriteQueue::pop() {
+  // Hand the slot back to the writer once we're done reading it
+  tail.store(tail.load(std::memory_order_relaxed) + 1,
+             std::memory_order_release);
+}
+
+void ApuWriteQueue::advanceTo(unsigned long long cycle) {
+  // Only the writer stores to newest, so this doesn't race
+  if (cycle > newest.load(std::memory_order_relaxed)) {
+    newest.store(cycle, std::memory_order_relaxed);
+  }
+}
+
+unsigned long long ApuWriteQueue::newestCycle() {
+  return newest.load(std::memory_order_relaxed);
+}
+
+unsigned long ApuWriteQueue::dropped() {
+  return droppedWrites.load(std::memory_order_relaxed);
+}
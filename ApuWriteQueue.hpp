@@ -0,0 +1,60 @@
+#ifndef APU_WRITE_QUEUE_H
+#define APU_WRITE_QUEUE_H
+
+#include <atomic>
+#include <vector>
+
+// Not a real register address (the APU's all live below 0x4018): the
+// DMC starts a sample, at the given offset into PRG ROM. The emulator
+// times the DMC's reads, and works out where its address is mapped.
+const unsigned int APU_DMC_START = 0x8000;
+
+// Has to be a power of two
+const unsigned int APU_WRITE_QUEUE_SIZE = 4096;
+
+/* One register write (or sample start), stamped with the CPU cycle it
+ * happened on. apu.py's ApuWrite has to match this layout.
+ */
+typedef struct apuWrite {
+  unsigned long long cycle;
+  unsigned int reg;
+  unsigned int value;
+} apuWrite;
+
+/* A lock-free ring buffer of register writes, from exactly one writer
+ * (the emulator) to exactly one reader (the audio callback). The writer
+ * only touches head and the reader only touches tail, so neither ever
+ * waits on the other.
+ */
+class ApuWriteQueue {
+public:
+  ApuWriteQueue();
+
+  // Writer side. Returns false, and counts a dropped write, if the
+  // queue is full (which means the reader has stopped).
+  bool push(const apuWrite &write);
+
+  // Reader side. peek returns false if the queue is empty.
+  bool peek(apuWrite &write);
+  void pop();
+
+  // Writer side: the emulator has gotten to this cycle, so there won't
+  // be any more writes before it
+  void advanceTo(unsigned long long cycle);
+
+  // The cycle of the newest write ever pushed, or the cycle from
+  // advanceTo if that's newer
+  unsigned long long newestCycle();
+  unsigned long dropped();
+
+private:
+  std::vector<apuWrite> writes;
+  // Index of the next write to push, and of the next to pop. They only
+  // ever go up; the slot is the index mod APU_WRITE_QUEUE_SIZE.
+  std::atomic<unsigned long> head;
+  std::atomic<unsigned long> tail;
+  std::atomic<unsigned long long> newest;
+  std::atomic<unsigned long> droppedWrites;
+};
+
+#endif
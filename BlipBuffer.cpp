@@ -0,0 +1,63 @@
+#include "BlipBuffer.hpp"
+
+#include <cmath>
+
+BlipBuffer::BlipBuffer(double cyclesPerSample)
+  : cyclesPerSample(cyclesPerSample), start(0.0), level(0.0)
+{
+  // Each phase's kernel is the derivative of a band-limited step
+  // starting that far into the sample: a Blackman-windowed sinc,
+  // centered (BLIP_WIDTH / 2 - 1) samples in. Normalizing each to sum
+  // to 1 makes every step come out exactly its size, so the level
+  // doesn't drift.
+  const double center = BLIP_WIDTH / 2 - 1;
+  for (int phase = 0; phase < BLIP_PHASES; phase++) {
+    double offset = center + (double) phase / BLIP_PHASES;
+    double sum = 0.0;
+    double taps[BLIP_WIDTH];
+    for (int i = 0; i < BLIP_WIDTH; i++) {
+      double x = i - offset;
+      double arg = M_PI * BLIP_CUTOFF * x;
+      double sinc = (x == 0.0) ? 1.0 : sin(arg) / arg;
+      double w = 2.0 * M_PI * x / BLIP_WIDTH;
+      double window = 0.42 + 0.5 * cos(w) + 0.08 * cos(2.0 * w);
+      taps[i] = (fabs(x) < BLIP_WIDTH / 2) ? sinc * window : 0.0;
+      sum += taps[i];
+    }
+    for (int i = 0; i < BLIP_WIDTH; i++) {
+      kernel[phase][i] = (float) (taps[i] / sum);
+    }
+  }
+}
+
+void BlipBuffer::begin(unsigned int n) {
+  if (deltas.size() < n + BLIP_WIDTH) {
+    deltas.resize(n + BLIP_WIDTH, 0.0);
+  }
+}
+
+void BlipBuffer::addDelta(double cycle, float delta) {
+  double position = (cycle - start) / cyclesPerSample;
+  int sample = (int) position;
+  int phase = (int) ((position - sample) * BLIP_PHASES);
+  float *out = &deltas[sample];
+  const float *k = kernel[phase];
+  for (int i = 0; i < BLIP_WIDTH; i++) {
+    out[i] += delta * k[i];
+  }
+}
+
+void BlipBuffer::read(float *out, unsigned int n) {
+  for (unsigned int i = 0; i < n; i++) {
+    level += deltas[i];
+    out[i] = (float) level;
+  }
+  // Keep the tails of steps near the end for next time
+  deltas.erase(deltas.begin(), deltas.begin() + n);
+  deltas.resize(BLIP_WIDTH, 0.0);
+  start += n * cyclesPerSample;
+}
+
+double BlipBuffer::startCycle() {
+  return start;
+}
@@ -0,0 +1,47 @@
+#ifndef BLIP_BUFFER_H
+#define BLIP_BUFFER_H
+
+#include <vector>
+
+// Each step is spread over this many samples
+const int BLIP_WIDTH = 16;
+// Steps are placed to within 1/BLIP_PHASES of a sample
+const int BLIP_PHASES = 32;
+// Cutoff of the step's low-pass filter, as a fraction of the Nyquist
+// frequency
+const double BLIP_CUTOFF = 0.9;
+
+/* Turns steps in a signal (which the channels produce, at CPU cycle
+ * times) into band-limited samples. Rather than storing the signal, it
+ * stores how much the signal changes at each sample, with each change
+ * spread out by a windowed sinc so it doesn't alias; read adds those
+ * changes back up. Adding a step costs BLIP_WIDTH multiply-adds, no
+ * matter how many samples it's been since the last one.
+ *
+ * Steps come out delayed by BLIP_WIDTH / 2 samples.
+ */
+class BlipBuffer {
+public:
+  BlipBuffer(double cyclesPerSample);
+
+  // Make room for n samples, starting at startCycle()
+  void begin(unsigned int n);
+  // Add a step of the given size at the given CPU cycle, which must be
+  // inside the n samples from begin
+  void addDelta(double cycle, float delta);
+  // Output the n samples from begin, and move past them
+  void read(float *out, unsigned int n);
+
+  // The cycle the next sample starts at
+  double startCycle();
+
+private:
+  double cyclesPerSample;
+  double start;
+  // The current output level, before any deltas in the buffer
+  double level;
+  std::vector<float> deltas;
+  float kernel[BLIP_PHASES][BLIP_WIDTH];
+};
+
+#endif
@@ -0,0 +1,84 @@
+#include "DmcWave.hpp"
+
+void DmcSampleCache::setPrgRom(const unsigned char *data, unsigned int n) {
+  prgRom.assign(data, data + n);
+  samples.clear();
+}
+
+const std::vector<signed char> &DmcSampleCache::get(unsigned int offset,
+                                                    unsigned int length) {
+  std::pair<unsigned int, unsigned int> key(offset, length);
+  std::map<std::pair<unsigned int, unsigned int>,
+           std::vector<signed char> >::iterator found = samples.find(key);
+  if (found != samples.end()) {
+    return found->second;
+  }
+  std::vector<signed char> &deltas = samples[key];
+  if (prgRom.empty()) {
+    return deltas;
+  }
+  deltas.reserve(length * 8);
+  for (unsigned int i = 0; i < length; i++) {
+    unsigned char byte = prgRom[(offset + i) % prgRom.size()];
+    // Least significant bit first
+    for (int b = 0; b < 8; b++) {
+      deltas.push_back(((byte >> b) & 1) ? DMC_DELTA : -DMC_DELTA);
+    }
+  }
+  return deltas;
+}
+
+DmcWave::DmcWave()
+  : period(DMC_RATE_TABLE[0]), level(0),
+    sample(NULL), bit(0), nextStep(0.0), restart(false)
+{
+}
+
+void DmcWave::setRate(unsigned int rate) {
+  period = DMC_RATE_TABLE[rate];
+}
+
+void DmcWave::setOutputLevel(unsigned char l) {
+  level = l;
+}
+
+void DmcWave::start(const std::vector<signed char> *s) {
+  sample = s->empty() ? NULL : s;
+  bit = 0;
+  restart = true;
+}
+
+void DmcWave::stop() {
+  sample = NULL;
+}
+
+void DmcWave::startRun(double from) {
+  if (restart) {
+    nextStep = from + period;
+    restart = false;
+  } else if (nextStep < from) {
+    nextStep = from;
+  }
+}
+
+double DmcWave::nextChange() {
+  return sample ? nextStep : NO_CHANGE;
+}
+
+void DmcWave::step() {
+  // The level only moves if it stays in range; otherwise the bit's
+  // skipped
+  int next = level + (*sample)[bit];
+  if (0 <= next && next <= DMC_OUTPUT_MAX) {
+    level = next;
+  }
+  bit++;
+  if (bit == sample->size()) {
+    sample = NULL;
+  }
+  nextStep += period;
+}
+
+unsigned char DmcWave::output() {
+  return level;
+}
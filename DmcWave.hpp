@@ -0,0 +1,71 @@
+#ifndef DMC_WAVE_H
+#define DMC_WAVE_H
+
+#include <cstddef>
+#include <map>
+#include <utility>
+#include <vector>
+
+#include "nesconstants.hpp"
+
+// CPU cycles per bit, for each rate setting (NTSC)
+const unsigned int DMC_RATE_TABLE[16] = {
+  428, 380, 340, 320, 286, 254, 226, 214,
+  190, 160, 142, 128, 106, 84, 72, 54};
+
+const unsigned char DMC_OUTPUT_MAX = 127;
+const int DMC_DELTA = 2;
+
+/* Samples decoded from PRG ROM: a delta for each bit, +2 for a 1 and
+ * -2 for a 0. Games play the same few samples over and over, so each
+ * is decoded the first time it's played, and kept.
+ */
+class DmcSampleCache {
+public:
+  void setPrgRom(const unsigned char *data, unsigned int n);
+  // The deltas for the length bytes at offset in PRG ROM (wrapping
+  // around at the end)
+  const std::vector<signed char> &get(unsigned int offset, unsigned int length);
+
+private:
+  std::vector<unsigned char> prgRom;
+  std::map<std::pair<unsigned int, unsigned int>,
+           std::vector<signed char> > samples;
+};
+
+class DmcWave {
+
+public:
+  DmcWave();
+  // Takes the rate bits from the register (0-15)
+  void setRate(unsigned int rate);
+  // A write to the direct load register
+  void setOutputLevel(unsigned char level);
+  // Start playing a sample from the cache
+  void start(const std::vector<signed char> *sample);
+  void stop();
+
+  // Stepping through a run of CPU cycles, for the mixer: see
+  // PulseWave. The output only changes while a sample's playing, so
+  // there's no endRun.
+  void startRun(double from);
+  double nextChange();
+  void step();
+  // The output level, 0-127
+  unsigned char output();
+
+protected:
+  unsigned int period;
+  unsigned char level;
+
+  // The sample playing, or NULL, and the next bit of it
+  const std::vector<signed char> *sample;
+  unsigned int bit;
+  // The cycle the next bit plays on
+  double nextStep;
+  // Set by start, so that startRun starts the sample at the start of
+  // the run
+  bool restart;
+};
+
+#endif
@@ -0,0 +1,34 @@
+#include "FrameCounter.hpp"
+
+FrameCounter::FrameCounter() {
+  // At power on, it's as if $4017 was written with 0
+  reset(0.0, false);
+}
+
+void FrameCounter::reset(double cycle, bool fiveStep) {
+  frameStart = cycle;
+  if (fiveStep) {
+    frameLength = FRAME_COUNTER_5STEP_LENGTH * CPU_CYCLES_PER_APU_CYCLE;
+    clocks = FRAME_COUNTER_5STEP_CLOCKS;
+  } else {
+    frameLength = FRAME_COUNTER_4STEP_LENGTH * CPU_CYCLES_PER_APU_CYCLE;
+    clocks = FRAME_COUNTER_4STEP_CLOCKS;
+  }
+  step = 0;
+}
+
+double FrameCounter::nextClock() {
+  return frameStart + clocks[step];
+}
+
+bool FrameCounter::nextIsHalfFrame() {
+  return step % 2 == 1;
+}
+
+void FrameCounter::advance() {
+  step++;
+  if (step == FRAME_COUNTER_STEPS) {
+    step = 0;
+    frameStart += frameLength;
+  }
+}
@@ -0,0 +1,44 @@
+#ifndef FRAME_COUNTER_H
+#define FRAME_COUNTER_H
+
+#include "nesconstants.hpp"
+
+// The APU clocks on every other CPU cycle
+const int CPU_CYCLES_PER_APU_CYCLE = 2;
+
+// CPU cycles from the start of a frame to each of its clocks, which
+// alternate quarter and half frame clocks. The 5-step sequence's last
+// clock is a step later, with nothing on the step in between.
+const int FRAME_COUNTER_STEPS = 4;
+const double FRAME_COUNTER_4STEP_CLOCKS[FRAME_COUNTER_STEPS] = {
+  7457, 14913, 22371, 29829};
+const double FRAME_COUNTER_5STEP_CLOCKS[FRAME_COUNTER_STEPS] = {
+  7457, 14913, 22371, 37281};
+
+/* When the frame counter clocks the channels' envelopes, sweeps and
+ * length counters. The sequence only ever restarts when $4017 is
+ * written, so every clock after that is worked out from the cycle of
+ * the write: the emulator doesn't have to send them.
+ */
+class FrameCounter {
+public:
+  FrameCounter();
+  // $4017 was written at the given cycle, setting the given mode
+  void reset(double cycle, bool fiveStep);
+  // The cycle of the next clock
+  double nextClock();
+  // Whether the next clock is a half frame clock (which does
+  // everything a quarter frame clock does too)
+  bool nextIsHalfFrame();
+  // Move on to the clock after the next one
+  void advance();
+
+private:
+  double frameStart;
+  double frameLength;
+  const double *clocks;
+  // Which of the frame's clocks is next
+  int step;
+};
+
+#endif
@@ -0,0 +1,174 @@
+#include "NoiseWave.hpp"
+
+#include <cassert>
+
+static const NoiseSequence LONG_SEQUENCE(NOISE_LONG_TAP);
+static const NoiseSequence SHORT_SEQUENCE(NOISE_SHORT_TAP);
+
+NoiseSequence::NoiseSequence(int tap) {
+  unsigned short value = NOISE_SHIFT_REGISTER_START;
+  do {
+    registers.push_back(value);
+    unsigned short feedback = (value ^ (value >> tap)) & 1;
+    value = (value >> 1) | (feedback << 14);
+  } while (value != NOISE_SHIFT_REGISTER_START);
+
+  // Count back from the end of each run of the same output. Going
+  // round twice gets the runs that wrap past the end right.
+  int n = length();
+  runs.resize(n);
+  unsigned short run = 1;
+  for (int i = 2 * n - 1; i >= 0; i--) {
+    int position = i % n;
+    if (high(position) != high((position + 1) % n)) {
+      run = 1;
+    } else {
+      run++;
+    }
+    runs[position] = run;
+  }
+}
+
+int NoiseSequence::find(unsigned short value) const {
+  for (unsigned int i = 0; i < length(); i++) {
+    if (registers[i] == value) {
+      return i;
+    }
+  }
+  return -1;
+}
+
+NoiseWave::NoiseWave()
+  : enabled(0), period(NOISE_PERIOD_TABLE[0]),
+    sequence(&LONG_SEQUENCE), position(0), nextStep(0.0),
+    lengthCounterHalt(0), lengthCounterValue(0),
+    envelopeLoop(0), envelopeConstant(1),
+    envelopeDividerReload(ENVELOPE_MAX), envelopeDivider(0),
+    envelopeCounter(ENVELOPE_MAX), frameCounterMode(0)
+{
+}
+
+void NoiseWave::reset() {
+  envelopeDivider = envelopeDividerReload;
+  envelopeCounter = ENVELOPE_MAX;
+}
+
+void NoiseWave::setEnabled(bool e) {
+  enabled = e;
+}
+
+void NoiseWave::setPeriod(unsigned int p) {
+  period = NOISE_PERIOD_TABLE[p];
+}
+
+void NoiseWave::setShortMode(bool shortMode) {
+  const NoiseSequence *next = shortMode ? &SHORT_SEQUENCE : &LONG_SEQUENCE;
+  if (next == sequence) {
+    return;
+  }
+  // The shift register carries on from where it was. The short
+  // sequence only has some of the values, though: if it's not one of
+  // those, start the sequence over.
+  int found = next->find(sequence->registers[position]);
+  position = (found < 0) ? 0 : found;
+  sequence = next;
+}
+
+void NoiseWave::setLengthCounterHalt(bool h) {
+  lengthCounterHalt = h;
+}
+
+void NoiseWave::setLengthCounter(unsigned int c) {
+  lengthCounterValue = c;
+}
+
+void NoiseWave::updateEnvelope(bool loop, bool constant,
+                               unsigned char timerReload) {
+  // Note: as with the pulse waves, this does not reset the envelope:
+  // writing to 0x400f does that
+  envelopeLoop = loop;
+  envelopeConstant = constant;
+  envelopeDividerReload = timerReload;
+}
+
+void NoiseWave::updateFrameCounter(bool mode) {
+  frameCounterMode = mode;
+}
+
+void NoiseWave::frameCounterQuarterFrame() {
+  envelopeAct();
+}
+
+void NoiseWave::frameCounterHalfFrame() {
+  lengthCounterAct();
+  envelopeAct();
+}
+
+void NoiseWave::envelopeAct() {
+  if (envelopeDivider) {
+    envelopeDivider--;
+    return;
+  }
+  envelopeDivider = envelopeDividerReload;
+  if (envelopeCounter > 0) {
+    envelopeCounter--;
+  } else if (envelopeLoop) {
+    envelopeCounter = ENVELOPE_MAX;
+  }
+}
+
+unsigned char NoiseWave::envelope() {
+  unsigned char out = envelopeConstant ?
+    envelopeDividerReload : envelopeCounter;
+  assert(out <= ENVELOPE_MAX);
+  return out;
+}
+
+void NoiseWave::lengthCounterAct() {
+  if ((!lengthCounterHalt) && (lengthCounterValue > 0)) {
+    lengthCounterValue--;
+  }
+  if (!enabled) {
+    lengthCounterValue = 0;
+  }
+}
+
+bool NoiseWave::silent() {
+  return (!enabled) || (!lengthCounterValue);
+}
+
+unsigned char NoiseWave::output() {
+  if (silent() || !sequence->high(position)) {
+    return 0;
+  }
+  return envelope();
+}
+
+void NoiseWave::startRun(double from) {
+  if (nextStep < from) {
+    nextStep = from;
+  }
+}
+
+double NoiseWave::nextChange() {
+  if (silent()) {
+    return NO_CHANGE;
+  }
+  return nextStep + (sequence->runs[position] - 1) * (double) period;
+}
+
+void NoiseWave::step() {
+  unsigned int run = sequence->runs[position];
+  position = (position + run) % sequence->length();
+  nextStep += run * (double) period;
+}
+
+void NoiseWave::endRun(double to) {
+  if (nextStep >= to) {
+    return;
+  }
+  // Skip straight to where the shift register will be
+  unsigned int shifts = (unsigned int) ((to - nextStep) / period) + 1;
+  position = (position + shifts) % sequence->length();
+  nextStep += shifts * (double) period;
+}
@@ -0,0 +1,101 @@
+#ifndef NOISE_WAVE_H
+#define NOISE_WAVE_H
+
+#include <vector>
+
+#include "nesconstants.hpp"
+
+// The shift register's feedback comes from bit 0 and one of these: bit
+// 1 normally, which runs through every nonzero value, or bit 6 in
+// short mode, which loops much sooner
+const int NOISE_LONG_TAP = 1;
+const int NOISE_SHORT_TAP = 6;
+const int NOISE_LONG_SEQUENCE_LENGTH = 32767;
+const int NOISE_SHORT_SEQUENCE_LENGTH = 93;
+// The shift register's value at power on
+const unsigned short NOISE_SHIFT_REGISTER_START = 1;
+
+// CPU cycles between shifts, for each period setting (NTSC)
+const unsigned int NOISE_PERIOD_TABLE[16] = {
+  4, 8, 16, 32, 64, 96, 128, 160,
+  202, 254, 380, 508, 762, 1016, 2034, 4068};
+
+/* Everything the shift register goes through in one mode, starting
+ * from NOISE_SHIFT_REGISTER_START: computed once, so the channel can
+ * step through it by position instead of shifting bits.
+ */
+class NoiseSequence {
+public:
+  NoiseSequence(int tap);
+
+  unsigned int length() const { return registers.size(); }
+  // Whether the output's high (bit 0 clear) at a position
+  bool high(unsigned int position) const { return !(registers[position] & 1); }
+  // Where the shift register has this value, or -1 if it never does
+  int find(unsigned short value) const;
+
+  // The shift register at each position
+  std::vector<unsigned short> registers;
+  // How many shifts from each position until the output changes
+  std::vector<unsigned short> runs;
+};
+
+class NoiseWave {
+
+public:
+  NoiseWave();
+  // Restarts the envelope
+  void reset();
+  void setEnabled(bool enabled);
+  // Takes the period bits from the register (0-15)
+  void setPeriod(unsigned int period);
+  void setShortMode(bool shortMode);
+  void setLengthCounterHalt(bool halt);
+  void setLengthCounter(unsigned int c);
+
+  void updateEnvelope(bool loop, bool constant,
+                      unsigned char timerReload);
+
+  void updateFrameCounter(bool mode);
+  void frameCounterQuarterFrame();
+  void frameCounterHalfFrame();
+
+  // Stepping through a run of CPU cycles, for the mixer: see
+  // PulseWave. Each step jumps straight to the next shift that changes
+  // the output.
+  void startRun(double from);
+  double nextChange();
+  void step();
+  void endRun(double to);
+  // The output level, 0-15
+  unsigned char output();
+
+protected:
+  bool silent();
+  void envelopeAct();
+  void lengthCounterAct();
+  unsigned char envelope();
+
+  bool enabled;
+  unsigned int period;
+
+  const NoiseSequence *sequence;
+  // Where the shift register is in the sequence, and the cycle it
+  // next shifts on
+  unsigned int position;
+  double nextStep;
+
+  bool lengthCounterHalt;
+  int lengthCounterValue;
+
+  bool envelopeLoop;
+  bool envelopeConstant;
+  // Note: the timer reload also specifies the envelope in constant mode
+  unsigned char envelopeDividerReload;
+  unsigned char envelopeDivider;
+  unsigned char envelopeCounter;
+
+  bool frameCounterMode;
+};
+
+#endif
@@ -4,19 +4,19 @@
 #include <cmath>
 #include <cstdio>
 
-PulseWave::PulseWave(float sampleRate)
-  : divider(0), duty(0.0), enabled(0), time(0.0),
+PulseWave::PulseWave()
+  : divider(0), duty(0), enabled(0),
+    sequenceStep(0), nextStep(0.0), phaseReset(true),
     sweepEnabled(0), sweepDividerReload(0), sweepDivider(0), sweepShift(0),
     lengthCounterValue(0), lengthCounterHalt(0), frameCounterMode(0),
     envelopeCounter(ENVELOPE_MAX), envelopeLoop(0), envelopeConstant(1),
-    envelopeDivider(0), envelopeDividerReload(ENVELOPE_MAX),
-    sampleRate(sampleRate)
+    envelopeDivider(0), envelopeDividerReload(ENVELOPE_MAX)
 {
 }
 
 void PulseWave::reset(void) {
   // reset phase, reload length conuter, reset envelope.
-  time = 0.0;
+  phaseReset = true;
   envelopeDivider = envelopeDividerReload;
   envelopeCounter = ENVELOPE_MAX;
 }
@@ -25,7 +25,7 @@ void PulseWave::setDivider(unsigned int d) {
   divider = d;
 }
 
-void PulseWave::setDuty(float d) {
+void PulseWave::setDuty(unsigned int d) {
   duty = d;
 }
 
@@ -146,32 +146,61 @@ void PulseWave::frameCounterHalfFrame() {
   sweepAct();
 }
 
-unsigned char PulseWave::tick()
-{
-  float prd = period();
-  float phase = fmod(((time - (0.125 * prd)) / prd), 1.0);
-  if (phase < 0.0) {
-    phase += 1.0;
-  }
-  float out = (phase < duty) ? envelope() : 0.0;
-  if ((divider < PULSE_MINIMUM_DIVIDER) || (divider > PULSE_MAXIMUM_DIVIDER)) {
-    out = 0;
+bool PulseWave::silent() {
+  return ((divider < PULSE_MINIMUM_DIVIDER) ||
+          (divider > PULSE_MAXIMUM_DIVIDER) ||
+          (!enabled) ||
+          (!lengthCounterValue));
+}
+
+unsigned char PulseWave::output() {
+  if (silent() || !PULSE_DUTY_SEQUENCES[duty][sequenceStep]) {
+    return 0;
   }
-  if (!enabled) {
-    out = 0;
+  return envelope();
+}
+
+double PulseWave::stepCycles() {
+  return (divider + 2) * CPU_CYCLES_PER_PULSE_STEP;
+}
+
+void PulseWave::startRun(double from) {
+  if (phaseReset) {
+    sequenceStep = 0;
+    nextStep = from + stepCycles();
+    phaseReset = false;
+  } else if (nextStep < from) {
+    nextStep = from;
   }
-  if (!lengthCounterValue) {
-    out = 0;
+}
+
+double PulseWave::nextChange() {
+  // A silent channel's sequencer still runs, but it can't change the
+  // output, so endRun catches it up instead
+  return silent() ? NO_CHANGE : nextStep;
+}
+
+void PulseWave::step() {
+  sequenceStep = (sequenceStep + 1) % PULSE_SEQUENCE_LENGTH;
+  nextStep += stepCycles();
+}
+
+void PulseWave::endRun(double to) {
+  if (nextStep >= to) {
+    return;
   }
-  time += 1.0 / sampleRate;
-  return out;
+  // Skip straight to where the sequencer will be
+  double cycles = stepCycles();
+  unsigned int steps = (unsigned int) ((to - nextStep) / cycles) + 1;
+  sequenceStep = (sequenceStep + steps) % PULSE_SEQUENCE_LENGTH;
+  nextStep += steps * cycles;
 }
 
 // Note: not guaranteed to print entire state
 void PulseWave::printState(void) {
   const char *enabledStr = enabled ? "enabled" : "disabled";
   float frequency = 1.0 / period();
-  printf("Pulse wave channel %d: %s, duty %f, divider %d (%f Hz)\n",
+  printf("Pulse wave channel %d: %s, duty %d, divider %d (%f Hz)\n",
          // dummy channel number below
          -1, enabledStr, duty, divider, frequency);
 }
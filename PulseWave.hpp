@@ -9,6 +9,19 @@
 const int CPU_CYCLES_PER_PULSE_CYCLE = 16;
 const float PULSE_PERIOD_INCREMENT = CPU_CYCLES_PER_PULSE_CYCLE / CPU_FREQUENCY;
 
+// Each period is 8 steps of the duty sequencer
+const int PULSE_SEQUENCE_LENGTH = 8;
+const int CPU_CYCLES_PER_PULSE_STEP =
+  CPU_CYCLES_PER_PULSE_CYCLE / PULSE_SEQUENCE_LENGTH;
+
+// Whether the output is high at each step, for each duty setting
+// (12.5%, 25%, 50% and 25% negated)
+const unsigned char PULSE_DUTY_SEQUENCES[4][PULSE_SEQUENCE_LENGTH] = {
+  {0, 1, 0, 0, 0, 0, 0, 0},
+  {0, 1, 1, 0, 0, 0, 0, 0},
+  {0, 1, 1, 1, 1, 0, 0, 0},
+  {1, 0, 0, 1, 1, 1, 1, 1}};
+
 const unsigned int PULSE_MINIMUM_DIVIDER = 8;
 const unsigned int PULSE_MAXIMUM_DIVIDER = 0x7ff;
 
@@ -16,10 +29,11 @@ class PulseWave {
 
 public:
 
-  PulseWave(float sampleRate);
+  PulseWave();
   void reset();
   void setDivider(unsigned int divider);
-  void setDuty(float duty);
+  // Takes the duty bits from the register (0-3)
+  void setDuty(unsigned int duty);
   void setEnabled(bool);
   void setLengthCounterHalt(bool halt);
   void setLengthCounter(unsigned int c);
@@ -35,24 +49,40 @@ public:
   void frameCounterQuarterFrame();
   void frameCounterHalfFrame();
 
-  unsigned char tick();
+  // Stepping through a run of CPU cycles, for the mixer (see
+  // APU::synthesize). Register writes and frame counter clocks happen
+  // between runs, never during one. startRun begins a run at from;
+  // nextChange is the cycle the output might next change on (or
+  // NO_CHANGE if it won't), and step moves the sequencer on to it;
+  // endRun catches the sequencer up to the end of the run.
+  void startRun(double from);
+  double nextChange();
+  void step();
+  void endRun(double to);
+  // The output level, 0-15
+  unsigned char output();
 
   void printState(void);
 
 protected:
 
   float period();
+  double stepCycles();
+  bool silent();
   void sweepAct();
   void envelopeAct();
   void lengthCounterAct();
   unsigned char envelope();
 
-  const float sampleRate;
-
   unsigned int divider;
-  float duty;
+  unsigned int duty;
   bool enabled;
-  float time;
+
+  // Where the duty sequencer is, and the cycle it next steps on
+  unsigned int sequenceStep;
+  double nextStep;
+  // Set by reset, so that startRun restarts the sequencer
+  bool phaseReset;
 
   bool lengthCounterHalt;
   int lengthCounterValue;
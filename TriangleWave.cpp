@@ -5,15 +5,13 @@
 #include <cstdio>
 
 // TODO make sure to initialize everything here
-TriangleWave::TriangleWave(float sampleRate)
+TriangleWave::TriangleWave()
   : enabled(0), divider(0),
     sequenceIndex(TRIANGLE_WAVE_SEQUENCE_START),
-    time(0.0),
+    nextStep(0.0),
     linearCounterHalt(0), lengthCounterHalt(0),
     linearCounterInit(0), linearCounterValue(0),
-    lengthCounterValue(0),
-    sequencerLastActed(0.0),
-    sampleRate(sampleRate)
+    lengthCounterValue(0)
 {
 }
 
@@ -22,7 +20,6 @@ void TriangleWave::setEnabled(bool e) {
 }
 
 void TriangleWave::setDivider(unsigned int d) {
-  sequencerLastActed = time; // DEBUG
   divider = d;
 }
 
@@ -41,20 +38,6 @@ void TriangleWave::setLengthCounter(unsigned int c) {
   lengthCounterValue = c;
 }
 
-unsigned char TriangleWave::envelope() {
-  // Envelope has a 32-element sequence: it counts down from 15 to 0,
-  // then up from 0 to 15
-  unsigned char out;
-  if (sequenceIndex < 16) {
-    out = 15 - sequenceIndex;
-  } else {
-    out = sequenceIndex - 16;
-  }
-  assert((out >= 0) &&
-         (out <= ENVELOPE_MAX));
-  return out;
-}
-
 void TriangleWave::updateFrameCounter(bool mode) {
   frameCounterMode = mode;
 }
@@ -95,19 +78,6 @@ void TriangleWave::lengthCounterAct() {
   }
 }
 
-float TriangleWave::sequencerPeriod() {
-  return (divider + 1) / CPU_FREQUENCY;
-}
-
-void TriangleWave::sequencerAct() {
-  sequencerLastActed += sequencerPeriod();
-  // When the triangle wave is silenced, it doesn't jump to 0: it just
-  // keeps outputting what it's been outputting
-  if (!silent()) {
-    sequenceIndex = (sequenceIndex + 1) % TRIANGLE_WAVE_SEQUENCE_LENGTH;
-  }
-}
-
 bool TriangleWave::silent() {
   // The channel is silent if the channel is inactive, if either
   // counter has expired, or if the divider is below its minimum
@@ -120,12 +90,24 @@ bool TriangleWave::silent() {
            (divider < TRIANGLE_MINIMUM_DIVIDER));
 }
 
-unsigned char TriangleWave::tick() {
-  if (sequencerPeriod() - (time - sequencerLastActed)
-      <= TIME_PRECISION) {
-    sequencerAct();
+void TriangleWave::startRun(double from) {
+  if (nextStep < from) {
+    nextStep = from;
   }
-  unsigned char out = envelope();
-  time += 1.0 / sampleRate;
-  return out;
+}
+
+double TriangleWave::nextChange() {
+  // When the triangle wave is silenced, it doesn't jump to 0: it just
+  // keeps outputting what it's been outputting, so the sequencer stays
+  // put
+  return silent() ? NO_CHANGE : nextStep;
+}
+
+void TriangleWave::step() {
+  sequenceIndex = (sequenceIndex + 1) % TRIANGLE_WAVE_SEQUENCE_LENGTH;
+  nextStep += divider + 1;
+}
+
+unsigned char TriangleWave::output() {
+  return TRIANGLE_SEQUENCE[sequenceIndex];
 }
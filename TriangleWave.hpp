@@ -9,10 +9,16 @@ const int TRIANGLE_WAVE_SEQUENCE_START = 15;
 
 const int TRIANGLE_MINIMUM_DIVIDER = 2;
 
+// The output at each step of the sequence: down from 15 to 0, then up
+// from 0 to 15
+const unsigned char TRIANGLE_SEQUENCE[TRIANGLE_WAVE_SEQUENCE_LENGTH] = {
+  15, 14, 13, 12, 11, 10, 9, 8, 7, 6, 5, 4, 3, 2, 1, 0,
+  0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15};
+
 class TriangleWave {
 
 public:
-  TriangleWave(float sampleRate);
+  TriangleWave();
   void setEnabled(bool enabled);
   void setDivider(unsigned int divider);
   void setLinearCounterInit(unsigned int c);
@@ -24,15 +30,21 @@ public:
   void frameCounterQuarterFrame();
   void frameCounterHalfFrame();
 
-  unsigned char tick();
+  // Stepping through a run of CPU cycles, for the mixer: see
+  // PulseWave. The sequencer doesn't run while the channel's silent,
+  // so there's no endRun.
+  void startRun(double from);
+  double nextChange();
+  void step();
+  // The output level, 0-15
+  unsigned char output();
 
 protected:
-  const float sampleRate;
-
   bool enabled;
   unsigned int divider;
   unsigned int sequenceIndex;
-  float time;
+  // The cycle the sequencer next steps on
+  double nextStep;
 
   // these two bits are actually the same bit in the NES
   bool linearCounterHalt; // a.k.a. linear counter control bit
@@ -42,18 +54,11 @@ protected:
   int linearCounterValue;
   int lengthCounterValue;
 
-  float sequencerPeriod();
-
   void linearCounterAct();
   void lengthCounterAct();
-  void sequencerAct();
-
-  float sequencerLastActed;
 
   bool silent();
 
-  unsigned char envelope();
-
   bool frameCounterMode;
 };
 
@@ -1,8 +1,17 @@
+#include <cmath>
 #include <stdexcept>
 #include <string>
 
 #include "apu.hpp"
 
+// For APU::synthesize to say which channel changes next: the pulses
+// are 0 and 1
+enum {
+  TRIANGLE_CHANNEL = N_PULSE_WAVES,
+  NOISE_CHANNEL,
+  DMC_CHANNEL
+};
+
 void checkPaError(PaError err) {
   if (err != paNoError) {
     fprintf(stderr, "PortAudio error: %s\n", Pa_GetErrorText(err));
@@ -19,23 +28,37 @@ static int apuCallback (const void *inputBuffer, void *outputBuffer,
   float *out = (float *) outputBuffer;
   (void) inputBuffer; /* Prevent unused variable warning. */
 
-  for(int i = 0; i < framesPerBuffer; i++) {
-    *out++ = apu->lastSample;
-    *out++ = apu->lastSample;
-    apu->tick();
+  // Generate in mono, in place, then spread it out to both channels
+  // from the back so nothing's overwritten before it's copied
+  apu->generate(out, framesPerBuffer);
+  for (long i = (long) framesPerBuffer - 1; i >= 0; i--) {
+    out[2 * i + 1] = out[i];
+    out[2 * i] = out[i];
   }
   return 0;
 }
 
 APU::APU(float sampleRate)
-  : time(0), sampleRate(sampleRate), timeStep(1.0/sampleRate),
+  : sampleRate(sampleRate),
     frameCounterMode(0),
-    pulses(std::vector<PulseWave>(2, PulseWave(sampleRate))),
-    triangle(TriangleWave(sampleRate))
+    pulses(std::vector<PulseWave>(2, PulseWave())),
+    triangle(TriangleWave()), noise(NoiseWave()), dmc(DmcWave()),
+    cycle(0.0), cyclesPerSample(CPU_FREQUENCY / sampleRate), realtime(false),
+    targetLatency(DEFAULT_TARGET_LATENCY),
+    smoothedLatency(DEFAULT_TARGET_LATENCY), playedCycle(0.0), playbackRate(1.0),
+    underruns(0), overruns(0),
+    blip(CPU_FREQUENCY / sampleRate), lastMix(0.0),
+    status(0), triangleTimer(0), dmcLength(1), stream(NULL)
 {
+  for (int i = 0; i < N_PULSE_WAVES; i++) {
+    pulseTimers[i] = 0;
+  }
 }
 
 APU::~APU(void) {
+  if (!stream) {
+    return;
+  }
   PaError err = Pa_StopStream(stream);
   checkPaError(err);
 
@@ -43,20 +66,34 @@ APU::~APU(void) {
   checkPaError(err);
 }
 
-void APU::apuInit(void) {
-
+void APU::apuInit(unsigned int framesPerBuffer, double deviceLatency,
+                  double _targetLatency) {
+  realtime = true;
+  targetLatency = _targetLatency;
+  smoothedLatency = _targetLatency;
 
   PaError err = Pa_Initialize();
   checkPaError(err);
 
+  PaStreamParameters output;
+  output.device = Pa_GetDefaultOutputDevice();
+  if (output.device == paNoDevice) {
+    fprintf(stderr, "PortAudio error: no default output device\n");
+    exit(1);
+  }
+  output.channelCount = 2;         /* stereo output */
+  output.sampleFormat = paFloat32; /* 32 bit floating point output */
+  output.suggestedLatency = (deviceLatency > 0) ? deviceLatency :
+    Pa_GetDeviceInfo(output.device)->defaultLowOutputLatency;
+  output.hostApiSpecificStreamInfo = NULL;
 
-  err = Pa_OpenDefaultStream(
+  err = Pa_OpenStream(
     &stream,
-    0,                /* no input channels */
-    2,                /* stereo output */
-    paFloat32,        /* 32 bit floating point output */
-    (int) sampleRate, /* sample rate */
-    256,              /* frames per buffer */
+    NULL,             /* no input */
+    &output,
+    sampleRate,       /* sample rate */
+    framesPerBuffer,  /* frames per buffer */
+    paNoFlag,
     apuCallback,      /* callback */
     this);            /* pointer passed to callback */
   checkPaError(err);
@@ -66,33 +103,344 @@ void APU::apuInit(void) {
 
 }
 
-// Computes one sample. Returns the sample, and also stores it in the
-// lastSample member. Automatically advances the stored time. Mixes
-// sources using a linear approximation of the NES's mixer. Returns a
-// value between 0.0 and 1.0, so that zero outputs match (and there's
-// no popping sound on startup and shutdown). Does not currently
-// simulate the high-pass and low-pass filters that the NES appliles
-// after DAC conversion.
-float APU::tick(void) {
-  float out = 0.0;
-  // Using linear approximation for mixing: see
-  // http://wiki.nesdev.com/w/index.php/APU_Mixer
+// Computes n samples into out, applying queued writes and frame
+// counter clocks as playback reaches them. Between them, synthesize
+// steps the channels and mixes their outputs with the NES's nonlinear
+// mixer (see ApuMixer); only the changes in the mixed output go into
+// the blip buffer. Outputs values between 0.0 and 1.0, so that zero
+// outputs match (and there's no popping sound on startup and
+// shutdown). Does not currently simulate the high-pass and low-pass
+// filters that the NES applies after DAC conversion.
+void APU::generate(float *out, unsigned int n) {
+  double newest = (double) writeQueue.newestCycle();
+  double step = cyclesPerSample;
+  bool hadWrites = cycle < newest;
+  if (realtime) {
+    double behind = (newest - cycle) / CPU_FREQUENCY;
+    if (behind > APU_OVERRUN_FACTOR * targetLatency) {
+      cycle = newest - targetLatency * CPU_FREQUENCY;
+      behind = targetLatency;
+      smoothedLatency = targetLatency;
+      overruns++;
+    }
+    smoothedLatency += APU_LATENCY_SMOOTHING * (behind - smoothedLatency);
+    double adjust = APU_RATE_GAIN * (smoothedLatency - targetLatency) / targetLatency;
+    if (adjust > APU_MAX_RATE_ADJUST) {
+      adjust = APU_MAX_RATE_ADJUST;
+    } else if (adjust < -APU_MAX_RATE_ADJUST) {
+      adjust = -APU_MAX_RATE_ADJUST;
+    }
+    step *= 1.0 + adjust;
+    playbackRate = 1.0 + adjust;
+  }
+  bool starved = false;
+  blip.begin(n);
+  double start = blip.startCycle();
+  double runStart = start;
+  for (unsigned int i = 0; i < n; i++) {
+    if (eventDue(cycle)) {
+      double now = start + i * cyclesPerSample;
+      synthesize(runStart, now);
+      runStart = now;
+      applyEvents(cycle);
+    }
+    cycle += step;
+    // Don't get ahead of the emulator: it may still send writes for
+    // cycles up to the newest one. (render doesn't need this, since
+    // it's told how far the emulator has gotten.)
+    if (realtime && cycle > newest) {
+      cycle = newest;
+      starved = true;
+    }
+  }
+  synthesize(runStart, start + n * cyclesPerSample);
+  blip.read(out, n);
+  if (realtime) {
+    // Running out is only an underrun if there was something to play:
+    // not if the emulator's paused
+    if (starved && hadWrites) {
+      underruns++;
+    }
+    playedCycle = cycle;
+  }
+}
+
+void APU::synthesize(double from, double to) {
+  for (int pulse_i = 0; pulse_i < N_PULSE_WAVES; pulse_i++) {
+    pulses[pulse_i].startRun(from);
+  }
+  triangle.startRun(from);
+  noise.startRun(from);
+  dmc.startRun(from);
+  // A write since the last run may have changed the output
+  mixOutput(from);
+  // Step whichever channel changes next, until none do before the end
+  // of the run. The mixer isn't linear, so the channels can't each add
+  // their own steps.
+  while (true) {
+    double next = to;
+    int channel = -1;
+    for (int pulse_i = 0; pulse_i < N_PULSE_WAVES; pulse_i++) {
+      if (pulses[pulse_i].nextChange() < next) {
+        next = pulses[pulse_i].nextChange();
+        channel = pulse_i;
+      }
+    }
+    if (triangle.nextChange() < next) {
+      next = triangle.nextChange();
+      channel = TRIANGLE_CHANNEL;
+    }
+    if (noise.nextChange() < next) {
+      next = noise.nextChange();
+      channel = NOISE_CHANNEL;
+    }
+    if (dmc.nextChange() < next) {
+      next = dmc.nextChange();
+      channel = DMC_CHANNEL;
+    }
+    if (channel < 0) {
+      break;
+    }
+    if (channel == TRIANGLE_CHANNEL) {
+      triangle.step();
+    } else if (channel == NOISE_CHANNEL) {
+      noise.step();
+    } else if (channel == DMC_CHANNEL) {
+      dmc.step();
+    } else {
+      pulses[channel].step();
+    }
+    mixOutput(next);
+  }
   for (int pulse_i = 0; pulse_i < N_PULSE_WAVES; pulse_i++) {
-    out += pulses[pulse_i].tick() * PULSE_MIX_COEFFICIENT;
+    pulses[pulse_i].endRun(to);
   }
-  out += triangle.tick() * TRIANGLE_MIX_COEFFICIENT;
-  //out = (out * 2.0) - 1.0;
-  lastSample = out;
-  time += timeStep;
+  noise.endRun(to);
+}
+
+void APU::mixOutput(double at) {
+  float out = mixer.output(pulses[0].output(), pulses[1].output(),
+                           triangle.output(), noise.output(), dmc.output());
+  if (out != lastMix) {
+    blip.addDelta(at, out - lastMix);
+    lastMix = out;
+  }
+}
+
+bool APU::eventDue(double until) {
+  apuWrite write;
+  return frameCounter.nextClock() <= until ||
+    (writeQueue.peek(write) && write.cycle <= until);
+}
+
+void APU::applyEvents(double until) {
+  apuWrite write;
+  while (true) {
+    bool writeDue = writeQueue.peek(write) && write.cycle <= until;
+    double clock = frameCounter.nextClock();
+    // A write on the same cycle as a clock goes first: if it's to
+    // $4017, the clock never happens
+    if (clock <= until && !(writeDue && write.cycle <= clock)) {
+      if (frameCounter.nextIsHalfFrame()) {
+        frameCounterHalfFrame();
+      } else {
+        frameCounterQuarterFrame();
+      }
+      frameCounter.advance();
+    } else if (writeDue) {
+      writeRegister(write);
+      writeQueue.pop();
+    } else {
+      break;
+    }
+  }
+}
+
+void APU::queueWrites(const apuWrite *writes, unsigned int n) {
+  for (unsigned int i = 0; i < n; i++) {
+    writeQueue.push(writes[i]);
+  }
+}
+
+void APU::advanceTo(unsigned long long cycle) {
+  writeQueue.advanceTo(cycle);
+}
+
+void APU::loadPrgRom(const unsigned char *data, unsigned int n) {
+  dmcSamples.setPrgRom(data, n);
+}
+
+unsigned long APU::droppedWrites() {
+  return writeQueue.dropped();
+}
+
+audioStats APU::stats() {
+  audioStats out;
+  out.latency = (writeQueue.newestCycle() - playedCycle) / CPU_FREQUENCY;
+  out.playbackRate = playbackRate;
+  out.underruns = underruns;
+  out.overruns = overruns;
+  out.droppedWrites = droppedWrites();
   return out;
 }
 
+unsigned int APU::render(unsigned long long untilCycle,
+                         short *out, unsigned int maxSamples) {
+  if (cycle >= (double) untilCycle) {
+    return 0;
+  }
+  // Enough samples for playback to reach untilCycle
+  double needed = ceil(((double) untilCycle - cycle) / cyclesPerSample);
+  unsigned int n = (needed < maxSamples) ? (unsigned int) needed : maxSamples;
+  samples.resize(n);
+  generate(&samples[0], n);
+  for (unsigned int i = 0; i < n; i++) {
+    float sample = samples[i] * PCM_MAX;
+    if (sample > PCM_MAX) {
+      sample = PCM_MAX;
+    } else if (sample < -PCM_MAX) {
+      sample = -PCM_MAX;
+    }
+    out[i] = (short) sample;
+  }
+  return n;
+}
+
+// Mirrors what apu.py's channels make of each write
+void APU::writeRegister(const apuWrite &write) {
+  unsigned int reg = write.reg;
+  unsigned int value = write.value;
+  if (reg == APU_DMC_START) {
+    dmc.start(&dmcSamples.get(value, dmcLength));
+  } else if (reg == APU_STATUS) {
+    status = value;
+    setPulseEnabled(0, value & PULSE_1_STATUS_MASK);
+    setPulseEnabled(1, value & PULSE_2_STATUS_MASK);
+    triangle.setEnabled(value & TRIANGLE_STATUS_MASK);
+    noise.setEnabled(value & NOISE_STATUS_MASK);
+    // The emulator starts samples itself, with APU_DMC_START
+    if (!(value & DMC_STATUS_MASK)) {
+      dmc.stop();
+    }
+  } else if (reg == APU_FRAME_COUNTER) {
+    frameCounter.reset(write.cycle, value & FRAME_COUNTER_MODE_MASK);
+    updateFrameCounter(value & FRAME_COUNTER_MODE_MASK);
+  } else if (PULSE_1_BASE <= reg && reg < PULSE_1_BASE + CHANNEL_ADDRESS_RANGE) {
+    writePulse(0, reg - PULSE_1_BASE, value);
+  } else if (PULSE_2_BASE <= reg && reg < PULSE_2_BASE + CHANNEL_ADDRESS_RANGE) {
+    writePulse(1, reg - PULSE_2_BASE, value);
+  } else if (TRIANGLE_BASE <= reg && reg < TRIANGLE_BASE + CHANNEL_ADDRESS_RANGE) {
+    writeTriangle(reg - TRIANGLE_BASE, value);
+  } else if (NOISE_BASE <= reg && reg < NOISE_BASE + CHANNEL_ADDRESS_RANGE) {
+    writeNoise(reg - NOISE_BASE, value);
+  } else if (DMC_BASE <= reg && reg < DMC_BASE + CHANNEL_ADDRESS_RANGE) {
+    writeDmc(reg - DMC_BASE, value);
+  }
+}
+
+void APU::writePulse(unsigned int pulse_n, unsigned int reg,
+                     unsigned char value) {
+  unsigned char enabledMask = pulse_n ? PULSE_2_STATUS_MASK : PULSE_1_STATUS_MASK;
+  switch (reg) {
+  case 0: {
+    // Duty, length counter halt (also the envelope loop flag), envelope
+    bool halt = value & 0x20;
+    setPulseDuty(pulse_n, value >> 6);
+    setPulseLengthCounterHalt(pulse_n, halt);
+    updatePulseEnvelope(pulse_n, halt, value & 0x10, value & 0xf);
+    break;
+  }
+  case 1: // Sweep unit
+    updatePulseSweep(pulse_n, value & 0x80, 1 + ((value >> 4) & 0x7),
+                     value & 0x7, value & 0x8);
+    break;
+  case 2: // Timer low (does not reset phase or envelope)
+    pulseTimers[pulse_n] = (pulseTimers[pulse_n] & 0x700) | value;
+    setPulseDivider(pulse_n, pulseTimers[pulse_n]);
+    break;
+  case 3: // Length counter load, timer high
+    pulseTimers[pulse_n] = (pulseTimers[pulse_n] & 0xff) | ((value & 0x7) << 8);
+    setPulseDivider(pulse_n, pulseTimers[pulse_n]);
+    if (status & enabledMask) {
+      setPulseLengthCounter(pulse_n, LENGTH_COUNTER_TABLE[value >> 3]);
+      // As a side effect, this restarts the envelope and resets the
+      // phase.
+      resetPulse(pulse_n);
+    }
+    break;
+  }
+}
+
+void APU::writeTriangle(unsigned int reg, unsigned char value) {
+  switch (reg) {
+  case 0: // Linear counter load, counters halt
+    triangle.setLinearCounterInit(value & 0x7f);
+    triangle.setTimerHalts(value & 0x80);
+    break;
+  case 2: // Timer low
+    triangleTimer = (triangleTimer & 0x700) | value;
+    triangle.setDivider(triangleTimer);
+    break;
+  case 3: // Length counter load, timer high
+    triangleTimer = (triangleTimer & 0xff) | ((value & 0x7) << 8);
+    triangle.setDivider(triangleTimer);
+    if (status & TRIANGLE_STATUS_MASK) {
+      triangle.setLengthCounter(LENGTH_COUNTER_TABLE[value >> 3]);
+      // As a side effect, this reloads the linear counter.
+      triangle.linearCounterReload();
+    }
+    break;
+  }
+  // Register 1 is unused
+}
+
+void APU::writeNoise(unsigned int reg, unsigned char value) {
+  switch (reg) {
+  case 0: {
+    // Length counter halt (also the envelope loop flag), envelope
+    bool halt = value & 0x20;
+    noise.setLengthCounterHalt(halt);
+    noise.updateEnvelope(halt, value & 0x10, value & 0xf);
+    break;
+  }
+  case 2: // Mode, period
+    noise.setShortMode(value & 0x80);
+    noise.setPeriod(value & 0xf);
+    break;
+  case 3: // Length counter load
+    if (status & NOISE_STATUS_MASK) {
+      noise.setLengthCounter(LENGTH_COUNTER_TABLE[value >> 3]);
+    }
+    // As a side effect, this restarts the envelope
+    noise.reset();
+    break;
+  }
+  // Register 1 is unused
+}
+
+void APU::writeDmc(unsigned int reg, unsigned char value) {
+  switch (reg) {
+  case 0: // IRQ enable, loop (both handled by the emulator), rate
+    dmc.setRate(value & 0xf);
+    break;
+  case 1: // Direct load
+    dmc.setOutputLevel(value & 0x7f);
+    break;
+  case 3: // Sample length
+    dmcLength = value * 16 + 1;
+    break;
+  }
+  // The emulator works out where the sample address (register 2)
+  // points, and sends it with APU_DMC_START
+}
+
 void APU::updateFrameCounter(bool mode) {
   frameCounterMode = mode;
   for (int i = 0; i < N_PULSE_WAVES; i++) {
     pulses.at(i).updateFrameCounter(mode);
   }
   triangle.updateFrameCounter(mode);
+  noise.updateFrameCounter(mode);
   if (mode) {
     // Updating the frame counter with the mode bit set will
     // immediately generate half-frame and quarter-frame clocks.
@@ -105,6 +453,7 @@ void APU::frameCounterQuarterFrame() {
     pulses.at(i).frameCounterQuarterFrame();
   }
   triangle.frameCounterQuarterFrame();
+  noise.frameCounterQuarterFrame();
 }
 
 void APU::frameCounterHalfFrame() {
@@ -112,6 +461,7 @@ void APU::frameCounterHalfFrame() {
     pulses.at(i).frameCounterHalfFrame();
   }
   triangle.frameCounterHalfFrame();
+  noise.frameCounterHalfFrame();
 }
 
 void APU::resetPulse(unsigned int pulse_n) {
@@ -126,7 +476,7 @@ void APU::setPulseEnabled(unsigned int pulse_n, bool enabled) {
   pulses.at(pulse_n).setEnabled(enabled);
 }
 
-void APU::setPulseDuty(unsigned int pulse_n, float duty) {
+void APU::setPulseDuty(unsigned int pulse_n, unsigned int duty) {
   pulses.at(pulse_n).setDuty(duty);
 }
 
@@ -154,88 +504,49 @@ void APU::updatePulseEnvelope(unsigned int pulse_n,
 
 extern "C" {
 
-  APU *ex_initAPU(void) {
+  // An APU that plays through the sound card. A deviceLatency of 0
+  // means the device's default.
+  APU *ex_initAPU(unsigned int framesPerBuffer, double deviceLatency,
+                  double targetLatency) {
     APU *out = new APU(SAMPLE_RATE);
-    out->apuInit();
+    out->apuInit(framesPerBuffer, deviceLatency, targetLatency);
     return out;
   }
 
-  void ex_updateFrameCounter(APU *apu, unsigned char mode) {
-    apu->updateFrameCounter((bool) mode);
-  }
-
-  void ex_frameCounterQuarterFrame(APU *apu) {
-    apu->frameCounterQuarterFrame();
-  }
-
-  void ex_frameCounterHalfFrame(APU *apu) {
-    apu->frameCounterHalfFrame();
-  }
-
-  // pulse wave interface
-
-  void ex_resetPulse(APU *apu, unsigned int pulse_n) {
-    apu->resetPulse(pulse_n);
-  }
-
-  void ex_setPulseDivider(APU *apu, unsigned int pulse_n, unsigned int divider) {
-    apu->setPulseDivider(pulse_n, divider);
-  }
-
-  void ex_setPulseEnabled(APU *apu, unsigned int pulse_n, unsigned char enabled) {
-    apu->setPulseEnabled(pulse_n, enabled);
-  }
-
-  void ex_setPulseDuty(APU *apu, unsigned int pulse_n, float duty) {
-    apu->setPulseDuty(pulse_n, duty);
+  // An APU that only produces samples through ex_render, as fast as
+  // it's asked for them
+  APU *ex_initOfflineAPU(void) {
+    return new APU(SAMPLE_RATE);
   }
 
-  void ex_setPulseLengthCounterHalt(APU *apu, unsigned int pulse_n, unsigned char halt) {
-    apu->setPulseLengthCounterHalt(pulse_n, (bool) halt);
+  void ex_destroyAPU(APU *apu) {
+    delete apu;
   }
 
-  void ex_setPulseLengthCounter(APU *apu, unsigned int pulse_n, unsigned int c) {
-    apu->setPulseLengthCounter(pulse_n, c);
-  }
-
-  void ex_updatePulseSweep(APU *apu, unsigned int pulse_n,
-                           unsigned char enabled, unsigned int divider,
-                           unsigned int shift, unsigned char negate) {
-    apu->updatePulseSweep(pulse_n,
-                          (bool) enabled, divider,
-                          shift, (bool) negate);
-  }
-
-  void ex_updatePulseEnvelope(APU *apu, unsigned int pulse_n,
-                              unsigned char loop, unsigned char constant,
-                              unsigned char timerReload) {
-    apu->updatePulseEnvelope(pulse_n, (bool) loop, (bool) constant, timerReload);
-  }
-
-
-  // triangle wave interface
-
-  void ex_setTriangleEnabled(APU *apu, unsigned char enabled) {
-    apu->triangle.setEnabled((bool) enabled);
+  unsigned int ex_render(APU *apu, unsigned long long untilCycle,
+                         short *out, unsigned int maxSamples) {
+    return apu->render(untilCycle, out, maxSamples);
   }
 
-  void ex_setTriangleDivider(APU *apu, unsigned int divider) {
-    apu->triangle.setDivider(divider);
+  // Takes an array of n writes. Copying them into the queue is the
+  // only synchronization with the audio callback.
+  void ex_queueWrites(APU *apu, const apuWrite *writes, unsigned int n) {
+    apu->queueWrites(writes, n);
   }
 
-  void ex_setTriangleLinearCounterInit(APU *apu, unsigned int c) {
-    apu->triangle.setLinearCounterInit(c);
+  void ex_advanceTo(APU *apu, unsigned long long cycle) {
+    apu->advanceTo(cycle);
   }
 
-  void ex_setTriangleTimerHalts(APU *apu, unsigned char halt) {
-    apu->triangle.setTimerHalts((bool) halt);
+  void ex_loadPrgRom(APU *apu, const unsigned char *data, unsigned int n) {
+    apu->loadPrgRom(data, n);
   }
 
-  void ex_setTriangleLengthCounter(APU *apu, unsigned int c) {
-    apu->triangle.setLengthCounter(c);
+  unsigned long ex_droppedWrites(APU *apu) {
+    return apu->droppedWrites();
   }
 
-  void ex_triangleLinearCounterReload(APU *apu) {
-    apu->triangle.linearCounterReload();
+  void ex_audioStats(APU *apu, audioStats *out) {
+    *out = apu->stats();
   }
 }
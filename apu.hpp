@@ -1,30 +1,110 @@
 #ifndef APU_H
 #define APU_H
 
+#include <atomic>
 #include <cstdlib>
 #include <string>
 #include <vector>
 
 #include "portaudio.h"
 
+#include "ApuMixer.hpp"
+#include "ApuWriteQueue.hpp"
+#include "BlipBuffer.hpp"
+#include "DmcWave.hpp"
+#include "FrameCounter.hpp"
+#include "NoiseWave.hpp"
 #include "PulseWave.hpp"
 #include "TriangleWave.hpp"
 
 const int N_PULSE_WAVES = 2;
 
 const float SAMPLE_RATE = 44100.0;
+// Defaults for apuInit
+const unsigned int FRAMES_PER_BUFFER = 256;
+const double DEFAULT_TARGET_LATENCY = 0.04;
 
-const float PULSE_MIX_COEFFICIENT = 0.00752;
-const float TRIANGLE_MIX_COEFFICIENT = 0.00851;
-const float NOISE_MIX_COEFFICIENT = 0.00494;
-const float DMC_MIX_COEFFICIENT = 0.00335;
+// Register addresses
+const unsigned int APU_STATUS = 0x4015;
+const unsigned int APU_FRAME_COUNTER = 0x4017;
+const unsigned int PULSE_1_BASE = 0x4000;
+const unsigned int PULSE_2_BASE = 0x4004;
+const unsigned int TRIANGLE_BASE = 0x4008;
+const unsigned int NOISE_BASE = 0x400c;
+const unsigned int DMC_BASE = 0x4010;
+const unsigned int CHANNEL_ADDRESS_RANGE = 4;
+
+const unsigned char PULSE_1_STATUS_MASK = 0x1;
+const unsigned char PULSE_2_STATUS_MASK = 0x2;
+const unsigned char TRIANGLE_STATUS_MASK = 0x4;
+const unsigned char NOISE_STATUS_MASK = 0x8;
+const unsigned char DMC_STATUS_MASK = 0x10;
+
+const unsigned char FRAME_COUNTER_MODE_MASK = 0x80;
+
+const unsigned char LENGTH_COUNTER_TABLE[32] = {
+  10, 254, 20, 2, 40, 4, 80, 6,
+  160, 8, 60, 10, 14, 12, 26, 14,
+  12, 16, 24, 18, 48, 20, 96, 22,
+  192, 24, 72, 26, 16, 28, 32, 30};
+
+// The audio callback plays writes back on its own clock, which follows
+// the emulator's cycle count, aiming to stay the target latency behind
+// it. It never runs past the newest write (an underrun). If it falls
+// more than APU_OVERRUN_FACTOR times the target behind (an overrun),
+// it skips ahead to the target. In between, it plays writes back up to
+// APU_MAX_RATE_ADJUST faster or slower than real time, in proportion
+// to how far the latency is off target (smoothed, since writes arrive
+// in bursts).
+const double APU_OVERRUN_FACTOR = 2.5;
+const double APU_MAX_RATE_ADJUST = 0.005;
+const double APU_RATE_GAIN = 0.02;
+const double APU_LATENCY_SMOOTHING = 0.05;
+
+/* For tuning latency: apu.py's AudioStats has to match this layout. */
+typedef struct audioStats {
+  // How far playback is behind the emulator, in seconds
+  double latency;
+  // How fast writes are being played back, relative to real time
+  double playbackRate;
+  // Callbacks that caught up with the emulator and ran out of writes
+  unsigned long underruns;
+  // Times playback fell so far behind that it skipped ahead
+  unsigned long overruns;
+  // Writes lost because the queue was full
+  unsigned long droppedWrites;
+} audioStats;
+
+// Full scale for 16-bit PCM output
+const float PCM_MAX = 32767.0;
 
 class APU {
 public:
   APU(float sampleRate);
   ~APU();
-  void apuInit();
-  float tick();
+  // Start playing through PortAudio, asking it for framesPerBuffer
+  // samples at a time, with the given device latency in seconds (or
+  // the device's default if it's 0). Playback aims to stay
+  // targetLatency seconds behind the emulator. Without this, the APU
+  // only produces samples through render.
+  void apuInit(unsigned int framesPerBuffer, double deviceLatency,
+               double targetLatency);
+  // Generate n samples, as floats between 0 and 1
+  void generate(float *out, unsigned int n);
+  // Render 16-bit samples into out until playback reaches the given
+  // cycle, or until out is full. Returns how many it rendered.
+  unsigned int render(unsigned long long untilCycle,
+                      short *out, unsigned int maxSamples);
+  // Queue writes from the emulator, to be applied by generate at their
+  // cycles
+  void queueWrites(const apuWrite *writes, unsigned int n);
+  // The emulator has gotten to this cycle
+  void advanceTo(unsigned long long cycle);
+  // Copy the cartridge's PRG ROM, for the DMC to play samples from.
+  // Has to happen before any writes are queued.
+  void loadPrgRom(const unsigned char *data, unsigned int n);
+  unsigned long droppedWrites();
+  audioStats stats();
   void updateFrameCounter(bool);
   void frameCounterQuarterFrame();
   void frameCounterHalfFrame();
@@ -32,7 +112,7 @@ public:
   void resetPulse(unsigned int);
   void setPulseDivider(unsigned int, unsigned int);
   void setPulseEnabled(unsigned int, bool);
-  void setPulseDuty(unsigned int, float);
+  void setPulseDuty(unsigned int, unsigned int);
   void setPulseLengthCounterHalt(unsigned int, bool);
   void setPulseLengthCounter(unsigned int, unsigned int);
   void setPulseDuration(unsigned int, float);
@@ -43,16 +123,66 @@ public:
                            bool loop, bool constant,
                            unsigned char timerReload);
 
-  float lastSample;
-
   std::vector<PulseWave> pulses;
   TriangleWave triangle;
+  NoiseWave noise;
+  DmcWave dmc;
 
 protected:
-  float time;
   float sampleRate;
-  float timeStep;
 
+  // Add the mixed output between the given cycles to blip
+  void synthesize(double from, double to);
+  // Add a step to blip at the given cycle if the mix has changed
+  void mixOutput(double at);
+  // Whether there's a write or frame counter clock due by the given
+  // cycle
+  bool eventDue(double until);
+  // Apply every write and frame counter clock due by the given cycle,
+  // in order
+  void applyEvents(double until);
+  // Takes a whole apuWrite value: a byte, except for APU_DMC_START
+  void writeRegister(const apuWrite &write);
+  void writePulse(unsigned int pulse_n, unsigned int reg, unsigned char value);
+  void writeTriangle(unsigned int reg, unsigned char value);
+  void writeNoise(unsigned int reg, unsigned char value);
+  void writeDmc(unsigned int reg, unsigned char value);
+
+  ApuWriteQueue writeQueue;
+  // Where playback has gotten to, in CPU cycles
+  double cycle;
+  double cyclesPerSample;
+  // Whether the clock follows the audio device (apuInit was called),
+  // or render
+  bool realtime;
+  double targetLatency;
+  double smoothedLatency;
+  // For stats, which the emulator's thread reads
+  std::atomic<double> playedCycle;
+  std::atomic<double> playbackRate;
+  std::atomic<unsigned long> underruns;
+  std::atomic<unsigned long> overruns;
+
+  BlipBuffer blip;
+  ApuMixer mixer;
+  // The mixed output last added to blip
+  float lastMix;
+  // render generates into this, then converts
+  std::vector<float> samples;
+
+  // Register state that the channels don't keep themselves: the status
+  // register's enable bits, the timers, which get written 8 and 3 bits
+  // at a time, and the DMC's sample length, which is only used when a
+  // sample starts
+  unsigned char status;
+  unsigned int pulseTimers[N_PULSE_WAVES];
+  unsigned int triangleTimer;
+  // The DMC's sample length, in bytes
+  unsigned int dmcLength;
+
+  DmcSampleCache dmcSamples;
+
+  FrameCounter frameCounter;
   bool frameCounterMode;
 
   PaStream *stream;
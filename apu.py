@@ -1,6 +1,8 @@
 import sys
 import ctypes
-from ctypes import CDLL, c_void_p, c_uint, c_float, c_ubyte
+from ctypes import CDLL, c_void_p, c_uint, c_ulong, c_ulonglong, c_short, c_double
+
+import audiorecord
 
 # TODO: note when an APU cycle starts, react (and print info)
 # accordingly
@@ -11,6 +13,8 @@ APU_INFO = False
 
 ENABLE_PULSE = True
 ENABLE_TRIANGLE = True
+ENABLE_NOISE = True
+ENABLE_DMC = True
 
 APU_STATUS = 0x4015
 APU_FRAME_COUNTER = 0x4017
@@ -28,6 +32,9 @@ PULSE_2_STATUS_MASK = 0x2
 TRIANGLE_STATUS_MASK = 0x4
 NOISE_STATUS_MASK = 0x8
 DMC_STATUS_MASK = 0x10
+# Only in what $4015 reads back
+FRAME_IRQ_STATUS_MASK = 0x40
+DMC_IRQ_STATUS_MASK = 0x80
 
 FRAME_COUNTER_IRQ_INHIBIT_MASK = 0x40
 FRAME_COUNTER_MODE_MASK = 0x80
@@ -83,11 +90,45 @@ TRIANGLE_LC_LOAD_OFFSET = 3
 
 TRIANGLE_LC_TABLE = PULSE_LC_TABLE
 
+NOISE_ENVELOPE_DIVIDER_MASK = 0xf
+NOISE_CONSTANT_ENVELOPE_MASK = 0x10
+NOISE_LENGTH_HALT_MASK = 0x20
+
+NOISE_PERIOD_MASK = 0xf
+NOISE_MODE_MASK = 0x80
+
+NOISE_LC_LOAD_MASK = 0xf8
+NOISE_LC_LOAD_OFFSET = 3
+
+NOISE_LC_TABLE = PULSE_LC_TABLE
+
+# CPU cycles between shifts of the noise channel's shift register
+NOISE_PERIOD_TABLE = [4, 8, 16, 32, 64, 96, 128, 160,
+                      202, 254, 380, 508, 762, 1016, 2034, 4068]
+
+DMC_IRQ_ENABLE_MASK = 0x80
+DMC_LOOP_MASK = 0x40
+DMC_RATE_MASK = 0xf
+
+DMC_ADDRESS_BASE = 0xc000
+DMC_ADDRESS_UNIT = 64
+DMC_LENGTH_UNIT = 16
+
+# CPU cycles per bit of a sample, for each rate setting
+DMC_RATE_TABLE = [428, 380, 340, 320, 286, 254, 226, 214,
+                  190, 160, 142, 128, 106, 84, 72, 54]
+DMC_BITS_PER_BYTE = 8
+# How long the CPU stalls while the DMC reads a byte
+DMC_STALL_CYCLES = 4
+
 CPU_FREQUENCY = 1.789773e6
 CPU_CYCLES_PER_WAVEFORM_CYCLE = 16
 
 APU_CPU_CYCLES_PER_FC_CYCLE = 2
 
+# The frame counter's sequences, which libapu follows too (see
+# FrameCounter.hpp)
+
 # lazy enum
 # note: each successive value implies the previous: e.g. an interrupt
 # will also generate a half and quarter cycle clock
@@ -120,114 +161,292 @@ APU_5STEP_SEQUENCE = [
      APU_FC_HALF_FRAME)]
 APU_CYCLES_PER_5STEP_FRAME = 18641
 
-APU_FREQUENCY = CPU_FREQUENCY / 2.0
-
-class CAPU(object):
-
-    def __init__(self):
-        libapu = CDLL("libapu.so")
-
-        libapu.ex_initAPU.restype = c_void_p
-
-        libapu.ex_updateFrameCounter.argtypes = \
-        [c_void_p, c_ubyte]
-        libapu.ex_frameCounterQuarterFrame.argtypes = \
-        [c_void_p]
-        libapu.ex_frameCounterHalfFrame.argtypes = \
-        [c_void_p]
-
-        # pulse wave interface
-
-        libapu.ex_resetPulse.argtypes = \
-        [c_void_p, c_uint]
-        libapu.ex_setPulseDivider.argtypes = \
-        [c_void_p, c_uint, c_uint]
-        libapu.ex_setPulseEnabled.argtypes = \
-        [c_void_p, c_uint, c_ubyte]
-        libapu.ex_setPulseDuty.argtypes = \
-        [c_void_p, c_uint, c_float]
-        libapu.ex_setPulseLengthCounterHalt.argtypes = \
-        [c_void_p, c_uint, c_ubyte]
-        libapu.ex_setPulseLengthCounter.argtypes = \
-        [c_void_p, c_uint, c_uint]
-        libapu.ex_updatePulseSweep.argtypes = \
-        [c_void_p, c_uint, c_ubyte, c_uint, c_uint, c_ubyte]
-        libapu.ex_updatePulseEnvelope.argtypes = \
-        [c_void_p, c_uint, c_ubyte, c_ubyte, c_ubyte]
-
-        # triangle wave interface
-
-        libapu.ex_setTriangleEnabled.argtypes = \
-        [c_void_p, c_ubyte]
-        libapu.ex_setTriangleDivider.argtypes = \
-        [c_void_p, c_uint]
-        libapu.ex_setTriangleLinearCounterInit.argtypes = \
-        [c_void_p, c_uint]
-        libapu.ex_setTriangleTimerHalts.argtypes = \
-        [c_void_p, c_ubyte]
-        libapu.ex_setTriangleLengthCounter.argtypes = \
-        [c_void_p, c_uint]
-        libapu.ex_triangleLinearCounterReload.argtypes = \
-        [c_void_p]
-
-        self.libapu = libapu
-
-        self.apu_p = libapu.ex_initAPU()
-
-    def updateFrameCounter(self, mode):
-        self.libapu.ex_updateFrameCounter(self.apu_p, mode)
-
-    def frameCounterQuarterFrame(self):
-        self.libapu.ex_frameCounterQuarterFrame(self.apu_p)
-
-    def frameCounterHalfFrame(self):
-        self.libapu.ex_frameCounterHalfFrame(self.apu_p)
-
-    def resetPulse(self, pulse_n):
-        self.libapu.ex_resetPulse(self.apu_p, pulse_n)
+# Where each sequence's half frame clocks are, in CPU cycles from its
+# start
+APU_4STEP_HALF_FRAMES = [cycle for (cycle, frameType) in APU_4STEP_SEQUENCE
+                         if frameType >= APU_FC_HALF_FRAME]
+APU_5STEP_HALF_FRAMES = [cycle for (cycle, frameType) in APU_5STEP_SEQUENCE
+                         if frameType >= APU_FC_HALF_FRAME]
 
-    def setPulseDivider(self, pulse_n, divider):
-        self.libapu.ex_setPulseDivider(self.apu_p, pulse_n, divider)
+# The frame IRQ, in CPU cycles from the $4017 write that starts the
+# 4-step sequence, and how often it comes after that
+APU_FC_IRQ_CYCLE = APU_4STEP_SEQUENCE[-1][0]
+APU_FC_IRQ_PERIOD = APU_CYCLES_PER_4STEP_FRAME * APU_CPU_CYCLES_PER_FC_CYCLE
 
-    def setPulseEnabled(self, pulse_n, enabled):
-        self.libapu.ex_setPulseEnabled(self.apu_p, pulse_n, enabled)
+# What scheduleAction gives the CPU when the APU has nothing to do
+# until the game writes to it
+APU_NO_ACTION = float('inf')
 
-    def setPulseDuty(self, pulse_n, duty):
-        self.libapu.ex_setPulseDuty(self.apu_p, pulse_n, duty)
-
-    def setPulseLengthCounterHalt(self, pulse_n, h):
-        self.libapu.ex_setPulseLengthCounterHalt(self.apu_p, pulse_n, h)
-
-    def setPulseLengthCounter(self, pulse_n, c):
-        self.libapu.ex_setPulseLengthCounter(self.apu_p, pulse_n, c)
-
-    def updatePulseSweep(self, pulse_n, enabled, divider, shift, negate):
-        self.libapu.ex_updatePulseSweep(self.apu_p, pulse_n,
-                                        enabled, divider, shift, negate)
-
-    def updatePulseEnvelope(self, pulse_n, loop, constant, timerReload):
-        self.libapu.ex_updatePulseEnvelope(self.apu_p, pulse_n,
-                                           loop, constant, timerReload)
-
-    def setTriangleEnabled(self, e):
-        self.libapu.ex_setTriangleEnabled(self.apu_p, e)
+APU_FREQUENCY = CPU_FREQUENCY / 2.0
 
-    def setTriangleDivider(self, d):
-        self.libapu.ex_setTriangleDivider(self.apu_p, d)
+# Not a real register address: sends DMC sample starts along with the
+# writes. Must match ApuWriteQueue.hpp.
+APU_DMC_START = 0x8000
+
+# How many writes to collect before handing them to libapu
+APU_WRITE_BATCH_SIZE = 256
+
+# Must match SAMPLE_RATE in apu.hpp
+SAMPLE_RATE = 44100
+# How many samples to render per call when rendering offline (a bit
+# more than an APU frame's worth)
+APU_RENDER_BUFFER_SIZE = 512
+
+# Audio backends (see makeAudioBackend)
+AUDIO_PORTAUDIO = "portaudio" # play through the sound card
+AUDIO_WAV = "wav" # render to a WAV file
+AUDIO_MEMORY = "memory" # render into a NumPy array
+AUDIO_NULL = "null" # no audio
+AUDIO_BACKENDS = [AUDIO_PORTAUDIO, AUDIO_WAV, AUDIO_MEMORY, AUDIO_NULL]
+
+# Defaults for AudioSettings
+DEFAULT_TARGET_LATENCY = 0.04
+DEFAULT_FRAMES_PER_BUFFER = 256
+
+class AudioSettings(object):
+    """How to run live audio:
+
+    - targetLatency: how far, in seconds, playback aims to stay behind
+      the emulator. Lower is more responsive; higher survives more
+      hiccups without underruns.
+    - framesPerBuffer: how many samples the sound card asks for at a
+      time (the period)
+    - deviceLatency: how much the sound card buffers, in seconds, or
+      None for its default
 
-    def setTriangleLinearCounterInit(self, c):
-        self.libapu.ex_setTriangleLinearCounterInit(self.apu_p, c)
+    """
 
-    def setTriangleTimerHalts(self, h):
-        self.libapu.ex_setTriangleTimerHalts(self.apu_p, h)
+    def __init__(self,
+                 targetLatency = DEFAULT_TARGET_LATENCY,
+                 framesPerBuffer = DEFAULT_FRAMES_PER_BUFFER,
+                 deviceLatency = None):
+        if targetLatency <= 0:
+            raise ValueError("Target latency must be positive, not %r" % targetLatency)
+        if framesPerBuffer <= 0:
+            raise ValueError("Frames per buffer must be positive, not %r" % framesPerBuffer)
+        self.targetLatency = targetLatency
+        self.framesPerBuffer = framesPerBuffer
+        self.deviceLatency = deviceLatency
+
+class ApuWrite(ctypes.Structure):
+    "A register write at a CPU cycle. Must match apuWrite in ApuWriteQueue.hpp."
+    _fields_ = [('cycle', c_ulonglong),
+                ('register', c_uint),
+                ('value', c_uint)]
+
+class AudioStats(ctypes.Structure):
+    "Must match audioStats in apu.hpp."
+    _fields_ = [('latency', c_double),
+                ('playbackRate', c_double),
+                ('underruns', c_ulong),
+                ('overruns', c_ulong),
+                ('droppedWrites', c_ulong)]
+
+def _nop(*args):
+    pass
+
+class AudioBackend(object):
+    """Where the APU sends its register writes, each stamped with the CPU
+    cycle it happened on, to be made into sound. Every backend has:
+
+    - write(cycle, register, value): a register write, or one of the
+      APU_* pseudo-registers
+    - loadPrgRom(prgrom): the cartridge's PRG ROM, for DMC samples,
+      before any writes
+    - sync(cycle): the emulator's gotten to the given cycle, so
+      anything before it can be played
+    - close(cycle): the emulator's stopped at the given cycle
+    - droppedWrites(): how many writes got lost
+    - isLive(): whether it plays in real time, by its own clock; if so,
+      it also has settings (an AudioSettings), and stats(cycle), which
+      returns AudioStats as of the given cycle
+
+    See makeAudioBackend for the implementations."""
+
+    def isLive(self):
+        return False
+
+class NullBackend(AudioBackend):
+    """No audio. Every method is the same do-nothing function, so
+    calling one costs no more than a call."""
+
+    write = staticmethod(_nop)
+    loadPrgRom = staticmethod(_nop)
+    sync = staticmethod(_nop)
+    close = staticmethod(_nop)
+
+    def droppedWrites(self):
+        return 0
+
+class CAPU(AudioBackend):
+    """Sends register writes to libapu, which plays them back at their
+    cycles, clocking the frame counter itself. Writes are collected here
+    and handed over in batches, when the batch fills up or at a sync.
+    Subclasses start libapu one way or another (initAPU), and do
+    something with what it makes."""
 
-    def setTriangleLengthCounter(self, c):
-        self.libapu.ex_setTriangleLengthCounter(self.apu_p, c)
+    def __init__(self):
+        libapu = CDLL("libapu.so")
 
-    def triangleLinearCounterReload(self):
-        self.libapu.ex_triangleLinearCounterReload(self.apu_p)
+        libapu.ex_initAPU.argtypes = [c_uint, c_double, c_double]
+        libapu.ex_initAPU.restype = c_void_p
+        libapu.ex_initOfflineAPU.restype = c_void_p
+        libapu.ex_destroyAPU.argtypes = [c_void_p]
+        libapu.ex_queueWrites.argtypes = \
+        [c_void_p, ctypes.POINTER(ApuWrite), c_uint]
+        libapu.ex_advanceTo.argtypes = [c_void_p, c_ulonglong]
+        libapu.ex_loadPrgRom.argtypes = [c_void_p, ctypes.c_char_p, c_uint]
+        libapu.ex_droppedWrites.argtypes = [c_void_p]
+        libapu.ex_droppedWrites.restype = c_ulong
+        libapu.ex_audioStats.argtypes = [c_void_p, ctypes.POINTER(AudioStats)]
+        libapu.ex_render.argtypes = \
+        [c_void_p, c_ulonglong, ctypes.POINTER(c_short), c_uint]
+        libapu.ex_render.restype = c_uint
 
+        self.libapu = libapu
+        self.apu_p = self.initAPU()
+
+        self.batch = (ApuWrite * APU_WRITE_BATCH_SIZE)()
+        self.batchLength = 0
+        # The cycle of the newest write
+        self.lastCycle = 0
+
+    def loadPrgRom(self, prgrom):
+        "Copy PRG ROM to libapu, which plays DMC samples from it"
+        self.libapu.ex_loadPrgRom(self.apu_p, prgrom, len(prgrom))
+
+    def write(self, cycle, register, value):
+        self.lastCycle = cycle
+        write = self.batch[self.batchLength]
+        write.cycle = cycle
+        write.register = register
+        write.value = value
+        self.batchLength += 1
+        if self.batchLength == APU_WRITE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.batchLength:
+            self.libapu.ex_queueWrites(self.apu_p, self.batch, self.batchLength)
+            self.batchLength = 0
+
+    def sync(self, cycle):
+        """Hand over any waiting writes, and tell libapu the emulator's
+        gotten to the given cycle."""
+        self.flush()
+        self.libapu.ex_advanceTo(self.apu_p, cycle)
+
+    def close(self, cycle):
+        "Stop libapu"
+        if self.apu_p is None:
+            return
+        self.flush()
+        self.libapu.ex_destroyAPU(self.apu_p)
+        self.apu_p = None
+
+    def droppedWrites(self):
+        "Writes libapu had to drop because its queue was full"
+        return self.libapu.ex_droppedWrites(self.apu_p)
+
+class PortAudioBackend(CAPU):
+    """Plays through the sound card, in real time, with the given
+    AudioSettings (or the defaults)."""
+
+    def __init__(self, settings = None):
+        self.settings = settings or AudioSettings()
+        super(PortAudioBackend, self).__init__()
+
+    def initAPU(self):
+        return self.libapu.ex_initAPU(self.settings.framesPerBuffer,
+                                      self.settings.deviceLatency or 0.0,
+                                      self.settings.targetLatency)
+
+    def isLive(self):
+        return True
+
+    def stats(self, cycle):
+        """Sync to the given cycle, and return libapu's AudioStats: so
+        the latency is how far playback is behind that cycle."""
+        self.sync(cycle)
+        stats = AudioStats()
+        self.libapu.ex_audioStats(self.apu_p, ctypes.byref(stats))
+        return stats
+
+class OfflineBackend(CAPU):
+    """Renders offline into an output (see audiorecord.py): whenever it
+    hands libapu a batch of writes, or syncs, it renders samples up to
+    that cycle and hands them to the output, however fast the emulator
+    is running."""
+
+    def __init__(self, output):
+        self.output = output
+        self.buffer = (c_short * APU_RENDER_BUFFER_SIZE)()
+        super(OfflineBackend, self).__init__()
+
+    def initAPU(self):
+        return self.libapu.ex_initOfflineAPU()
+
+    def flush(self):
+        if self.batchLength:
+            super(OfflineBackend, self).flush()
+            # Render as we go, so libapu's queue never fills up
+            self.render(self.lastCycle)
+
+    def sync(self, cycle):
+        self.flush()
+        self.render(cycle)
+
+    def render(self, cycle):
+        "Render samples up to the given cycle."
+        while True:
+            n = self.libapu.ex_render(self.apu_p, cycle,
+                                      self.buffer, APU_RENDER_BUFFER_SIZE)
+            if n:
+                self.output.write(ctypes.string_at(self.buffer, n * 2))
+            if n < APU_RENDER_BUFFER_SIZE:
+                break
+
+    def close(self, cycle):
+        """Render up to the given cycle, close the output, and stop
+        libapu."""
+        if self.apu_p is None:
+            return
+        self.sync(cycle)
+        self.output.close()
+        super(OfflineBackend, self).close(cycle)
+
+class WavBackend(OfflineBackend):
+    "Renders offline to a WAV file."
+
+    def __init__(self, path):
+        super(WavBackend, self).__init__(audiorecord.WavRecorder(path, SAMPLE_RATE))
+
+class MemoryBackend(OfflineBackend):
+    "Renders offline into memory: for tests, and for timing libapu."
 
+    def __init__(self):
+        super(MemoryBackend, self).__init__(audiorecord.ArrayRecorder())
+
+    def samples(self):
+        "Everything rendered so far, as an int16 array"
+        return self.output.samples()
+
+def makeAudioBackend(name, settings = None, path = None):
+    """The backend called name (one of AUDIO_BACKENDS). settings (an
+    AudioSettings) is for AUDIO_PORTAUDIO; path is the file for
+    AUDIO_WAV."""
+    if name == AUDIO_PORTAUDIO:
+        return PortAudioBackend(settings)
+    elif name == AUDIO_WAV:
+        if path is None:
+            raise ValueError("The %s audio backend needs a path" % name)
+        return WavBackend(path)
+    elif name == AUDIO_MEMORY:
+        return MemoryBackend()
+    elif name == AUDIO_NULL:
+        return NullBackend()
+    else:
+        raise ValueError("Unknown audio backend %r" % name)
 
 class PulseChannel(object):
 
@@ -254,7 +473,7 @@ class PulseChannel(object):
         # TODO ensure these defaults are right
         self.envelopeDivider = 0
         self.constantEnvelope = True
-        self.lengthCounterHalt = True
+        self.lengthCounterHalt = False
         self.duty = 0
         self.timer = 0
         self.lengthCounter = 0
@@ -271,7 +490,11 @@ class PulseChannel(object):
         if not enabled:
             self.lengthCounter = 0
             # TODO ensure that the channel is immediately silenced
-        self.apu.capu.setPulseEnabled(self.channelID, enabled)
+
+    def clockLengthCounter(self, n):
+        "Count down for n half frame clocks, unless halted"
+        if not self.lengthCounterHalt:
+            self.lengthCounter = max(0, self.lengthCounter - n)
 
     def getPeriod(self):
         return ((self.timer + 2) * CPU_CYCLES_PER_WAVEFORM_CYCLE
@@ -284,10 +507,6 @@ class PulseChannel(object):
             self.constantEnvelope = bool(val & PULSE_CONSTANT_ENVELOPE_MASK)
             self.lengthCounterHalt = bool(val & PULSE_LENGTH_HALT_MASK)
             self.duty = (val & PULSE_DUTY_MASK) >> PULSE_DUTY_OFFSET
-            dutyFloat = PULSE_DUTY_TABLE[self.duty]
-            self.apu.capu.setPulseDuty(self.channelID, dutyFloat)
-            self.updateDuration()
-            self.updateEnvelope()
             if APU_INFO:
                 print >> sys.stderr, \
                     "Frame %d: APU pulse %d: divider %d, constant envelope %d, length counter halt %d, duty %d" % \
@@ -299,9 +518,6 @@ class PulseChannel(object):
             self.sweepNegate = bool(val & PULSE_SWEEP_NEGATE_MASK)
             self.sweepPeriod = 1 + ((val & PULSE_SWEEP_PERIOD_MASK) >> PULSE_SWEEP_PERIOD_OFFSET)
             self.sweepEnable = bool(val & PULSE_SWEEP_ENABLE_MASK)
-            self.apu.capu.updatePulseSweep(self.channelID, self.sweepEnable,
-                                           self.sweepPeriod, self.sweepShift,
-                                           int(self.sweepNegate))
             if APU_INFO:
                 if self.sweepEnable:
                     print >> sys.stderr, \
@@ -314,7 +530,6 @@ class PulseChannel(object):
                     % (self.apu.cpu.ppu.frame, self.channelID)
         elif register == 2: # Timer low (note: does not reset phase or envelope)
             self.timer = (self.timer & PULSE_TIMER_HIGH_VALUE_MASK) + val
-            self.apu.capu.setPulseDivider(self.channelID, self.timer)
             if APU_INFO:
                 if self.timer < 8:
                     freq_string = "silent"
@@ -328,14 +543,9 @@ class PulseChannel(object):
         elif register == 3: # Length counter load, timer high
             self.timer = (self.timer & PULSE_TIMER_LOW_VALUE_MASK) + \
                          ((val & PULSE_TIMER_HIGH_INPUT_MASK) << PULSE_TIMER_HIGH_VALUE_OFFSET)
-            self.apu.capu.setPulseDivider(self.channelID, self.timer)
             if self.enabled:
                 lengthCounterIndex = (val & PULSE_LC_LOAD_MASK) >> PULSE_LC_LOAD_OFFSET
                 self.lengthCounter = PULSE_LC_TABLE[lengthCounterIndex]
-                self.updateDuration()
-                # As a side effect, this restarts the envelope and
-                # resets the phase.
-                self.apu.capu.resetPulse(self.channelID)
             if APU_INFO:
                 if self.timer < 8:
                     freq_string = "silent"
@@ -357,17 +567,6 @@ class PulseChannel(object):
         else:
             raise RuntimeError("Unrecognized pulse channel register")
 
-    def updateDuration(self):
-        self.apu.capu.setPulseLengthCounterHalt(self.channelID, int(self.lengthCounterHalt))
-        self.apu.capu.setPulseLengthCounter(self.channelID, self.lengthCounter)
-
-    def updateEnvelope(self):
-        # Note: the envelope loop flag is the same as the length counter halt flag.
-        self.apu.capu.updatePulseEnvelope(self.channelID,
-                                          int(self.lengthCounterHalt),
-                                          int(self.constantEnvelope),
-                                          self.envelopeDivider)
-
 class TriangleChannel(object):
 
     def __init__(self, apu):
@@ -380,15 +579,19 @@ class TriangleChannel(object):
 
     def setEnabled(self, enabled):
         self.enabled = enabled and ENABLE_TRIANGLE
-        self.apu.capu.setTriangleEnabled(enabled)
+        if not enabled:
+            self.lengthCounter = 0
+
+    def clockLengthCounter(self, n):
+        "Count down for n half frame clocks, unless halted"
+        if not self.countersHalt:
+            self.lengthCounter = max(0, self.lengthCounter - n)
 
     def write(self, register, val):
         # register should be between 0 and 3 inclusive, and val should be an integer
         if register == 0:
             self.linearCounterInit = val & TRIANGLE_LINEAR_COUNTER_MASK
             self.countersHalt = bool(val & TRIANGLE_COUNTER_HALT_MASK)
-            self.apu.capu.setTriangleLinearCounterInit(self.linearCounterInit)
-            self.apu.capu.setTriangleTimerHalts(int(self.countersHalt))
             if APU_INFO:
                 print >> sys.stderr, \
                     "Frame %d: APU triangle: linear counter load %d, counters halted %d" % \
@@ -401,7 +604,6 @@ class TriangleChannel(object):
                     % self.apu.cpu.ppu.frame
         elif register == 2:
             self.timer = (self.timer & TRIANGLE_TIMER_HIGH_VALUE_MASK) + val
-            self.apu.capu.setTriangleDivider(self.timer)
             if APU_INFO:
                 if self.timer < 2:
                     freq_string = "silent"
@@ -414,13 +616,9 @@ class TriangleChannel(object):
         elif register == 3:
             self.timer = (self.timer & TRIANGLE_TIMER_LOW_VALUE_MASK) + \
                          ((val & TRIANGLE_TIMER_HIGH_INPUT_MASK) << TRIANGLE_TIMER_HIGH_VALUE_OFFSET)
-            self.apu.capu.setTriangleDivider(self.timer)
             if self.enabled:
                 lengthCounterIndex = (val & TRIANGLE_LC_LOAD_MASK) >> TRIANGLE_LC_LOAD_OFFSET
                 self.lengthCounter = TRIANGLE_LC_TABLE[lengthCounterIndex]
-                self.apu.capu.setTriangleLengthCounter(self.lengthCounter)
-                # As a side effect, this reloads the linear counter.
-                self.apu.capu.triangleLinearCounterReload()
             if APU_INFO:
                 if self.timer < 2:
                     freq_string = "silent"
@@ -436,52 +634,284 @@ class TriangleChannel(object):
         else:
             raise RuntimeError("Unrecognized triangle channel register")
 
-class DummyCAPU(object):
-    """A dummy object: represents every method a CAPU object could have,
-    but none of them do anything.
+class NoiseChannel(object):
 
-    """
+    def __init__(self, apu):
+        self.apu = apu
+        self.enabled = False
+        self.envelopeDivider = 0
+        self.constantEnvelope = True
+        self.lengthCounterHalt = False
+        self.shortMode = False
+        self.period = NOISE_PERIOD_TABLE[0]
+        self.lengthCounter = 0
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled and ENABLE_NOISE
+        if not enabled:
+            self.lengthCounter = 0
+
+    def clockLengthCounter(self, n):
+        "Count down for n half frame clocks, unless halted"
+        if not self.lengthCounterHalt:
+            self.lengthCounter = max(0, self.lengthCounter - n)
+
+    def write(self, register, val):
+        # register should be between 0 and 3 inclusive, and val should be an integer
+        if register == 0: # Length counter halt, envelope settings
+            self.envelopeDivider = val & NOISE_ENVELOPE_DIVIDER_MASK
+            self.constantEnvelope = bool(val & NOISE_CONSTANT_ENVELOPE_MASK)
+            self.lengthCounterHalt = bool(val & NOISE_LENGTH_HALT_MASK)
+            if APU_INFO:
+                print >> sys.stderr, \
+                    "Frame %d: APU noise: divider %d, constant envelope %d, length counter halt %d" % \
+                    (self.apu.cpu.ppu.frame,
+                     self.envelopeDivider, self.constantEnvelope, self.lengthCounterHalt)
+        elif register == 1: # Does nothing
+            if APU_INFO:
+                print >> sys.stderr, \
+                    "Frame %d: Ignoring write to unused noise channel register" \
+                    % self.apu.cpu.ppu.frame
+        elif register == 2: # Mode, period
+            self.shortMode = bool(val & NOISE_MODE_MASK)
+            self.period = NOISE_PERIOD_TABLE[val & NOISE_PERIOD_MASK]
+            if APU_INFO:
+                print >> sys.stderr, \
+                    "Frame %d: APU noise period %d cycles (%f Hz), short mode %d" \
+                    % (self.apu.cpu.ppu.frame, self.period,
+                       CPU_FREQUENCY / self.period, self.shortMode)
+        elif register == 3: # Length counter load
+            if self.enabled:
+                lengthCounterIndex = (val & NOISE_LC_LOAD_MASK) >> NOISE_LC_LOAD_OFFSET
+                self.lengthCounter = NOISE_LC_TABLE[lengthCounterIndex]
+            if APU_INFO:
+                duration = self.lengthCounter * self.apu.frameDuration() / 2.0
+                print >> sys.stderr, \
+                    "Frame %d: APU noise length counter %d (%fs)" \
+                    % (self.apu.cpu.ppu.frame, self.lengthCounter, duration)
+        else:
+            raise RuntimeError("Unrecognized noise channel register")
+
+class DMCChannel(object):
+    """libapu plays the DMC's samples. This keeps track of when the DMC
+    reads each byte of them, which stalls the CPU, and of when a sample
+    ends, which raises an IRQ or starts it over.
 
-    # Just let any attribute of this object be successfully looked up,
-    # but always return a no-op function
-    def __getattr__(self, name):
-        def nop(*args):
+    Once a sample starts, the reads come at fixed intervals, so rather
+    than stepping through them, catchUp works out how far the sample's
+    gotten whenever it's called. The APU calls it at its own actions,
+    including the end of every sample (see nextEventCycle), and before
+    any register write: so the stalls are charged a batch at a time, and
+    the IRQ is on time."""
+
+    def __init__(self, apu):
+        self.apu = apu
+        self.irqEnabled = False
+        self.loop = False
+        self.period = DMC_RATE_TABLE[0]
+        self.sampleAddress = DMC_ADDRESS_BASE
+        self.sampleLength = 1
+        self.irqFlag = False
+        # The sample playing: the cycle it started on, how long it is,
+        # and how many bytes of it have been read
+        self.playing = False
+        self.startCycle = 0
+        self.length = 0
+        self.bytesRead = 0
+        # When a looping sample's ended, the cycle it starts over on
+        self.restartCycle = None
+
+    def bytePeriod(self):
+        return self.period * DMC_BITS_PER_BYTE
+
+    def bytesRemaining(self):
+        if self.restartCycle is not None:
+            return self.sampleLength
+        if not self.playing:
+            return 0
+        return self.length - self.bytesRead
+
+    def nextEventCycle(self):
+        """The cycle the APU has to call catchUp on next: when the
+        sample's last byte is read, or when a looping sample starts
+        over. None if there's no sample playing."""
+        if self.restartCycle is not None:
+            return self.restartCycle
+        if self.playing:
+            return self.startCycle + (self.length - 1) * self.bytePeriod()
+        return None
+
+    def catchUp(self, cycle):
+        "Read everything the DMC would have by the given cycle"
+        while True:
+            event = self.nextEventCycle()
+            if event is None or event > cycle:
+                break
+            if self.restartCycle is not None:
+                self.start(self.restartCycle)
+                continue
+            self.readBytes(self.length)
+            self.playing = False
+            if self.loop:
+                self.restartCycle = event + self.bytePeriod()
+            elif self.irqEnabled:
+                self.irqFlag = True
+                self.apu.cpu.irqPending = True
+        if self.playing:
+            self.readBytes((cycle - self.startCycle) // self.bytePeriod() + 1)
+
+    def readBytes(self, n):
+        "Read up to the nth byte of the sample, stalling the CPU for each"
+        if n > self.bytesRead:
+            self.apu.cpu.instructionCycleExtra += \
+                DMC_STALL_CYCLES * (n - self.bytesRead)
+            self.bytesRead = n
+
+    def start(self, cycle):
+        self.restartCycle = None
+        self.playing = True
+        self.startCycle = cycle
+        self.length = self.sampleLength
+        self.bytesRead = 0
+        # libapu decodes the sample from PRG ROM, so it has to know
+        # where the address is mapped now
+        self.apu.backend.write(cycle, APU_DMC_START,
+                               self.apu.cpu.mem.prgOffset(self.sampleAddress))
+        # The first byte's read right away
+        self.readBytes(1)
+
+    def acknowledgeIRQ(self):
+        self.irqFlag = False
+        self.apu.releaseIRQ()
+
+    def setEnabled(self, enabled, cycle):
+        self.acknowledgeIRQ()
+        if not (enabled and ENABLE_DMC):
+            self.playing = False
+            self.restartCycle = None
+        elif not self.bytesRemaining():
+            self.start(cycle)
+
+    def write(self, register, val, cycle):
+        # register should be between 0 and 3 inclusive, and val should be an integer
+        if register == 0: # IRQ enable, loop, rate
+            self.irqEnabled = bool(val & DMC_IRQ_ENABLE_MASK)
+            self.loop = bool(val & DMC_LOOP_MASK)
+            if not self.irqEnabled:
+                self.acknowledgeIRQ()
+            period = DMC_RATE_TABLE[val & DMC_RATE_MASK]
+            if self.playing and period != self.period:
+                # Keep the next read a byte's time from now, at the new
+                # rate
+                self.startCycle = cycle - (self.bytesRead - 1) * period * DMC_BITS_PER_BYTE
+            self.period = period
+            if APU_INFO:
+                print >> sys.stderr, \
+                    "Frame %d: APU DMC: IRQ enabled %d, loop %d, %d cycles per bit" % \
+                    (self.apu.cpu.ppu.frame, self.irqEnabled, self.loop, self.period)
+        elif register == 1: # Direct load: only matters to libapu
             pass
-        return nop
+        elif register == 2:
+            self.sampleAddress = DMC_ADDRESS_BASE + val * DMC_ADDRESS_UNIT
+        elif register == 3:
+            self.sampleLength = val * DMC_LENGTH_UNIT + 1
+            if APU_INFO:
+                print >> sys.stderr, \
+                    "Frame %d: APU DMC sample at 0x%04x, %d bytes" % \
+                    (self.apu.cpu.ppu.frame, self.sampleAddress, self.sampleLength)
+        else:
+            raise RuntimeError("Unrecognized DMC register")
 
 class APU(object):
 
-    def __init__(self, cpu):
+    def __init__(self, cpu, pacer = None):
         self.cpu = cpu
         self.pulse1 = PulseChannel(self, 0)
         self.pulse2 = PulseChannel(self, 1)
         self.triangle = TriangleChannel(self)
-        self.noiseEnabled = False
-        self.dmcEnabled = False
+        self.noise = NoiseChannel(self)
+        self.dmc = DMCChannel(self)
+        # libapu clocks the frame counter itself, from the $4017 writes.
+        # Here, the length counters (for $4015 reads) are caught up with
+        # it whenever they're needed, and the frame IRQ is scheduled. At
+        # power on, it's as if $4017 was written with 0.
         self.fcMode = 0
         self.fcIRQInhibit = False
-        self.fcSequenceIndex = 0
-        # set up the cpu's ppuCyclesUntilAction
-        self.fcSleep()
-
-        if cpu.audioEnabled:
-            self.capu = CAPU()
+        self.fcIRQFlag = False
+        # The cycle the next frame IRQ comes on, or None if it won't
+        self.fcIRQCycle = APU_FC_IRQ_CYCLE
+        # The cycle of the last $4017 write, and how many half frame
+        # clocks since then the length counters have had
+        self.fcStartCycle = 0
+        self.halfFramesClocked = 0
+        # set up the cpu's apuCyclesUntilAction
+        self.scheduleAction()
+
+        if cpu.audioBackend is not None:
+            self.backend = cpu.audioBackend
+        elif cpu.audioEnabled:
+            self.backend = PortAudioBackend()
         else:
-            self.capu = DummyCAPU()
+            self.backend = NullBackend()
+        self.backend.loadPrgRom(cpu.prgrom)
+
+        # Live audio has its own clock, which the pacer can follow
+        if pacer is not None and self.backend.isLive():
+            pacer.setAudioClock(self)
+
+    def audioStats(self):
+        "libapu's AudioStats as of now, if audio is live; otherwise None"
+        if not self.backend.isLive():
+            return None
+        return self.backend.stats(self.currentCycle())
+
+    def audioSurplus(self):
+        """How many seconds more than the target latency playback is
+        behind the emulator (negative if it's less), if audio is live;
+        otherwise None."""
+        stats = self.audioStats()
+        if stats is None:
+            return None
+        return stats.latency - self.targetLatency()
+
+    def targetLatency(self):
+        return self.backend.settings.targetLatency
+
+    def sync(self):
+        """Let the backend play everything up to now. The pacer calls
+        this every frame, in case the game hasn't written anything."""
+        self.backend.sync(self.currentCycle())
+
+    def close(self):
+        "Stop audio, finishing any recording"
+        self.backend.close(self.currentCycle())
+
+    def currentCycle(self):
+        "The CPU cycle that's running now, counting from power on"
+        return self.cpu.cycles + self.cpu.excessCycles
 
     def write(self, address, val):
+        # libapu decodes the write itself; the channels here keep track
+        # of their registers for the APU_INFO messages, and of what
+        # $4015 reads back, so they have to be caught up first
+        cycle = self.currentCycle()
+        self.catchUp(cycle)
+        queued = ord(val)
+        if address == APU_STATUS:
+            if not ENABLE_DMC:
+                queued &= ~DMC_STATUS_MASK
+            if not ENABLE_PULSE:
+                queued &= ~(PULSE_1_STATUS_MASK | PULSE_2_STATUS_MASK)
+            if not ENABLE_TRIANGLE:
+                queued &= ~TRIANGLE_STATUS_MASK
+            if not ENABLE_NOISE:
+                queued &= ~NOISE_STATUS_MASK
+        self.backend.write(cycle, address, queued)
+
         if address == APU_STATUS:
             self.setStatus(ord(val))
         elif address == APU_FRAME_COUNTER:
-            self.fcMode = (ord(val) & FRAME_COUNTER_MODE_MASK) >> FRAME_COUNTER_MODE_OFFSET
-            self.fcIRQInhibit = not bool(ord(val) & FRAME_COUNTER_IRQ_INHIBIT_MASK)
-            self.capu.updateFrameCounter(self.fcMode)
-            # TODO: currently fcIRQInhibit doesn't actually do
-            # anything. Fix that.
-            if APU_FRAME_COUNTER_WARN:
-                print >> sys.stderr, \
-                    "Frame %d: ignoring APU frame counter write: 0b%s" % \
-                    (self.cpu.ppu.frame, "{0:08b}".format(ord(val)))
+            self.writeFrameCounter(ord(val), cycle)
         elif PULSE_1_BASE <= address < (PULSE_1_BASE + CHANNEL_ADDRESS_RANGE):
             self.pulse1.write(address - PULSE_1_BASE, ord(val))
         elif PULSE_2_BASE <= address < (PULSE_2_BASE + CHANNEL_ADDRESS_RANGE):
@@ -489,15 +919,10 @@ class APU(object):
         elif TRIANGLE_BASE <= address < (TRIANGLE_BASE + CHANNEL_ADDRESS_RANGE):
             self.triangle.write(address - TRIANGLE_BASE, ord(val))
         elif NOISE_BASE <= address < (NOISE_BASE + CHANNEL_ADDRESS_RANGE):
-            if APU_WARN:
-                print >> sys.stderr, \
-                    "Frame %d: ignoring write to APU noise register 0x%04x: %02x" % \
-                    (self.cpu.ppu.frame, address, ord(val))
+            self.noise.write(address - NOISE_BASE, ord(val))
         elif DMC_BASE <= address < (DMC_BASE + CHANNEL_ADDRESS_RANGE):
-            if APU_WARN:
-                print >> sys.stderr, \
-                    "Frame %d: ignoring write to APU noise register 0x%04x: %02x" % \
-                    (self.cpu.ppu.frame, address, ord(val))
+            self.dmc.write(address - DMC_BASE, ord(val), cycle)
+            self.scheduleAction()
         else:
             raise RuntimeError(
                 "Frame %d: write to invalid APU register 0x%04x: %02x" %
@@ -509,10 +934,12 @@ class APU(object):
         # - Clears the DMC interrupt flag
         # - Does whatever DMC logic it needs to do depending on the DMC bit
         self.pulse1.setEnabled(bool(statusByte & PULSE_1_STATUS_MASK))
-        self.pulse2.setEnabled(bool(statusByte & PULSE_1_STATUS_MASK))
+        self.pulse2.setEnabled(bool(statusByte & PULSE_2_STATUS_MASK))
         self.triangle.setEnabled(bool(statusByte & TRIANGLE_STATUS_MASK))
-        self.noiseEnabled = bool(statusByte & NOISE_STATUS_MASK)
-        self.dmcEnabled = bool(statusByte & DMC_STATUS_MASK)
+        self.noise.setEnabled(bool(statusByte & NOISE_STATUS_MASK))
+        self.dmc.setEnabled(bool(statusByte & DMC_STATUS_MASK),
+                            self.currentCycle())
+        self.scheduleAction()
         if APU_INFO:
             channels = []
             if self.pulse1.enabled:
@@ -521,9 +948,9 @@ class APU(object):
                 channels += ["pulse wave 2"]
             if self.triangle.enabled:
                 channels += ["triangle wave"]
-            if self.noiseEnabled:
+            if self.noise.enabled:
                 channels += ["noise"]
-            if self.dmcEnabled:
+            if self.dmc.bytesRemaining():
                 channels += ["DMC"]
             if channels:
                 print >> sys.stderr, "Frame %d: APU channels enabled: %s" % \
@@ -538,42 +965,131 @@ class APU(object):
         else:
             return APU_CYCLES_PER_5STEP_FRAME / APU_FREQUENCY
 
-    def fcSequence(self):
-        if not self.fcMode:
-            return APU_4STEP_SEQUENCE
+    def writeFrameCounter(self, val, cycle):
+        """A write to $4017 restarts the frame counter's sequence (which
+        libapu does too, from the same write), so the frame IRQ comes a
+        whole 4-step frame later, unless it's inhibited."""
+        self.fcMode = (val & FRAME_COUNTER_MODE_MASK) >> FRAME_COUNTER_MODE_OFFSET
+        self.fcIRQInhibit = bool(val & FRAME_COUNTER_IRQ_INHIBIT_MASK)
+        self.fcStartCycle = cycle
+        self.halfFramesClocked = 0
+        if self.fcMode:
+            # Starting the 5-step sequence clocks everything right away
+            self.clockLengthCounters(1)
+        if self.fcIRQInhibit:
+            self.acknowledgeFrameIRQ()
+        if self.fcMode or self.fcIRQInhibit:
+            self.fcIRQCycle = None
         else:
-            return APU_5STEP_SEQUENCE
-
-    def frameCounterTick(self):
-        sequence = self.fcSequence()
-        (cycle, frameType) = sequence[self.fcSequenceIndex]
-        if frameType < APU_FC_HALF_FRAME:
-            self.capu.frameCounterQuarterFrame()
+            self.fcIRQCycle = cycle + APU_FC_IRQ_CYCLE
+        self.scheduleAction()
+        if APU_FRAME_COUNTER_WARN:
+            print >> sys.stderr, \
+                "Frame %d: APU frame counter: %d-step, IRQ %s" % \
+                (self.cpu.ppu.frame, 5 if self.fcMode else 4,
+                 "inhibited" if self.fcIRQInhibit else "enabled")
+
+    def readStatus(self):
+        """What a read from $4015 gets: which channels' length counters
+        are still going, whether the DMC has bytes left to play, and the
+        IRQ flags. Reading it acknowledges the frame IRQ."""
+        self.catchUp(self.currentCycle())
+        status = 0
+        if self.pulse1.lengthCounter:
+            status |= PULSE_1_STATUS_MASK
+        if self.pulse2.lengthCounter:
+            status |= PULSE_2_STATUS_MASK
+        if self.triangle.lengthCounter:
+            status |= TRIANGLE_STATUS_MASK
+        if self.noise.lengthCounter:
+            status |= NOISE_STATUS_MASK
+        if self.dmc.bytesRemaining():
+            status |= DMC_STATUS_MASK
+        if self.fcIRQFlag:
+            status |= FRAME_IRQ_STATUS_MASK
+        if self.dmc.irqFlag:
+            status |= DMC_IRQ_STATUS_MASK
+        self.acknowledgeFrameIRQ()
+        # catchUp may have moved the frame IRQ on
+        self.scheduleAction()
+        return chr(status)
+
+    def acknowledgeFrameIRQ(self):
+        self.fcIRQFlag = False
+        self.releaseIRQ()
+
+    def releaseIRQ(self):
+        """Called when an IRQ flag's been cleared. The IRQ line stays low
+        as long as either the frame counter's or the DMC's flag is set:
+        if neither is, and the CPU hasn't gotten to the interrupt yet,
+        it won't."""
+        if not (self.fcIRQFlag or self.dmc.irqFlag):
+            self.cpu.irqPending = False
+
+    def fcHalfFrames(self):
+        "The current sequence's half frame clocks, and its length"
+        if not self.fcMode:
+            return (APU_4STEP_HALF_FRAMES,
+                    APU_CYCLES_PER_4STEP_FRAME * APU_CPU_CYCLES_PER_FC_CYCLE)
         else:
-            # note: sending half frame also has effects of quarter frame
-            self.capu.frameCounterHalfFrame()
-        if (frameType == APU_FC_INTERRUPT) and not self.fcIRQInhibit:
-            # send interrupt
+            return (APU_5STEP_HALF_FRAMES,
+                    APU_CYCLES_PER_5STEP_FRAME * APU_CPU_CYCLES_PER_FC_CYCLE)
+
+    def halfFramesBefore(self, cycle):
+        """How many half frame clocks there have been since the last
+        $4017 write, before the given cycle. (libapu applies a write
+        on the same cycle as a clock before the clock.)"""
+        (halfFrames, frameLength) = self.fcHalfFrames()
+        elapsed = cycle - self.fcStartCycle
+        n = 0
+        for clock in halfFrames:
+            if elapsed > clock:
+                n += 1 + (elapsed - clock - 1) // frameLength
+        return n
+
+    def clockLengthCounters(self, n):
+        self.pulse1.clockLengthCounter(n)
+        self.pulse2.clockLengthCounter(n)
+        self.triangle.clockLengthCounter(n)
+        self.noise.clockLengthCounter(n)
+
+    def catchUp(self, cycle):
+        """Bring what's kept here up to the given cycle: the DMC, the
+        frame IRQ, and the length counters. The length counters' halt
+        flags only change with a write, which catches up first, so the
+        half frame clocks since the last catchUp can all be applied at
+        once."""
+        self.dmc.catchUp(cycle)
+        if self.fcIRQCycle is not None and cycle >= self.fcIRQCycle:
+            self.fcIRQFlag = True
             self.cpu.irqPending = True
-        self.fcSequenceIndex = (self.fcSequenceIndex + 1) % len(sequence)
-        self.fcSleep()
-
-
-    # Determine the number of CPU cycles it will take until the frame
-    # counter next acts, and tell the CPU what that number is.
-    def fcSleep(self):
-        sequence = self.fcSequence()
-        if self.fcSequenceIndex > 0:
-            c = (sequence[self.fcSequenceIndex][0] -
-                 sequence[self.fcSequenceIndex-1][0])
-        else:
-            if not self.fcMode:
-                frameLen = (APU_CYCLES_PER_4STEP_FRAME *
-                            APU_CPU_CYCLES_PER_FC_CYCLE)
-            else:
-                frameLen = (APU_CYCLES_PER_5STEP_FRAME *
-                            APU_CPU_CYCLES_PER_FC_CYCLE)
-            c = (sequence[self.fcSequenceIndex][0] -
-                 sequence[self.fcSequenceIndex-1][0] +
-                 frameLen)
-        self.cpu.apuCyclesUntilAction = c
+            # On to the first one after cycle
+            self.fcIRQCycle += APU_FC_IRQ_PERIOD * \
+                ((cycle - self.fcIRQCycle) // APU_FC_IRQ_PERIOD + 1)
+        n = self.halfFramesBefore(cycle) - self.halfFramesClocked
+        # (tick can be for an earlier cycle than a write that's already
+        # caught up)
+        if n > 0:
+            self.clockLengthCounters(n)
+            self.halfFramesClocked += n
+
+    def tick(self):
+        """The CPU calls this once it's past the cycle from
+        scheduleAction, with the cycles it's past it by still stored
+        up."""
+        self.catchUp(self.cpu.cycles - self.cpu.apuStoredCycles)
+        self.scheduleAction()
+
+    def scheduleAction(self):
+        """Tell the CPU how long until tick has something to do: the
+        next frame IRQ, or the next DMC event, whichever's sooner. If
+        there's neither, the CPU won't call tick at all."""
+        nextAction = APU_NO_ACTION
+        if self.fcIRQCycle is not None:
+            nextAction = self.fcIRQCycle
+        dmcEvent = self.dmc.nextEventCycle()
+        if dmcEvent is not None and dmcEvent < nextAction:
+            nextAction = dmcEvent
+        # The CPU counts apuStoredCycles from the last action
+        self.cpu.apuCyclesUntilAction = nextAction - \
+            (self.cpu.cycles - self.cpu.apuStoredCycles)
@@ -0,0 +1,222 @@
+# Checks the APU's timing against known register writes: when the DMC
+# reads sample bytes (stalling the CPU) and raises its IRQ, and what
+# $4015 reads back as the frame counter runs. Drives the APU the way
+# CPU.tick does, but without running any instructions, so every cycle
+# is known. The last check renders sound, so it needs libapu.
+
+import apu
+import cpu
+import rom
+
+ROMFILE = 'nestest.nes'
+
+def makeCPU(**kwargs):
+    c = cpu.CPU(rom=rom.readRom(ROMFILE), renderer='software', **kwargs)
+    c.excessCycles = 0
+    return c
+
+class Harness(object):
+    def __init__(self, c):
+        self.c = c
+        # Stall cycles the DMC has charged the CPU, and the cycle the
+        # IRQ line first went up on (if it has)
+        self.stalls = 0
+        self.irqCycle = None
+
+    def runTo(self, cycle):
+        """The APU side of CPU.tick, up to the given cycle, stopping at
+        each of the APU's actions; then catch the APU up, as any access
+        to it would. The stalls are counted, not run."""
+        c = self.c
+        while c.cycles < cycle:
+            step = cycle - c.cycles
+            untilAction = c.apuCyclesUntilAction - c.apuStoredCycles
+            if untilAction < step:
+                step = untilAction
+            c.cycles += step
+            c.apuStoredCycles += step
+            if c.apuStoredCycles >= c.apuCyclesUntilAction:
+                c.apuStoredCycles -= c.apuCyclesUntilAction
+                c.apu.tick()
+            self.collect()
+        c.apu.catchUp(c.cycles)
+        self.collect()
+
+    def collect(self):
+        c = self.c
+        self.stalls += c.instructionCycleExtra
+        c.instructionCycleExtra = 0
+        if c.irqPending and self.irqCycle is None:
+            self.irqCycle = c.cycles
+
+    def write(self, address, val):
+        self.c.mem.write(address, val)
+        self.collect()
+
+# DMC rate 15: 54 cycles per bit, so 432 per byte
+BYTE_PERIOD = apu.DMC_RATE_TABLE[15] * apu.DMC_BITS_PER_BYTE
+STALL = apu.DMC_STALL_CYCLES
+
+def startSample(h, flags, start):
+    "A 17-byte sample at $C000, started on the given cycle"
+    # Keep the frame IRQ out of it
+    h.write(0x4017, apu.FRAME_COUNTER_IRQ_INHIBIT_MASK)
+    h.write(0x4010, flags | 15)
+    h.write(0x4012, 0x00)
+    h.write(0x4013, 0x01)
+    h.runTo(start)
+    h.write(0x4015, 0x10)
+
+# A sample with the IRQ on: the first byte's read as it starts, the last
+# 16 byte periods later, and the IRQ comes with the last byte
+h = Harness(makeCPU(audioEnabled = False))
+start = 1000
+startSample(h, apu.DMC_IRQ_ENABLE_MASK, start)
+assert h.stalls == STALL
+h.runTo(start + 5 * BYTE_PERIOD)
+assert h.stalls == 6 * STALL
+assert h.c.apu.dmc.bytesRemaining() == 11
+h.runTo(start + 16 * BYTE_PERIOD - 1)
+assert h.irqCycle is None
+h.runTo(start + 20 * BYTE_PERIOD)
+assert h.irqCycle == start + 16 * BYTE_PERIOD, h.irqCycle
+assert h.stalls == 17 * STALL
+assert h.c.apu.dmc.irqFlag
+assert not h.c.apu.dmc.bytesRemaining()
+assert h.c.irqPending
+# Writing $4015 acknowledges the DMC's IRQ, and so does turning it off
+# in $4010
+h.write(0x4015, 0x00)
+assert not h.c.apu.dmc.irqFlag
+assert not h.c.irqPending
+h = Harness(makeCPU(audioEnabled = False))
+startSample(h, apu.DMC_IRQ_ENABLE_MASK, start)
+h.runTo(start + 20 * BYTE_PERIOD)
+assert h.c.irqPending
+h.write(0x4010, 15)
+assert not h.c.apu.dmc.irqFlag
+assert not h.c.irqPending
+
+# A looping sample starts over a byte period after its last byte, so
+# the reads keep coming at the same rate, with no IRQ
+h = Harness(makeCPU(audioEnabled = False))
+startSample(h, apu.DMC_LOOP_MASK | apu.DMC_IRQ_ENABLE_MASK, start)
+for n in [17, 18, 40, 100]:
+    h.runTo(start + (n - 1) * BYTE_PERIOD)
+    assert h.stalls == n * STALL, (n, h.stalls)
+assert h.irqCycle is None
+# Disabling the DMC stops the reads
+h.write(0x4015, 0x00)
+h.runTo(start + 200 * BYTE_PERIOD)
+assert h.stalls == 100 * STALL
+assert h.c.apuCyclesUntilAction == apu.APU_NO_ACTION
+
+# Changing the rate mid-sample puts the next read a byte period (at the
+# new rate) after the write
+h = Harness(makeCPU(audioEnabled = False))
+startSample(h, 0, start)
+h.runTo(start + 2 * BYTE_PERIOD) # third byte read
+slowPeriod = apu.DMC_RATE_TABLE[0] * apu.DMC_BITS_PER_BYTE
+h.runTo(start + 2 * BYTE_PERIOD + 100)
+h.write(0x4010, 0)
+h.runTo(start + 2 * BYTE_PERIOD + 100 + slowPeriod - 1)
+assert h.stalls == 3 * STALL
+h.runTo(start + 2 * BYTE_PERIOD + 100 + slowPeriod)
+assert h.stalls == 4 * STALL
+
+# $4015: the length counters count down on half frame clocks, which
+# start over from each $4017 write
+def status(h):
+    return ord(h.c.mem.read(apu.APU_STATUS))
+
+def lengths(h):
+    "Just the length counter bits: the frame IRQ comes every 2 clocks"
+    return status(h) & 0x0f
+
+def halfFrame(t0, k):
+    "The cycle of the kth half frame clock after a 4-step $4017 write at t0"
+    return (t0 + (k - 1) // 2 * apu.APU_FC_IRQ_PERIOD +
+            apu.APU_4STEP_HALF_FRAMES[(k - 1) % 2])
+
+h = Harness(makeCPU(audioEnabled = False))
+t0 = 500
+h.runTo(t0)
+h.write(0x4017, 0x00)
+h.write(0x4015, 0x0f)
+h.write(0x4003, 0x00) # pulse 1: length 10
+h.write(0x4008, 0x00)
+h.write(0x400b, 0x18) # triangle: length 2
+h.write(0x400c, apu.NOISE_LENGTH_HALT_MASK)
+h.write(0x400f, 0x00) # noise: length 10, halted
+assert status(h) == 0x0d
+# A clock only counts from the cycle after it
+h.runTo(halfFrame(t0, 2))
+assert h.irqCycle == t0 + apu.APU_FC_IRQ_CYCLE
+assert status(h) == 0x0d | apu.FRAME_IRQ_STATUS_MASK
+# Reading $4015 acknowledges the frame IRQ
+assert status(h) == 0x0d
+assert not h.c.irqPending
+h.runTo(halfFrame(t0, 2) + 1)
+assert status(h) == 0x09
+h.runTo(halfFrame(t0, 10))
+assert status(h) & apu.PULSE_1_STATUS_MASK
+h.runTo(halfFrame(t0, 10) + 1)
+assert lengths(h) == 0x08
+# Unhalted, the noise counts down from where it was
+h.write(0x400c, 0x00)
+h.runTo(halfFrame(t0, 20))
+assert lengths(h) == 0x08
+h.runTo(halfFrame(t0, 20) + 1)
+assert lengths(h) == 0x00
+# A write on a clock's cycle goes first
+h.runTo(halfFrame(t0, 22))
+h.write(0x4003, 0x00)
+h.runTo(halfFrame(t0, 22) + 1)
+assert h.c.apu.pulse1.lengthCounter == 9
+# Disabling a channel clears its length counter right away
+h.write(0x400b, 0x08)
+assert status(h) & apu.TRIANGLE_STATUS_MASK
+h.write(0x4015, 0x0b)
+assert not status(h) & apu.TRIANGLE_STATUS_MASK
+# Starting the 5-step sequence clocks the length counters, and there's
+# no frame IRQ, so the CPU has nothing to call the APU for
+h.write(0x4017, apu.FRAME_COUNTER_MODE_MASK)
+assert h.c.apu.pulse1.lengthCounter == 8
+assert h.c.apuCyclesUntilAction == apu.APU_NO_ACTION
+# Inhibiting the frame IRQ clears its flag
+h = Harness(makeCPU(audioEnabled = False))
+h.runTo(apu.APU_FC_IRQ_CYCLE)
+assert h.irqCycle == apu.APU_FC_IRQ_CYCLE
+h.write(0x4017, apu.FRAME_COUNTER_IRQ_INHIBIT_MASK)
+assert not h.c.irqPending
+assert status(h) == 0x00
+assert h.c.apuCyclesUntilAction == apu.APU_NO_ACTION
+
+# Write-only registers read back 0, and are only counted
+for i in range(3):
+    assert h.c.mem.read(0x4009) == '\x00'
+assert h.c.mem.unsupportedReads[0x4009] == 3
+
+# libapu's pulse goes quiet when $4015 says its length counter ran out
+backend = apu.MemoryBackend()
+h = Harness(makeCPU(audioBackend = backend))
+h.runTo(t0)
+h.write(0x4017, 0x00)
+h.write(0x4015, 0x01)
+h.write(0x4000, 0x9f) # constant volume 15, not halted
+h.write(0x4002, 0xfd)
+h.write(0x4003, 0x00) # length 10
+end = halfFrame(t0, 10)
+h.runTo(end + 1)
+assert lengths(h) == 0x00
+h.runTo(end + 2 * apu.APU_FC_IRQ_PERIOD)
+h.c.apu.close()
+samples = backend.samples()
+# Steps come out BLIP_WIDTH / 2 (8) samples late
+endSample = int(end / (apu.CPU_FREQUENCY / apu.SAMPLE_RATE)) + 8
+before = samples[endSample - 400:endSample - 20]
+after = samples[endSample + 20:endSample + 400]
+assert before.max() - before.min() > 1000
+assert abs(after).max() < 50, abs(after).max()
+
+print "done"
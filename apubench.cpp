@@ -0,0 +1,98 @@
+// Measures how fast the synthesizer runs: samples per second with each
+// channel playing on its own, and with all of them. Run with no
+// arguments.
+
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <vector>
+
+#include "apu.hpp"
+
+// How much audio each benchmark generates
+const double BENCH_SECONDS = 60.0;
+
+typedef std::chrono::steady_clock benchClock;
+
+static void report(const char *name, unsigned long samples, double seconds) {
+  printf("%-20s %12.0f samples/s (%.0fx real time)\n", name,
+         samples / seconds, samples / seconds / SAMPLE_RATE);
+}
+
+// Stands in for a cartridge's PRG ROM, for the DMC to play
+static std::vector<unsigned char> prgRom(0x8000);
+
+// Time rendering a minute of audio offline, after the given writes
+static void benchAPU(const char *name, const apuWrite *writes, unsigned int n) {
+  APU apu(SAMPLE_RATE);
+  apu.loadPrgRom(&prgRom[0], prgRom.size());
+  apu.queueWrites(writes, n);
+  std::vector<short> out(FRAMES_PER_BUFFER);
+  unsigned long long endCycle = (unsigned long long) (BENCH_SECONDS * CPU_FREQUENCY);
+  unsigned long samples = 0;
+  benchClock::time_point start = benchClock::now();
+  unsigned int rendered;
+  while ((rendered = apu.render(endCycle, &out[0], FRAMES_PER_BUFFER))) {
+    samples += rendered;
+  }
+  std::chrono::duration<double> elapsed = benchClock::now() - start;
+  report(name, samples, elapsed.count());
+}
+
+int main(int argc, char **argv) {
+  for (unsigned int i = 0; i < prgRom.size(); i++) {
+    prgRom[i] = rand() & 0xff;
+  }
+
+  // Each channel at full volume, held: the tones at about 440 Hz,
+  // the noise at a middling period
+  const apuWrite pulse[] = {
+    {0, APU_STATUS, 0x01},
+    {0, PULSE_1_BASE, 0xbf}, {0, PULSE_1_BASE + 2, 0xfd},
+    {0, PULSE_1_BASE + 3, 0x08}};
+  benchAPU("pulse", pulse, sizeof(pulse) / sizeof(pulse[0]));
+
+  const apuWrite triangle[] = {
+    {0, APU_STATUS, 0x04},
+    {0, TRIANGLE_BASE, 0xff}, {0, TRIANGLE_BASE + 2, 0x7e},
+    {0, TRIANGLE_BASE + 3, 0x08}};
+  benchAPU("triangle", triangle, sizeof(triangle) / sizeof(triangle[0]));
+
+  const apuWrite noise[] = {
+    {0, APU_STATUS, 0x08},
+    {0, NOISE_BASE, 0x3f}, {0, NOISE_BASE + 2, 0x04},
+    {0, NOISE_BASE + 3, 0x08}};
+  benchAPU("noise", noise, sizeof(noise) / sizeof(noise[0]));
+
+  // The longest sample at the fastest rate, started over whenever it
+  // ends, as the emulator does to loop it
+  std::vector<apuWrite> dmc;
+  const apuWrite dmcSetup[] = {
+    {0, APU_STATUS, 0x10},
+    {0, DMC_BASE, 0x0f}, {0, DMC_BASE + 1, 0x40}, {0, DMC_BASE + 3, 0xff}};
+  dmc.assign(dmcSetup, dmcSetup + sizeof(dmcSetup) / sizeof(dmcSetup[0]));
+  unsigned long long sampleCycles = (0xff * 16 + 1) * 8 * DMC_RATE_TABLE[0xf];
+  for (unsigned long long cycle = 0; cycle < BENCH_SECONDS * CPU_FREQUENCY;
+       cycle += sampleCycles) {
+    apuWrite start = {cycle, APU_DMC_START, 0x4000};
+    dmc.push_back(start);
+  }
+  benchAPU("DMC", &dmc[0], dmc.size());
+
+  // Everything at once
+  std::vector<apuWrite> writes;
+  const apuWrite tones[] = {
+    {0, APU_STATUS, 0x1f},
+    {0, PULSE_1_BASE, 0xbf}, {0, PULSE_1_BASE + 2, 0xfd},
+    {0, PULSE_1_BASE + 3, 0x08},
+    {0, PULSE_2_BASE, 0x7f}, {0, PULSE_2_BASE + 2, 0x7e},
+    {0, PULSE_2_BASE + 3, 0x08},
+    {0, TRIANGLE_BASE, 0xff}, {0, TRIANGLE_BASE + 2, 0x7e},
+    {0, TRIANGLE_BASE + 3, 0x08},
+    {0, NOISE_BASE, 0x3f}, {0, NOISE_BASE + 2, 0x04},
+    {0, NOISE_BASE + 3, 0x08}};
+  writes.assign(tones, tones + sizeof(tones) / sizeof(tones[0]));
+  writes.insert(writes.end(), dmc.begin() + 1, dmc.end());
+  benchAPU("APU (5 channels)", &writes[0], writes.size());
+  return 0;
+}
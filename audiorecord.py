@@ -0,0 +1,47 @@
+"""Outputs for audio rendered offline (see apu.OfflineBackend): each takes 16-bit
+mono PCM, as a string of native-endian samples."""
+import sys
+import wave
+
+import numpy as np
+
+SAMPLE_WIDTH = 2 # bytes
+
+class WavRecorder(object):
+    "Streams samples, at the given sample rate, to a WAV file."
+
+    def __init__(self, path, sampleRate):
+        self.wav = wave.open(path, 'wb')
+        self.wav.setnchannels(1)
+        self.wav.setsampwidth(SAMPLE_WIDTH)
+        self.wav.setframerate(sampleRate)
+        self.samplesWritten = 0
+
+    def write(self, samples):
+        if sys.byteorder != 'little':
+            # WAV samples are little-endian
+            samples = np.fromstring(samples, dtype=np.int16).byteswap().tostring()
+        self.wav.writeframes(samples)
+        self.samplesWritten += len(samples) // SAMPLE_WIDTH
+
+    def close(self):
+        self.wav.close()
+
+class ArrayRecorder(object):
+    "Keeps samples in memory, for tests."
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, samples):
+        self.chunks.append(np.fromstring(samples, dtype=np.int16))
+
+    def close(self):
+        self.closed = True
+
+    def samples(self):
+        "Everything recorded so far, as an int16 array"
+        if not self.chunks:
+            return np.zeros(0, dtype=np.int16)
+        return np.concatenate(self.chunks)
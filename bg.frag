@@ -0,0 +1,42 @@
+#version 330
+
+in vec2 f_pos;
+flat in ivec2 f_scrollOffset;
+
+out vec4 outColor;
+
+// Tile and palette indexes for the whole scroll space, one texel per
+// tile. These are uploaded straight from python's column-major
+// buffers, so tile (x, y) is at texel (y, x).
+uniform usampler2D tileIndices;
+uniform usampler2D paletteIndices;
+// Size of scroll space in pixels
+uniform ivec2 scrollSize;
+
+// Same as in fragment.frag
+uniform usampler2D chrBanks;
+uniform int patternTableBase;
+uniform int[8] chrPages;
+
+uniform vec4[16] localPalettes;
+
+const int CHR_BANK_TILES = 64;
+
+void main()
+{
+  // Which pixel of scroll space we're looking at
+  ivec2 ss = (ivec2(floor(f_pos)) + f_scrollOffset) % scrollSize;
+  ivec2 nts = ss / 8;
+  ivec2 texel = ss % 8;
+
+  int tile = int(texelFetch(tileIndices, nts.yx, 0).r);
+  int palette = int(texelFetch(paletteIndices, nts.yx, 0).r);
+
+  int page = patternTableBase * 4 + tile / CHR_BANK_TILES;
+  int bank = chrPages[page];
+  uint localPaletteIndex =
+    texelFetch(chrBanks,
+               ivec2((tile % CHR_BANK_TILES) * 8 + texel.x, bank * 8 + texel.y),
+               0).r;
+  outColor = localPalettes[palette * 4 + int(localPaletteIndex)];
+}
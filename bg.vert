@@ -0,0 +1,21 @@
+#version 330
+
+// One vertex of a scroll region's quad, in pixel space
+in vec2 pos;
+// The scroll region's offset into scroll space
+in ivec2 scrollOffset;
+
+out vec2 f_pos;
+flat out ivec2 f_scrollOffset;
+
+void main()
+{
+  // This converts from pixel-space coordinates to GL coordinates.
+  // In GL coordinates, the y axis goes down-to-up.
+  gl_Position = vec4( (pos.x / (16.0*8.0)) - 1,
+                      1 - (pos.y / (15.0*8.0)),
+                      0.0,
+                      1.0);
+  f_pos = pos;
+  f_scrollOffset = scrollOffset;
+}
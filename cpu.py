@@ -2,6 +2,7 @@ import controller
 import instruction
 import mem
 import opc
+import pacing
 import ppu
 import apu
 
@@ -23,12 +24,19 @@ class CPU(object):
     def __init__(self,
                  rom,
                  audioEnabled = True,
+                 audioBackend = None,
                  ppuDebug = False,
-                 cheats = None):
+                 cheats = None,
+                 renderer = None,
+                 pacer = None):
         """Sets up an initial CPU state loading from the given ROM. Simulates
-        the reset signal."""
+        the reset signal. Audio goes to audioBackend (see
+        apu.makeAudioBackend) if there is one; otherwise it's played
+        through the sound card, or dropped if audioEnabled is False.
+        Without a pacer, frames are paced in real time."""
 
         self.audioEnabled = audioEnabled
+        self.audioBackend = audioBackend
 
         # see http://wiki.nesdev.com/w/index.php/CPU_power_up_state
         # for some initial values
@@ -72,10 +80,20 @@ class CPU(object):
         self.apuCyclesUntilAction = 0
         self.apuStoredCycles = 0
 
+        # CPU cycles run since power on, not counting excessCycles. The
+        # APU stamps its register writes with this.
+        self.cycles = 0
+
+        # The screen and the APU share the pacer: it syncs live audio
+        # at the end of every frame
+        if pacer is None:
+            pacer = pacing.FramePacer()
         self.ppu = ppu.PPU(cpu = self,
                            mirroring = rom.mirroring,
-                           ppu_debug = ppuDebug)
-        self.apu = apu.APU(self)
+                           ppu_debug = ppuDebug,
+                           renderer = renderer,
+                           pacer = pacer)
+        self.apu = apu.APU(self, pacer = pacer)
 
         # Cycles for the PPU to catch up on. (When the CPU executes a
         # cycle, this goes up by the cycle count. When the PPU
@@ -86,8 +104,9 @@ class CPU(object):
         self.controller = controller.Controller()
 
         # If an instruction takes more time than its "cycles"
-        # property, it should set this value to the number of extra
-        # cycles it took.
+        # property, it should add the number of extra cycles it took
+        # to this value. So should anything else that stalls the CPU,
+        # like the DMC reading samples.
         self.instructionCycleExtra = 0
 
         # Now that everything is set up, simulate the RST signal.
@@ -161,6 +180,7 @@ class CPU(object):
     def tick(self):
         self.ppuStoredCycles += self.excessCycles * 3
         self.apuStoredCycles += self.excessCycles
+        self.cycles += self.excessCycles
         self.excessCycles = 0
         if self.ppuStoredCycles >= self.ppuCyclesUntilAction:
             self.ppuStoredCycles -= self.ppuCyclesUntilAction
@@ -168,6 +188,6 @@ class CPU(object):
             self.ppu.ppuTick(self.ppuCyclesUntilAction)
         if self.apuStoredCycles >= self.apuCyclesUntilAction:
             self.apuStoredCycles -= self.apuCyclesUntilAction
-            # apuTick sets apuCyclesUntilAction
-            self.apu.frameCounterTick()
+            # apu.tick sets apuCyclesUntilAction
+            self.apu.tick()
         self.cpuTick()
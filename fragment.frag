@@ -1,18 +1,36 @@
 #version 330
 
 in vec2 f_uv;
+flat in int f_tile;
+// Bit n is set if row n of the tile gets drawn
+flat in int f_visible_rows;
 in vec4[4] f_palette;
 
 out vec4 outColor;
 
-uniform sampler2D patternTable;
+// Every CHR bank, decoded to color indexes. Each 1 KB bank is a strip
+// of 64 tiles, 8 pixels tall, with bank n starting at row 8*n.
+uniform usampler2D chrBanks;
+// 0 or 1, for the pattern table at $0000 or $1000
+uniform int patternTableBase;
+// The CHR bank mapped to each 1 KB page of the pattern tables
+uniform int[8] chrPages;
 
-uniform float[16] localPalettes;
+const int CHR_BANK_TILES = 64;
 
 void main()
 {
-  float localPaletteIndex;
-  localPaletteIndex = texture(patternTable, f_uv).r;
+  ivec2 texel = min(ivec2(f_uv * 8.0), ivec2(7));
+  // Rows past the 8-sprites-per-scanline limit don't get drawn
+  if (((f_visible_rows >> texel.y) & 1) == 0) {
+    discard;
+  }
+  int page = patternTableBase * 4 + f_tile / CHR_BANK_TILES;
+  int bank = chrPages[page];
+  uint localPaletteIndex =
+    texelFetch(chrBanks,
+               ivec2((f_tile % CHR_BANK_TILES) * 8 + texel.x, bank * 8 + texel.y),
+               0).r;
   // for now, assume localPaletteIndex will always be valid
   outColor = f_palette[int(localPaletteIndex)];
-}
\ No newline at end of file
+}
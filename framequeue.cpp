@@ -0,0 +1,119 @@
+#include <cassert>
+#include <utility>
+
+using namespace std;
+
+#include "framequeue.hpp"
+
+FrameQueue::FrameQueue(int maxFramesAhead)
+  : slots(maxFramesAhead + 1), writing(-1), reading(-1), closed(false)
+{
+  assert(maxFramesAhead >= 1);
+  for (int i = 0; i < (int) slots.size(); i++) {
+    freeSlots.push_back(i);
+    slots[i].copiesValid = false;
+    slots[i].hasChr = false;
+  }
+  counts.submitted = 0;
+  counts.rendered = 0;
+  counts.dropped = 0;
+  counts.queueDepth = 0;
+  counts.maxQueueDepth = 0;
+  counts.unchanged = 0;
+  counts.skippedUploads = 0;
+  counts.lastSkippedUploads = 0;
+}
+
+frameSnapshot *FrameQueue::beginWrite() {
+  unique_lock<mutex> lock(queueLock);
+  assert(writing < 0);
+  while (freeSlots.empty() && !closed) {
+    changed.wait(lock);
+  }
+  if (closed) {
+    return NULL;
+  }
+  writing = freeSlots.back();
+  freeSlots.pop_back();
+  return &slots[writing];
+}
+
+void FrameQueue::endWrite() {
+  unique_lock<mutex> lock(queueLock);
+  assert(writing >= 0);
+  pending.push_back(writing);
+  writing = -1;
+  counts.submitted++;
+  if ((int) pending.size() > counts.maxQueueDepth) {
+    counts.maxQueueDepth = pending.size();
+  }
+  changed.notify_all();
+}
+
+frameSnapshot *FrameQueue::beginRead() {
+  unique_lock<mutex> lock(queueLock);
+  assert(reading < 0);
+  while (pending.empty() && !closed) {
+    changed.wait(lock);
+  }
+  if (closed) {
+    return NULL;
+  }
+  // Drop everything but the newest frame. If a dropped frame came
+  // with new CHR and the next one didn't, pass it along so it still
+  // gets uploaded.
+  while (pending.size() > 1) {
+    frameSnapshot &dropped = slots[pending.front()];
+    freeSlots.push_back(pending.front());
+    pending.pop_front();
+    frameSnapshot &next = slots[pending.front()];
+    if (dropped.hasChr && !next.hasChr) {
+      swap(dropped.chr, next.chr);
+      next.nChrBanks = dropped.nChrBanks;
+      next.hasChr = true;
+    }
+    dropped.hasChr = false;
+    counts.dropped++;
+  }
+  reading = pending.front();
+  pending.pop_front();
+  // There may be free slots now, if we dropped anything
+  changed.notify_all();
+  return &slots[reading];
+}
+
+void FrameQueue::endRead(bool drawn, int skippedUploads) {
+  unique_lock<mutex> lock(queueLock);
+  assert(reading >= 0);
+  freeSlots.push_back(reading);
+  reading = -1;
+  counts.rendered++;
+  if (!drawn) {
+    counts.unchanged++;
+  }
+  counts.skippedUploads += skippedUploads;
+  counts.lastSkippedUploads = skippedUploads;
+  changed.notify_all();
+}
+
+void FrameQueue::close() {
+  unique_lock<mutex> lock(queueLock);
+  closed = true;
+  changed.notify_all();
+}
+
+void FrameQueue::invalidateCopies() {
+  unique_lock<mutex> lock(queueLock);
+  // Snapshots that are waiting or being rendered already have their
+  // copies, so this only needs to catch the rest
+  for (int i = 0; i < (int) freeSlots.size(); i++) {
+    slots[freeSlots[i]].copiesValid = false;
+  }
+}
+
+renderStats FrameQueue::stats() {
+  unique_lock<mutex> lock(queueLock);
+  renderStats out = counts;
+  out.queueDepth = pending.size();
+  return out;
+}
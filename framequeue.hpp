@@ -0,0 +1,93 @@
+#ifndef FRAMEQUEUE_H
+#define FRAMEQUEUE_H
+
+#include <condition_variable>
+#include <deque>
+#include <mutex>
+#include <vector>
+
+#include "screen.hpp"
+
+/* Everything the render thread needs to draw one frame. The emulator
+ * keeps writing its own tile, palette and OAM buffers while the render
+ * thread works, so each snapshot gets its own copies.
+ */
+typedef struct frameSnapshot {
+  frameState state;
+  vector<unsigned char> tileIndices;
+  vector<unsigned char> paletteIndices;
+  unsigned char oam[OAM_SIZE];
+  // The versions tileIndices/paletteIndices and oam were copied at,
+  // so the copies can be skipped when they haven't changed. Snapshots
+  // get reused, so these are usually from a few frames ago.
+  bool copiesValid;
+  unsigned int bgTilesVersion;
+  unsigned int oamVersion;
+  // CHR banks to upload before drawing this frame, if hasChr is set
+  bool hasChr;
+  vector<unsigned char> chr;
+  int nChrBanks;
+} frameSnapshot;
+
+typedef struct renderStats {
+  unsigned long submitted;
+  unsigned long rendered;
+  // Frames that were submitted but skipped because a newer frame was
+  // already waiting by the time the render thread got to them
+  unsigned long dropped;
+  // Frames waiting to be rendered, now and at most
+  int queueDepth;
+  int maxQueueDepth;
+  // Rendered frames that were identical to the one before, so the
+  // render thread left the previous one up instead of redrawing
+  unsigned long unchanged;
+  // Uploads skipped because their data hadn't changed, in total and
+  // in the last frame
+  unsigned long skippedUploads;
+  int lastSkippedUploads;
+} renderStats;
+
+/* Hands frame snapshots from the emulator (the writer) to the render
+ * thread (the reader). There are maxFramesAhead + 1 snapshots, so the
+ * writer only blocks when all of them are waiting or being rendered:
+ * that is, when it's gotten more than maxFramesAhead frames ahead of
+ * the render thread. The reader always skips ahead to the newest
+ * waiting frame.
+ */
+class FrameQueue {
+public:
+  FrameQueue(int maxFramesAhead);
+
+  // The writer fills in the snapshot from beginWrite, then calls
+  // endWrite. beginWrite returns NULL once the queue is closed.
+  frameSnapshot *beginWrite();
+  void endWrite();
+  // Same for the reader. endRead takes whether the frame was drawn
+  // (or skipped as unchanged) and how many uploads it skipped.
+  frameSnapshot *beginRead();
+  void endRead(bool drawn, int skippedUploads);
+
+  // Wake everyone up and make beginWrite and beginRead return NULL
+  void close();
+
+  // Make the writer copy every buffer into the snapshots again
+  void invalidateCopies();
+
+  renderStats stats();
+
+private:
+  mutex queueLock;
+  condition_variable changed;
+
+  vector<frameSnapshot> slots;
+  vector<int> freeSlots;
+  // Written frames, oldest first
+  deque<int> pending;
+  int writing;
+  int reading;
+  bool closed;
+
+  renderStats counts;
+};
+
+#endif
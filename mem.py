@@ -2,6 +2,7 @@
 
 from rom import MirrorMode
 
+from collections import Counter
 from operator import xor
 import struct
 import sys
@@ -15,10 +16,36 @@ VEC_IRQ = 0xFFFE
 
 RAM_SIZE = 0x0800
 PRG_RAM_SIZE = 0x2000 # Note: PRG RAM is not yet persistent
-PPU_RAM_SIZE = 0x0800
+CHR_RAM_SIZE = 0x2000
+
+# The PPU address space is split into 1 KB pages: eight for the
+# pattern tables (CHR), then four nametables, then four more that
+# mirror the nametables. Palette RAM lives at the top of the last page
+# and gets special handling.
+PPU_PAGE_SIZE = 0x400
+PPU_PAGE_SHIFT = 10
+PPU_PAGE_MASK = PPU_PAGE_SIZE - 1
+PPU_PAGES = 16
+CHR_PAGES = 8
+NAMETABLE_PAGE = 8 # first nametable page
+NAMETABLE_PAGES = 4
+NAMETABLE_START = 0x2000
+PALETTE_RAM_START = 0x3f00
+
+# Which nametable bank each of the four nametables uses
+NAMETABLE_LAYOUTS = {
+    MirrorMode.horizontalMirroring: (0, 0, 1, 1),
+    MirrorMode.verticalMirroring: (0, 1, 0, 1),
+    MirrorMode.fourScreenVRAM: (0, 1, 2, 3),
+}
 
 IO_OAMDMA = 0x4014
+APU_STATUS = 0x4015
+JOYSTICK_1 = 0x4016
+JOYSTICK_2 = 0x4017
 
+# Whether unsupportedReport covers reads from APU registers other than
+# $4015, and from joystick 2
 APU_WARN = True
 JOYSTICK_WARN = False
 
@@ -30,10 +57,12 @@ class Memory(object):
         # http://wiki.nesdev.com/w/index.php/CPU_power_up_state
         self.cpu = cpu
         self.ram = ['\xff'] * RAM_SIZE
-        self.mirroring = mirroring
-        self.ppuram = ['\x00'] * PPU_RAM_SIZE
         self.prgram = ['\x00'] * PRG_RAM_SIZE
         self.instructionCache = {} # for NROM, this is never invalidated
+        # How many times each register we can't read yet has been read
+        # (reading them yields 0)
+        self.unsupportedReads = Counter()
+        self.initPpuPages(mirroring)
 
     def readMany(self, address, nbytes):
         out = ""
@@ -53,34 +82,56 @@ class Memory(object):
             register = (address - 0x2000) % 8
             return self.cpu.ppu.readReg(register)
         elif 0x4000 <= address < 0x4020:
-            if address == 0x4016:
+            if address == APU_STATUS:
+                return self.cpu.apu.readStatus()
+            elif address == JOYSTICK_1:
                 return chr(self.cpu.controller.read())
-            elif address == 0x4017:
-                if JOYSTICK_WARN:
-                    print >> sys.stderr, "Warning: reporting no input from joystick 2"
-                return '\x00'
             else:
-                if APU_WARN:
-                    print >> sys.stderr, "Warning: reading 0 from APU register %x" % address
+                # Joystick 2, or a write-only APU register
+                self.unsupportedReads[address] += 1
                 return '\x00'
         elif 0x4020 <= address < 0x6000:
             raise RuntimeError("Read from unmapped address %x" % address)
         elif 0x6000 <= address < 0x8000:
             return self.prgram[address - 0x6000]
         elif 0x8000 <= address <= 0xffff:
-            if self.cpu.prgromsize == 0x4000:
-                prgaddr = address - 0x8000
-                if prgaddr >= 0x4000:
-                    prgaddr -= 0x4000
-            elif self.cpu.prgromsize == 0x8000:
-                prgaddr = address - 0x8000
-            else:
-                raise RuntimeError("Unsupported NROM size for PRG ROM: %d bytes"
-                                   % self.cpu.prgromsize)
-            return self.cpu.prgrom[prgaddr]
+            return self.cpu.prgrom[self.prgOffset(address)]
         else:
             raise RuntimeError("Address out of range: %x" % address)
 
+    def unsupportedReport(self):
+        """A line for each register we can't read yet that's been read,
+        with how many times (subject to APU_WARN and JOYSTICK_WARN), or
+        None if there aren't any."""
+        lines = []
+        for address in sorted(self.unsupportedReads):
+            if address == JOYSTICK_2:
+                if not JOYSTICK_WARN:
+                    continue
+                what = "joystick 2 (no input)"
+            else:
+                if not APU_WARN:
+                    continue
+                what = "APU register"
+            lines.append("Read 0 from %s 0x%04x %d times" %
+                         (what, address, self.unsupportedReads[address]))
+        if not lines:
+            return None
+        return "\n".join(lines)
+
+    def prgOffset(self, address):
+        "Where the given address ($8000-$FFFF) is mapped in PRG ROM"
+        if self.cpu.prgromsize == 0x4000:
+            prgaddr = address - 0x8000
+            if prgaddr >= 0x4000:
+                prgaddr -= 0x4000
+        elif self.cpu.prgromsize == 0x8000:
+            prgaddr = address - 0x8000
+        else:
+            raise RuntimeError("Unsupported NROM size for PRG ROM: %d bytes"
+                               % self.cpu.prgromsize)
+        return prgaddr
+
     def write(self, address, val):
         if isinstance(val, int): # someday we will want to get rid of this chr/ord weirdness
             val = chr(val)
@@ -98,12 +149,19 @@ class Memory(object):
         elif 0x4000 <= address < 0x4020:
             if address == IO_OAMDMA:
                 startaddr = ord(val) * 0x100
-                for i in range(256):
-                    self.cpu.ppu.oam[i] = self.read(startaddr + i)
+                ppu = self.cpu.ppu
+                if startaddr < 0x2000:
+                    # Internal RAM, which is the usual source: copy
+                    # the page in one go
+                    ramaddr = startaddr % 0x800
+                    ppu.oam[:] = ''.join(self.ram[ramaddr:ramaddr + 0x100])
+                else:
+                    ppu.oam[:] = self.readMany(startaddr, 0x100)
+                ppu.oamVersion += 1
                 # TODO: for perfect accuracy, this should take 514
                 # cycles on an odd CPU cycle and 513 on an even cycle
-                self.cpu.instructionCycleExtra = 514
-            elif address == 0x4016:
+                self.cpu.instructionCycleExtra += 514
+            elif address == JOYSTICK_1:
                 strobe = bool(ord(val) & 1)
                 self.cpu.controller.inputStrobe(strobe)
             else:
@@ -124,75 +182,140 @@ class Memory(object):
         pointer = self.readMany(paddr, nbytes=2)
         return struct.unpack("<H", pointer)[0]
 
-    def ppuNametablePaddr(self, vaddr):
-        paddr = vaddr - 0x2000
-        if self.mirroring == MirrorMode.horizontalMirroring:
-            # adjust paddr for horizontal mirroring
-            if (0x400 <= paddr < 0x800) or (0xc00 <= paddr < 0x1000):
-                paddr -= 0x400
-            # now remember that paddr 2400 lives at vaddr 2800
-            if 0x800 <= paddr:
-                paddr -= 0x400
-        elif self.mirroring == MirrorMode.verticalMirroring:
-            paddr = paddr % 0x800
-        elif self.mirroring == MirrorMode.fourScreenVRAM:
-            pass
-        elif self.mirroring == MirrorMode.oneScreenMirroring:
-            raise RuntimeError("NROM mapper does not support one-screen mirroring")
+    def initPpuPages(self, mirroring):
+        """Set up CHR and nametable banks and the PPU page table that
+        maps them into the PPU address space."""
+        chrrom = self.cpu.chrrom
+        # Carts without CHR ROM have CHR RAM instead
+        self.chrWritable = not chrrom
+        if not chrrom:
+            chrrom = '\x00' * CHR_RAM_SIZE
+        self.chrBanks = [bytearray(chrrom[i:i+PPU_PAGE_SIZE])
+                         for i in xrange(0, len(chrrom), PPU_PAGE_SIZE)]
+        # Incremented whenever the contents of the pattern tables
+        # change, either from a write to CHR RAM or a bank switch.
+        self.chrVersion = 0
+        # Incremented only when the contents of a CHR bank change
+        # (that is, on CHR RAM writes), not on bank switches
+        self.chrDataVersion = 0
+        # Which CHR bank each pattern table page maps
+        self.chrPageBanks = [None] * CHR_PAGES
+        # Four nametables' worth of VRAM. The NES itself only has two;
+        # the other two are on the cart in four-screen mode.
+        self.vramBanks = [bytearray(PPU_PAGE_SIZE)
+                          for i in xrange(NAMETABLE_PAGES)]
+        self.ppuPages = [None] * PPU_PAGES
+        self.setChrPages(range(CHR_PAGES))
+        self.setMirroring(mirroring)
+
+    def setChrPages(self, banks):
+        """Map 1 KB CHR banks into the pattern table pages, in order."""
+        changed = False
+        for (page, bank) in enumerate(banks):
+            bank %= len(self.chrBanks)
+            chrBank = self.chrBanks[bank]
+            if self.ppuPages[page] is not chrBank:
+                self.ppuPages[page] = chrBank
+                self.chrPageBanks[page] = bank
+                changed = True
+        if changed:
+            self.chrVersion += 1
+
+    def setMirroring(self, mirroring, oneScreenBank = 0):
+        """Map nametable banks into the nametable pages (and their
+        mirrors at $3000) according to the mirroring mode."""
+        self.mirroring = mirroring
+        if mirroring == MirrorMode.oneScreenMirroring:
+            layout = (oneScreenBank,) * NAMETABLE_PAGES
+        elif mirroring in NAMETABLE_LAYOUTS:
+            layout = NAMETABLE_LAYOUTS[mirroring]
         else:
-            raise RuntimeError("Unrecognized mirroring type: %s" % str(self.mirroring))
-        return paddr
+            raise RuntimeError("Unrecognized mirroring type: %s" % str(mirroring))
+        for (i, bank) in enumerate(layout):
+            self.ppuPages[NAMETABLE_PAGE + i] = self.vramBanks[bank]
+            self.ppuPages[NAMETABLE_PAGE + NAMETABLE_PAGES + i] = self.vramBanks[bank]
 
     def ppuRead(self, address):
-        if 0 <= address < 0x2000:
-            return self.cpu.chrrom[address]
-        elif 0x2000 <= address < 0x3f00:
-            # 0x3000 through 0x3f00 mirrors memory at 0x2000
-            if 0x3000 <= address:
-                address -= 0x1000
-            paddr = self.ppuNametablePaddr(address)
-            return self.ppuram[paddr]
-        elif 0x3f00 <= address <= 0x4000:
+        if address >= PALETTE_RAM_START:
+            if address > 0x4000:
+                raise RuntimeError("PPU read address out of range: %x" % address)
             paletteRamAddr = (address - 0x3f00) % 32
             # 3f14/3f18/3f1c mirror 3f04/3f08/3f0c
             if paletteRamAddr % 4 == 0:
                 paletteRamAddr &= 0x0f
-            return self.cpu.ppu.paletteRam[paletteRamAddr]
-        else:
-            raise RuntimeError("PPU read address out of range: %x" % address)
+            return chr(self.cpu.ppu.paletteRam[paletteRamAddr])
+        return chr(self.ppuPages[address >> PPU_PAGE_SHIFT][address & PPU_PAGE_MASK])
 
     def ppuWrite(self, address, val):
-        if isinstance(val, int):
-            val = chr(val)
-        if 0 <= address < 0x2000:
-            raise RuntimeError("Can't write to CHR ROM")
-        elif 0x2000 <= address < 0x3000:
-            paddr = self.ppuNametablePaddr(address)
+        if isinstance(val, str):
+            val = ord(val)
+        self.ppuStore(address, val)
+        if NAMETABLE_START <= address < PALETTE_RAM_START:
             # We're writing to a nametable byte, so invalidate the
-            # corresponding portion of the background cache. TODO:
-            # handle the fact that we might actually be writing to the
-            # other nametable.
-            ntabOffset = address & 0x3ff
-            tileX = ntabOffset % 32
-            tileY = ntabOffset / 32
+            # corresponding portion of the background cache.
             # TODO we probably shouldn't be talking to the ppu
             # directly here
-
-            # this might actually be part of the attribute table, but
-            # the ppu code will handle that
-            self.cpu.ppu.flushBgTile(tileX, tileY)
-            self.ppuram[paddr] = val
-        elif 0x3000 <= address < 0x3f00:
-            # mirror memory at 0x2000
-            self.ppuWrite(address - 0x1000, val)
-        elif 0x3f00 <= address <= 0x4000:
+            self.cpu.ppu.flushBgRange(address, address + 1)
+
+    def ppuWriteRun(self, address, step, data):
+        """Write a run of bytes to PPU memory, step addresses apart,
+        and invalidate the background for just the bytes written."""
+        end = address + step * (len(data) - 1) + 1
+        if step == 1 and end <= PALETTE_RAM_START:
+            # Copy whole page-sized chunks at once
+            i = 0
+            while i < len(data):
+                chunkAddress = address + i
+                page = chunkAddress >> PPU_PAGE_SHIFT
+                pageOffset = chunkAddress & PPU_PAGE_MASK
+                n = min(len(data) - i, PPU_PAGE_SIZE - pageOffset)
+                self.checkPpuPageWritable(page)
+                self.ppuPages[page][pageOffset:pageOffset+n] = data[i:i+n]
+                i += n
+        else:
+            for (i, val) in enumerate(data):
+                self.ppuStore(address + step * i, val)
+        if step == 1:
+            start = max(address, NAMETABLE_START)
+            end = min(end, PALETTE_RAM_START)
+            if start < end:
+                self.cpu.ppu.flushBgRange(start, end)
+        else:
+            # A run down a column skips over most of the span, so only
+            # invalidate the tiles (or attribute bytes) actually written,
+            # and let the PPU merge them
+            for i in xrange(len(data)):
+                a = address + step * i
+                if NAMETABLE_START <= a < PALETTE_RAM_START:
+                    self.cpu.ppu.flushBgRange(a, a + 1)
+
+    def ppuStore(self, address, val):
+        """Store a byte in PPU memory, without invalidating anything
+        but palette RAM and pattern table versions."""
+        if address >= PALETTE_RAM_START:
+            if address > 0x4000:
+                raise RuntimeError("PPU write address out of range: %x" % address)
             paletteRamAddr = (address - 0x3f00) % 32
             # 3f14/3f18/3f1c mirror 3f04/3f08/3f0c
             if paletteRamAddr % 4 == 0:
                 paletteRamAddr &= 0x0f
-            self.cpu.ppu.paletteRam[paletteRamAddr] = val
-        else:
-            raise RuntimeError("PPU write address out of range: %x" % address)
+            ppu = self.cpu.ppu
+            if ppu.paletteRam[paletteRamAddr] != val:
+                ppu.paletteRam[paletteRamAddr] = val
+                # Anything built from palette RAM checks this to see
+                # whether it needs to be rebuilt.
+                ppu.paletteVersion += 1
+            return
+        page = address >> PPU_PAGE_SHIFT
+        self.checkPpuPageWritable(page)
+        self.ppuPages[page][address & PPU_PAGE_MASK] = val
+
+    def checkPpuPageWritable(self, page):
+        if page < CHR_PAGES:
+            if not self.chrWritable:
+                raise RuntimeError("Can't write to CHR ROM")
+            self.chrVersion += 1
+            self.chrDataVersion += 1
 
     def isRom(self, address):
         """Returns true if the given address is read-only."""
@@ -215,7 +338,8 @@ class MMC1(Memory):
         self.cpu = cpu
         self.ram = ['\xff'] * RAM_SIZE
         self.prgram = ['\x00'] * PRG_RAM_SIZE
-        # ignore mirroring input
+        self.unsupportedReads = Counter()
+        # ignore mirroring input: the mapper controls mirroring
 
         self.shiftIndex = 0
         self.shiftContents = 0x00
@@ -241,32 +365,36 @@ class MMC1(Memory):
         self.PRGBank = 0
         self.PRGRAMEnable = False
 
-    # TODO the PPU has its own address space, and the mapper will need
-    # to deal with that
+        self.initPpuPages(MirrorMode.horizontalMirroring)
+        self.updatePpuPages()
 
     def read(self, address):
         if 0x6000 <= address < 0x8000:
             # TODO check PRGRAMEnable
             return self.prgram[address - 0x6000]
         elif 0x8000 <= address <= 0xffff:
-            if self.PRGSize:
-                bank = self.PRGBank >> 1 # ignore lowest bit
-                bankIndex = address & 0x7fff # here banks are 32 KB
-                return self.cpu.prgrom[(bank * 0x8000) + bankIndex]
-            else:
-                # find the bank depending on address and PRG slot. If the
-                # PRG slot bit is set, we need to find banks for addresses
-                # below 0xc000. Otherwise, we need to find banks for
-                # addresses >= 0xc000.
-                if xor(bool(address >= 0xc000), bool(self.PRGSlot)):
-                    bank = self.PRGBank
-                else:
-                    bank = -1
-                bankIndex = address & 0x3fff # banks are 16 KB
-                return self.cpu.prgrom[(bank * 0x4000) + bankIndex]
+            return self.cpu.prgrom[self.prgOffset(address)]
         else:
             return super(MMC1, self).read(address)
 
+    def prgOffset(self, address):
+        if not self.PRGSize:
+            bank = self.PRGBank >> 1 # ignore lowest bit
+            bankIndex = address & 0x7fff # here banks are 32 KB
+            return (bank * 0x8000) + bankIndex
+        else:
+            # find the bank depending on address and PRG slot. If the
+            # PRG slot bit is set, we need to find banks for addresses
+            # below 0xc000. Otherwise, we need to find banks for
+            # addresses >= 0xc000.
+            if xor(bool(address >= 0xc000), bool(self.PRGSlot)):
+                bank = self.PRGBank
+            else:
+                bank = -1
+            bankIndex = address & 0x3fff # banks are 16 KB
+            # bank -1 is the last one
+            return ((bank * 0x4000) + bankIndex) % self.cpu.prgromsize
+
     def write(self, address, val):
         if isinstance(val, int): # someday we will want to get rid of this chr/ord weirdness
             val = chr(val)
@@ -275,10 +403,10 @@ class MMC1(Memory):
             self.prgram[address - 0x6000] = val
         elif 0x8000 <= address <= 0xffff:
             flags = ord(val)
-            reset = bool(flags % 0x80)
+            reset = bool(flags & 0x80)
             if not reset:
                 # Set the current bit if the data bit is set
-                if bool(flags % 0x1):
+                if bool(flags & 0x1):
                     self.shiftContents |= (1 << self.shiftIndex)
                 # If we're done, write to the register; otherwise,
                 # advance the index
@@ -295,6 +423,9 @@ class MMC1(Memory):
             super(MMC1, self).write(address, val)
 
     def setMapperRegister(self, address, val):
+        # Queued PPUDATA writes have to land in the banks that were
+        # mapped when they were made.
+        self.cpu.ppu.flushPpuWrites()
         if 0x8000 <= address < 0xa000:
             # bits 0-1 set mirroring
             self.mirroringN = val & 0x3
@@ -304,10 +435,13 @@ class MMC1(Memory):
             self.PRGSize = (val >> 3) & 0x1
             # bit 4 sets CHR mode
             self.CHRMode = (val >> 4) & 0x1
+            self.updatePpuPages()
         elif 0xa000 <= address < 0xc000:
             self.CHRBank0 = val
+            self.updatePpuPages()
         elif 0xc000 <= address < 0xe000:
             self.CHRBank1 = val
+            self.updatePpuPages()
         elif 0xe000 <= address <= 0xffff:
             # bit 4 sets RAM enable; bits 0-3 set bank
             self.PRGRAMEnable = bool(val & 0x10)
@@ -315,13 +449,28 @@ class MMC1(Memory):
         else:
             raise RuntimeError("Bad mapper register address %x" % address)
 
-    def ppuRead(self, address):
-        return '\x00' # DEBUG
-        raise NotImplementedError()
-
-    def ppuWrite(self, address, val):
-        return # DEBUG
-        raise NotImplementedError()
+    def updatePpuPages(self):
+        """Point the PPU page table at the nametables and CHR banks
+        selected by the mapper registers."""
+        if self.mirroringN < 2:
+            self.setMirroring(MirrorMode.oneScreenMirroring,
+                              oneScreenBank = self.mirroringN)
+        elif self.mirroringN == 2:
+            self.setMirroring(MirrorMode.verticalMirroring)
+        else:
+            self.setMirroring(MirrorMode.horizontalMirroring)
+        # CHR bank registers count in 4 KB units; pages are 1 KB
+        pagesPer4k = CHR_PAGES / 2
+        if self.CHRMode:
+            banks = ([self.CHRBank0 * pagesPer4k + i for i in xrange(pagesPer4k)] +
+                     [self.CHRBank1 * pagesPer4k + i for i in xrange(pagesPer4k)])
+        else:
+            # 8 KB mode ignores the low bit of the bank number
+            base = (self.CHRBank0 & ~1) * pagesPer4k
+            banks = range(base, base + CHR_PAGES)
+        self.setChrPages(banks)
 
     def isRom(self, address):
-        raise NotImplementedError()
+        # PRG banks can be switched out from under the instruction
+        # cache, so don't let anything get cached.
+        return False
@@ -3,18 +3,59 @@ import cpu
 import instruction
 import mem
 import opc
+import pacing
 import rom
+import screen
+
+import apu
 
 import argparse
+import sys
 import time
 
 def getargs():
     parser = argparse.ArgumentParser()
     parser.add_argument("rom", help="Path to the ROM to run")
+    parser.add_argument("--audio",
+                        help="Where audio goes: played through the sound card, rendered to a WAV file (see --record-audio), rendered into memory and thrown away (for timing), or nowhere (default %(default)s)",
+                        dest="audioBackend",
+                        choices=apu.AUDIO_BACKENDS,
+                        default=apu.AUDIO_PORTAUDIO)
     parser.add_argument("--no-audio",
-                        help="Disable audio output",
-                        dest="audio",
-                        action="store_false")
+                        help="Disable audio output (the same as --audio %s)" % apu.AUDIO_NULL,
+                        dest="audioBackend",
+                        action="store_const",
+                        const=apu.AUDIO_NULL)
+    parser.add_argument("--record-audio",
+                        help="Instead of playing audio, render it to this WAV file, at whatever speed the emulator runs (implies --audio %s)" % apu.AUDIO_WAV,
+                        dest="recordAudio",
+                        metavar="WAV")
+    parser.add_argument("--audio-latency",
+                        help="How far behind the emulator audio playback aims to stay, in milliseconds (default %(default)s)",
+                        dest="audioLatency",
+                        type=float,
+                        default=apu.DEFAULT_TARGET_LATENCY * 1000.0)
+    parser.add_argument("--audio-period",
+                        help="Samples per audio callback (default %(default)s)",
+                        dest="audioPeriod",
+                        type=int,
+                        default=apu.DEFAULT_FRAMES_PER_BUFFER)
+    parser.add_argument("--audio-buffer",
+                        help="How much the sound card should buffer, in milliseconds (default: the device's own low-latency default)",
+                        dest="audioBuffer",
+                        type=float)
+    parser.add_argument("--renderer",
+                        help="How to draw frames: with OpenGL, or into a framebuffer in software (no display needed)",
+                        choices=screen.RENDERERS,
+                        default=screen.RENDERER_OPENGL)
+    parser.add_argument("--pacing",
+                        help="How fast to run: at the NES's frame rate, as fast as possible, at --speed times the NES's frame rate, or at the NES's frame rate following the sound card's clock (which falls back to realtime without live audio)",
+                        choices=pacing.PACING_MODES,
+                        default=pacing.PACING_AUDIO)
+    parser.add_argument("--speed",
+                        help="Speed multiplier for --pacing multiplier (default 2)",
+                        type=float,
+                        default=2.0)
     parser.add_argument("--ppu-debug",
                         help="Print PPU debug information",
                         dest="ppuDebug",
@@ -25,6 +66,10 @@ def getargs():
                         dest="smbCheats",
                         action="store_true")
     args = parser.parse_args()
+    if args.recordAudio:
+        args.audioBackend = apu.AUDIO_WAV
+    elif args.audioBackend == apu.AUDIO_WAV:
+        parser.error("--audio %s needs --record-audio" % apu.AUDIO_WAV)
     return args
 
 def makeCPU(romfilepath,
@@ -34,8 +79,15 @@ def makeCPU(romfilepath,
                    *cpuargs, **cpukwargs)
 
 def run(c):
-    while True:
-        c.tick()
+    try:
+        while True:
+            c.tick()
+    finally:
+        # Finish the WAV file if we're recording one, even on ctrl-C
+        c.apu.close()
+        report = c.mem.unsupportedReport()
+        if report is not None:
+            print >> sys.stderr, report
 
 if __name__ == "__main__":
     args = getargs()
@@ -45,8 +97,18 @@ if __name__ == "__main__":
                                     cheats.smbNoFall])
     else:
         chts = None
+    audioBackend = apu.makeAudioBackend(
+        args.audioBackend,
+        settings = apu.AudioSettings(
+            targetLatency = args.audioLatency / 1000.0,
+            framesPerBuffer = args.audioPeriod,
+            deviceLatency = (args.audioBuffer / 1000.0
+                             if args.audioBuffer else None)),
+        path = args.recordAudio)
     c = makeCPU(args.rom,
-                audioEnabled = args.audio,
+                audioBackend = audioBackend,
                 ppuDebug = args.ppuDebug,
-                cheats = chts)
+                cheats = chts,
+                renderer = args.renderer,
+                pacer = pacing.FramePacer(args.pacing, args.speed))
     run(c)
@@ -7,6 +7,9 @@ const unsigned char ENVELOPE_MAX = 0xf;
 
 // not an NES-specificconstant, but still useful across multiple files
 const float TIME_PRECISION = 1e-8;
+// What a channel's nextChange returns when its output won't change:
+// later than any cycle
+const double NO_CHANGE = 1e300;
 
 const int FRAME_COUNTER_4STEP_LENGTH = 14915;
 const int FRAME_COUNTER_5STEP_LENGTH = 18641;
@@ -0,0 +1,231 @@
+"""Keep emulation running at the NES's frame rate (or a fixed multiple of
+it, or as fast as it'll go, or in step with the sound card), and keep
+track of where each frame's time goes.
+
+"""
+import ctypes
+import ctypes.util
+import sys
+import time
+
+# The NTSC NES's master clock is 236.25/11 MHz, and a frame takes
+# 357366 master clock cycles (on average: every other frame is one PPU
+# cycle short when rendering is on)
+NES_FPS = (236.25e6 / 11) / 357366.0
+
+# Pacing modes
+PACING_REALTIME = "realtime" # NES_FPS
+PACING_TURBO = "turbo" # as fast as possible
+PACING_MULTIPLIER = "multiplier" # NES_FPS times a fixed speed
+PACING_AUDIO = "audio" # NES_FPS by the sound card's clock, when there's live audio
+PACING_MODES = [PACING_REALTIME, PACING_TURBO, PACING_MULTIPLIER, PACING_AUDIO]
+
+# Sleeping isn't precise, so sleep until this long before the end of
+# the frame, then spin for the rest
+SPIN_SECONDS = 0.002
+
+# If we fall this many frames behind (say, the window was being
+# dragged), give up on catching up and start pacing from now
+MAX_FRAMES_BEHIND = 3
+
+# When pacing by audio, never wait more than this many frames for
+# playback to catch up, in case the sound card has stopped
+MAX_AUDIO_WAIT_FRAMES = 4
+
+# Where a frame's time goes, in order
+EMULATE = "emulate" # running the CPU, PPU and APU
+RENDER = "render" # getting the frame ready for the screen
+PRESENT = "present" # handing the frame to the screen, and reading input
+SLEEP = "sleep" # waiting for the next frame to start
+PHASES = [EMULATE, RENDER, PRESENT, SLEEP]
+
+# Upper edges of the histogram bins, in milliseconds. There's one more
+# bin for everything longer than the last edge.
+HISTOGRAM_EDGES_MS = [0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128]
+
+# clock_gettime clock IDs
+CLOCK_MONOTONIC_IDS = {'linux': 1, 'darwin': 6}
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_nsec', ctypes.c_long)]
+
+def _makeMonotonicClock():
+    """Returns a function that gives the time in seconds from a monotonic,
+    high-resolution clock. Python 2 doesn't have one built in, so call
+    clock_gettime if we can, and fall back to time.time if we can't."""
+    platform = 'linux' if sys.platform.startswith('linux') else sys.platform
+    clockId = CLOCK_MONOTONIC_IDS.get(platform)
+    libName = ctypes.util.find_library('c')
+    if clockId is None or libName is None:
+        return time.time
+    try:
+        clockGettime = ctypes.CDLL(libName, use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    clockGettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+    clockGettime.restype = ctypes.c_int
+    timespec = _Timespec()
+    timespecPointer = ctypes.pointer(timespec)
+    def monotonicTime():
+        if clockGettime(clockId, timespecPointer) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+    return monotonicTime
+
+monotonicTime = _makeMonotonicClock()
+
+
+class TimingHistogram(object):
+    """Counts how long each phase of a frame took, in bins bounded by
+    HISTOGRAM_EDGES_MS."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = dict((phase, [0] * (len(HISTOGRAM_EDGES_MS) + 1))
+                           for phase in PHASES)
+        self.totals = dict((phase, 0.0) for phase in PHASES)
+        self.maxima = dict((phase, 0.0) for phase in PHASES)
+
+    def record(self, phase, seconds):
+        ms = seconds * 1000.0
+        counts = self.counts[phase]
+        for (i, edge) in enumerate(HISTOGRAM_EDGES_MS):
+            if ms < edge:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self.totals[phase] += seconds
+        self.maxima[phase] = max(self.maxima[phase], seconds)
+
+    def report(self):
+        "Returns a table of the histogram, one line per phase."
+        header = ["%8s" % "phase"]
+        header += ["<%gms" % edge for edge in HISTOGRAM_EDGES_MS]
+        header += [">=%gms" % HISTOGRAM_EDGES_MS[-1], "mean", "max"]
+        widths = [max(len(h), 6) for h in header]
+        lines = [" ".join(h.rjust(w) for (h, w) in zip(header, widths))]
+        for phase in PHASES:
+            counts = self.counts[phase]
+            frames = sum(counts)
+            mean = self.totals[phase] / frames * 1000.0 if frames else 0.0
+            row = ["%8s" % phase] + [str(n) for n in counts]
+            row += ["%.2f" % mean, "%.2f" % (self.maxima[phase] * 1000.0)]
+            lines.append(" ".join(r.rjust(w) for (r, w) in zip(row, widths)))
+        return "\n".join(lines)
+
+
+class FramePacer(object):
+    """Paces frames and times their phases. The screen calls mark at the
+    end of each phase of a frame, and wait at the end of the frame.
+
+    In PACING_AUDIO mode, the pacer follows an audio clock (the APU, if
+    it's playing live), which it's given with setAudioClock: at the end
+    of each frame, it waits until playback is no further behind the
+    emulator than the clock's target latency. In any mode, it syncs the
+    clock at the end of each frame, so playback can keep going even if
+    the game hasn't written to the APU. The audio clock fine-tunes
+    its own playback rate to match. Without an audio clock, it paces
+    like PACING_REALTIME."""
+
+    def __init__(self, mode = PACING_REALTIME, speed = 1.0):
+        if mode not in PACING_MODES:
+            raise ValueError("Unknown pacing mode %r" % mode)
+        if mode == PACING_MULTIPLIER and speed <= 0:
+            raise ValueError("Speed must be positive, not %r" % speed)
+        self.mode = mode
+        self.speed = speed if mode == PACING_MULTIPLIER else 1.0
+        self.histogram = TimingHistogram()
+        # When the last phase ended
+        self.lastMark = None
+        # When the next frame should start
+        self.deadline = None
+        self.audioClock = None
+
+    def setAudioClock(self, clock):
+        """Follow the given clock's audioSurplus in PACING_AUDIO mode,
+        sync it every frame, and report its audioStats and
+        targetLatency."""
+        self.audioClock = clock
+
+    def framePeriod(self):
+        "Seconds per frame, or None when not throttling."
+        if self.mode == PACING_TURBO:
+            return None
+        return 1.0 / (NES_FPS * self.speed)
+
+    def mark(self, phase):
+        """Record that the given phase just ended, having started when the
+        last one ended."""
+        now = monotonicTime()
+        if self.lastMark is not None:
+            self.histogram.record(phase, now - self.lastMark)
+        self.lastMark = now
+
+    def wait(self):
+        """Wait until it's time for the next frame: sleep for most of it,
+        then spin for the last SPIN_SECONDS, which sleep can't hit
+        precisely. (Or, pacing by audio, wait for playback to catch up.)
+        Records the time as SLEEP."""
+        if self.audioClock is not None:
+            self.audioClock.sync()
+        period = self.framePeriod()
+        now = monotonicTime()
+        if self.mode == PACING_AUDIO and self.audioClock is not None:
+            self.waitForAudio(period, now + MAX_AUDIO_WAIT_FRAMES * period)
+        elif period is not None:
+            if self.deadline is None or now - self.deadline > MAX_FRAMES_BEHIND * period:
+                self.deadline = now
+            self.deadline += period
+            sleepFor = self.deadline - now - SPIN_SECONDS
+            if sleepFor > 0:
+                time.sleep(sleepFor)
+            now = monotonicTime()
+            while now < self.deadline:
+                now = monotonicTime()
+        self.mark(SLEEP)
+
+    def waitForAudio(self, period, giveUp):
+        """Sleep until audio playback catches up to the target latency, or
+        until giveUp. Running the next frame will put the emulator a whole
+        period further ahead, so wait for half a period under the target:
+        that keeps the latency on target on average, which is what the
+        audio clock aims for."""
+        while True:
+            surplus = self.audioClock.audioSurplus()
+            if surplus is None:
+                return
+            surplus += period / 2.0
+            if surplus <= 0:
+                return
+            # Playback catches up in real time
+            sleepFor = min(surplus, giveUp - monotonicTime())
+            if sleepFor <= 0:
+                return
+            time.sleep(sleepFor)
+
+    def audioStatus(self):
+        "A line about the audio clock's latency and counters, or None"
+        if self.audioClock is None:
+            return None
+        stats = self.audioClock.audioStats()
+        if stats is None:
+            return None
+        return ("Audio: %.1fms behind (target %.1fms), playback rate %.4f, "
+                "%d underruns, %d overruns, %d writes dropped") % (
+            stats.latency * 1000.0,
+            self.audioClock.targetLatency() * 1000.0,
+            stats.playbackRate, stats.underruns, stats.overruns,
+            stats.droppedWrites)
+
+    def report(self):
+        """Returns the timing histogram as a table, and the audio status
+        if there is any."""
+        report = self.histogram.report()
+        audio = self.audioStatus()
+        if audio is not None:
+            report += "\n" + audio
+        return report
@@ -23,16 +23,42 @@ PALETTE = np.array([
     (160, 214, 228),  (160, 162, 160),  (  0,   0,   0),  (  0,   0,   0)  # $3c
 ], dtype='uint8')
 
-# PALETTE_BYTES = PALETTE[:].tobytes()
+# PPUMASK's top three bits emphasize red, green, and blue. We
+# approximate emphasis by darkening the channels that aren't
+# emphasized.
+EMPHASIS_VARIANTS = 8
+EMPHASIS_ATTENUATION = 0.75
 
-# # some ugly code here as I figure out the best format to have this in
-# RGBA_PALETTE_BYTEENTRIES = []
-# for (r,g,b) in PALETTE:
-#     RGBA_PALETTE_BYTEENTRIES.append(chr(r) + chr(g) + chr(b) + chr(255))
+def emphasize(rgb, emphasis):
+    """Apply color emphasis bits (bit 0 red, bit 1 green, bit 2 blue) to
+    an array of RGB bytes."""
+    out = rgb.astype('float32')
+    for channel in xrange(3):
+        if emphasis and not (emphasis & (1 << channel)):
+            out[..., channel] *= EMPHASIS_ATTENUATION
+    return out.round().astype('uint8')
+
+# PALETTE as opaque RGBA entries for every emphasis setting, indexed
+# by [emphasis, palette index]. Index this with an array of palette
+# indexes to convert a whole local palette or tile at once.
+RGBA_PALETTES = np.array([
+    np.hstack((emphasize(PALETTE, e),
+               np.full((len(PALETTE), 1), 255, dtype='uint8')))
+    for e in xrange(EMPHASIS_VARIANTS)], dtype='uint8')
+RGBA_PALETTE = RGBA_PALETTES[0]
+# The same, as floats in [0, 1]
+FLOAT_RGBA_PALETTE = RGBA_PALETTE.astype('float32') / 255.0
+
+TRANSPARENT = np.zeros(4, dtype='uint8')
 
 def palette(index):
     return PALETTE[index,:]
 
-# def smallPaletteBytes(bg, paletteData):
-#     # excessively long but I don't want to look up library functions
-#     return PALETTE[[bg, paletteData[0], paletteData[1], paletteData[2]],:].tobytes()
+def rgbaLookup(paletteData, emphasis = 0):
+    """Returns a 4x4 lookup table mapping a tile's 2-bit color indexes
+    to RGBA bytes. Color 0 is transparent; colors 1-3 come from the
+    three palette indexes in paletteData."""
+    out = np.empty((4, 4), dtype='uint8')
+    out[0] = TRANSPARENT
+    out[1:] = RGBA_PALETTES[emphasis, [p & 0x3f for p in paletteData[:3]]]
+    return out
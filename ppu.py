@@ -1,5 +1,8 @@
 import sys
 
+import numpy as np
+
+import mem
 import palette
 import ppucache
 from rom import MirrorMode
@@ -47,9 +50,17 @@ MAX_SPRITES = 8 # maximum number of sprites displayed per scanline
 BG_PALETTE_BASE = 0x3f00
 SPRITE_PALETTE_BASE = 0x3f10
 
+NAMETABLE_BASE = 0x2000
+NAMETABLE_SIZE = 0x400
+ATTRIBUTE_TABLE_OFFSET = 0x3c0 # offset of the attribute table in a nametable
+
+# PPUMASK bits that turn on rendering (background and sprites)
+RENDER_MASK = (1 << 3) | (1 << 4)
+
 class PPU(object):
 
-    def __init__(self, cpu, mirroring, ppu_debug = False):
+    def __init__(self, cpu, mirroring, ppu_debug = False, renderer = None,
+                 pacer = None):
         self.cpu = cpu
         self.mirroring = mirroring
         self.ppu_debug = ppu_debug or FORCE_PPU_DEBUG
@@ -64,8 +75,14 @@ class PPU(object):
         # don't think that's worth emulating
         self.latch = 0x0
 
-        self.oam = ['\x00' for i in range(OAM_SIZE)]
-        self.paletteRam = ['\x00' for i in range(PALETTE_SIZE)]
+        self.oam = bytearray(OAM_SIZE)
+        # Bumped on every OAM write, so the screen can tell whether it
+        # needs to rebuild its sprites
+        self.oamVersion = 0
+        self.paletteRam = bytearray(PALETTE_SIZE)
+        # Incremented whenever palette RAM changes. Cached palette
+        # dumps are tagged with the version they were built from.
+        self.paletteVersion = 0
 
         ## PPUCTRL flags
 
@@ -113,12 +130,25 @@ class PPU(object):
 
         ## PPUDATA
         self.ppuDataBuffer = 0
+        # PPUDATA writes made outside of rendering are collected here
+        # and applied together the next time anything could observe
+        # them. Each run is [start address, address step, bytes].
+        self.ppuWriteRuns = []
 
         ## Sprite-relevant state
         self.spritesThisScanline = [None for i in range(MAX_SPRITES)]
         self.nSpritesThisScanline = 0
 
         ## Background tile caches
+        # Nametable offset ranges (start, end) whose tiles need to be
+        # copied to the screen by updateBgTiles
+        self.dirtyBgRanges = []
+        self.allBgDirty = True
+        # Nametable banks that updateBgTiles last copied from
+        self.lastNametablePages = None
+        # Bumped whenever updateBgTiles writes the screen's tile and
+        # palette index buffers
+        self.bgTilesVersion = 0
         self.bglowbyte = 0
         self.bghighbyte = 0
         self.bgpalette = [0,0,0] # global palette indexes for numbers 1, 2, and 3
@@ -130,8 +160,13 @@ class PPU(object):
 
         self.sleepUntil(VBLANK_START, self.vblankStart)
 
-        from screen import Screen # herp derp circular import
-        self.pgscreen = Screen(self)
+        # herp derp circular import
+        import screen
+        if renderer == screen.RENDERER_SOFTWARE:
+            from softscreen import SoftwareScreen as Screen
+        else:
+            from screen import Screen
+        self.pgscreen = Screen(self, pacer)
 
     def readReg(self, register):
         # Set the latch, then return it. Write-only registers just set
@@ -164,7 +199,7 @@ class PPU(object):
         elif register == REG_OAMDATA:
             # TODO: if (oamaddr % 4) == 3, report that bits 2-4 are 0
             # see http://wiki.nesdev.com/w/index.php/PPU_OAM
-            self.latch = ord(self.oam[self.oamaddr])
+            self.latch = self.oam[self.oamaddr]
         elif register == REG_PPUSCROLL:
             if self.ppu_debug:
                 print >> sys.stderr, 'Warning: read from PPUSCROLL'
@@ -172,6 +207,7 @@ class PPU(object):
             if self.ppu_debug:
                 print >> sys.stderr, 'Warning: read from PPUADDR'
         elif register == REG_PPUDATA:
+            self.flushPpuWrites()
             # do not question the PPUDATA post-fetch read buffer
             if self.ppuaddr < 0x3f00:
                 self.latch = self.ppuDataBuffer
@@ -245,7 +281,8 @@ class PPU(object):
         elif register == REG_OAMADDR:
             self.oamaddr = val
         elif register == REG_OAMDATA:
-            self.oam[self.oamaddr] = chr(val)
+            self.oam[self.oamaddr] = val
+            self.oamVersion += 1
             self.oamaddr = (self.oamaddr + 1) % OAM_SIZE
         elif register == REG_PPUSCROLL:
             # TODO: During rendering, the first write to PPUSCROLL
@@ -283,6 +320,7 @@ class PPU(object):
             # vertical scrolling anywhere; it is the only way to
             # change horiz. scrolling during a scanline or vert.
             # scrolling during a frame.
+            self.flushPpuWrites()
             if self.nextAddr == 0:
                 # addresses past $3fff are mirrored down
                 self.addrHigh = val & 0x3f
@@ -299,11 +337,42 @@ class PPU(object):
                 self.maintainScroll()
 
         elif register == REG_PPUDATA:
-            self.cpu.mem.ppuWrite(self.ppuaddr, val)
+            if self.isRendering():
+                self.flushPpuWrites()
+                self.cpu.mem.ppuWrite(self.ppuaddr, val)
+            else:
+                self.bufferPpuWrite(self.ppuaddr, val)
             self.advanceVram()
         else:
             raise RuntimeError("PPU write to bad register %x" % register)
 
+    def isRendering(self):
+        """Returns true if the PPU is drawing the frame right now."""
+        if not (self.maskState & RENDER_MASK):
+            return False
+        cycle = self.fineCycle() % CYCLES_PER_FRAME
+        return not (VBLANK_START <= cycle < VBLANK_END)
+
+    def bufferPpuWrite(self, address, val):
+        """Queue a PPUDATA write, extending the last run of writes if
+        this one continues it."""
+        step = 32 if self.vramInc else 1
+        if self.ppuWriteRuns:
+            run = self.ppuWriteRuns[-1]
+            if run[1] == step and run[0] + step * len(run[2]) == address:
+                run[2].append(val)
+                return
+        self.ppuWriteRuns.append([address, step, bytearray((val,))])
+
+    def flushPpuWrites(self):
+        """Apply any queued PPUDATA writes to PPU memory. Call this
+        before anything looks at PPU memory."""
+        if self.ppuWriteRuns:
+            runs = self.ppuWriteRuns
+            self.ppuWriteRuns = []
+            for (address, step, data) in runs:
+                self.cpu.mem.ppuWriteRun(address, step, data)
+
     def advanceVram(self):
         # TODO: advancing vram (on reads or writes to REG_PPUDATA)
         # during rendering does bizarre things to the scroll values.
@@ -347,8 +416,10 @@ class PPU(object):
         assert ((lowplane & 8) == 0)
         highplane = lowplane | 8 # set bit 3 for high dataplane
 
-        lowbyte = ord(self.cpu.mem.ppuRead(lowplane))
-        highbyte = ord(self.cpu.mem.ppuRead(highplane))
+        # both planes are always on the same page
+        page = self.cpu.mem.ppuPages[lowplane >> mem.PPU_PAGE_SHIFT]
+        lowbyte = page[lowplane & mem.PPU_PAGE_MASK]
+        highbyte = page[highplane & mem.PPU_PAGE_MASK]
 
         return (lowbyte,highbyte)
 
@@ -378,69 +449,112 @@ class PPU(object):
         coarseScrollY = (self.nametableBase // 2) * 240
         return coarseScrollY + self.fineScrollY
 
-    def updateBgTiles(self):
-        for tilecolumn in xrange(self.tileColumns()):
-            for tilerow in xrange(self.tileRows()):
-                ## BACKGROUND
-
-                # Grab data from nametable to find pattern table
-                # entry. There are 30*32 bytes in a pattern table, and
-                # each byte corresponds to an 8*8-pixel tile.
-
-                # We can pull 8 horizontally-continguous pixels at
-                # once: we have a low-plane byte with the low-plane
-                # bits for 8 pixels, and a high-plane byte with the
-                # high-plane bits for the same 8 pixels. Finally, we
-                # need to grab the background palette from the
-                # attribute table.
-
-                # This function copies over both background
-                # nametables, ignoring the scroll data (both the low
-                # bits from PPUSCROLL and the high bits from PPUCTRL).
-
-                # TODO: remove assumption that there are exactly two
-                # background nametables
-
-                # Ignore the nametableBase setting from PPUCTRL here:
-                # it'll become the high bits for scrolling.
-                nametableBase = 0
-                if (tilecolumn >= (VISIBLE_COLUMNS / 8)):
-                    nametableBase += 1
-                if (tilerow >= (VISIBLE_SCANLINES / 8)):
-                    nametableBase += 2
-
-                nametable = 0x2000 + 0x400 * nametableBase # TODO don't use magic numbers
-                wrappedColumn = tilecolumn % (VISIBLE_COLUMNS / 8)
-                wrappedRow = tilerow % (VISIBLE_SCANLINES / 8)
-                nametableEntry = nametable + wrappedColumn + wrappedRow * 32
-                ptabTile = ord(self.cpu.mem.ppuRead(nametableEntry))
-
-                # TODO don't use magic numbers
-                attributeRow = wrappedRow // 4
-                attributeColumn = wrappedColumn // 4
-                attributeTable = nametable + 0x3C0
-                attributeTableEntry = attributeTable + attributeColumn + attributeRow * 8
-                attributeTile = ord(self.cpu.mem.ppuRead(attributeTableEntry))
-
-                # The attributeTile byte divides the 32x32 tile into
-                # four 16x16 quarter-tiles. Bits 0-1 specify the
-                # palette for the top-left quarter-tile, bits 2-3 are
-                # the top-right, bits 4-5 are the bottom-left, and
-                # bits 6-7 are the bottom-right.
-                paletteOffset = 0
-                if (wrappedColumn % 4) >= 2:
-                    paletteOffset += 1*2
-                if (wrappedRow % 4) >= 2:
-                    paletteOffset += 2*2
+    def displayedNametables(self):
+        """Returns the nametables (0-3) that updateBgTiles copies to the
+        screen, given how many tile rows and columns it has."""
+        return [n for n in xrange(4)
+                if (n % 2) * (VISIBLE_COLUMNS / 8) < self.tileColumns()
+                and (n // 2) * (VISIBLE_SCANLINES / 8) < self.tileRows()]
 
+    def updateBgTiles(self):
+        ppuPages = self.cpu.mem.ppuPages
+        nametablePages = ppuPages[mem.NAMETABLE_PAGE:
+                                  mem.NAMETABLE_PAGE + mem.NAMETABLE_PAGES]
+        # Remapping the nametables (say, by changing mirroring)
+        # changes every tile
+        if (self.lastNametablePages is None or
+            any(a is not b for (a, b) in zip(nametablePages, self.lastNametablePages))):
+            self.allBgDirty = True
+        if self.allBgDirty:
+            offsets = xrange(ATTRIBUTE_TABLE_OFFSET)
+        else:
+            offsets = self.dirtyBgOffsets()
+        self.allBgDirty = False
+        self.dirtyBgRanges = []
+        self.lastNametablePages = nametablePages
+        if not len(offsets):
+            return
+
+        nametables = self.displayedNametables()
+        tileIndices = self.pgscreen.tileIndices
+        paletteIndices = self.pgscreen.paletteIndices
+        # Games often rewrite tiles with what's already there, and the
+        # screen only needs to hear about real changes
+        oldTileIndices = tileIndices.copy()
+        oldPaletteIndices = paletteIndices.copy()
+        for nametableEntry in offsets:
+            ## BACKGROUND
+
+            # Grab data from nametable to find pattern table
+            # entry. There are 30*32 bytes in a pattern table, and
+            # each byte corresponds to an 8*8-pixel tile.
+
+            # We can pull 8 horizontally-continguous pixels at
+            # once: we have a low-plane byte with the low-plane
+            # bits for 8 pixels, and a high-plane byte with the
+            # high-plane bits for the same 8 pixels. Finally, we
+            # need to grab the background palette from the
+            # attribute table.
+
+            # This function copies over the background nametables,
+            # ignoring the scroll data (both the low bits from
+            # PPUSCROLL and the high bits from PPUCTRL). It only
+            # copies tiles that have changed since the last call.
+            wrappedColumn = nametableEntry % 32
+            wrappedRow = nametableEntry // 32
+
+            # TODO don't use magic numbers
+            attributeRow = wrappedRow // 4
+            attributeColumn = wrappedColumn // 4
+            attributeTableEntry = ATTRIBUTE_TABLE_OFFSET + attributeColumn + attributeRow * 8
+
+            # The attributeTile byte divides the 32x32 tile into
+            # four 16x16 quarter-tiles. Bits 0-1 specify the
+            # palette for the top-left quarter-tile, bits 2-3 are
+            # the top-right, bits 4-5 are the bottom-left, and
+            # bits 6-7 are the bottom-right.
+            paletteOffset = 0
+            if (wrappedColumn % 4) >= 2:
+                paletteOffset += 1*2
+            if (wrappedRow % 4) >= 2:
+                paletteOffset += 2*2
+
+            # Ignore the nametableBase setting from PPUCTRL here:
+            # it'll become the high bits for scrolling.
+            for nametableBase in nametables:
+                nametable = nametablePages[nametableBase]
+                ptabTile = nametable[nametableEntry]
+                attributeTile = nametable[attributeTableEntry]
                 paletteNumber = (attributeTile >> paletteOffset) & 0x3
 
-                self.pgscreen.tileIndices[tilecolumn][tilerow] = ptabTile
-                self.pgscreen.paletteIndices[tilecolumn][tilerow] = paletteNumber
+                tilecolumn = wrappedColumn + (nametableBase % 2) * (VISIBLE_COLUMNS / 8)
+                tilerow = wrappedRow + (nametableBase // 2) * (VISIBLE_SCANLINES / 8)
+                tileIndices[tilecolumn, tilerow] = ptabTile
+                paletteIndices[tilecolumn, tilerow] = paletteNumber
+
+        if not (np.array_equal(tileIndices, oldTileIndices) and
+                np.array_equal(paletteIndices, oldPaletteIndices)):
+            self.bgTilesVersion += 1
+
+    def dirtyBgOffsets(self):
+        """Merge the dirty background ranges and return the nametable
+        offsets they cover, in order."""
+        ranges = sorted(self.dirtyBgRanges)
+        merged = []
+        for (start, end) in ranges:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        out = []
+        for (start, end) in merged:
+            out.extend(xrange(start, min(end, ATTRIBUTE_TABLE_OFFSET)))
+        return out
 
     def vblankStart(self):
         if self.ppu_debug:
             print "Starting vblank"
+        self.flushPpuWrites()
         self.draw()
         self.vblank = 1
         if self.vblankNMI:
@@ -452,6 +566,7 @@ class PPU(object):
         if self.ppu_debug:
             print "Ending vblank"
         self.vblank = 0
+        self.flushPpuWrites()
         self.updateBgTiles()
         # It's possible that we're supposed to reset sprite 0 one
         # frame earlier, but I don't want to look up the details right
@@ -468,6 +583,7 @@ class PPU(object):
         self.cycle = -1
         if self.ppu_debug:
             print "BEGIN PPU FRAME %d" % self.frame
+        self.flushPpuWrites()
         sprite0hit = self.findSprite0Hit()
         if sprite0hit < 0:
             self.sleepUntil(VBLANK_START, self.vblankStart)
@@ -534,51 +650,50 @@ class PPU(object):
         # background next frame. Currently this does nothing.
         pass
 
-    def flushBgTile(self, tileX, tileY):
-        # Currently this does nothing.
-
-        # Clear our background tile cache for a single tile. This
-        # should be called when we write to the PPU nametable address
-        # corresponding to our active nametable. For now I'm going to
-        # have the memory management code deal with that - that's
-        # going to involve some weird interplay between the two
-        # modules, so I might want to reorganize that eventually.
-
-        # first make sure we're not actually writing to the attribute table
-        if tileY < VISIBLE_SCANLINES / 8:
-            pass
-        else:
-            # if we are, just flush everything to be safe
-            self.flushBgCache()
-            pass
+    def flushBgRange(self, start, end):
+        """Invalidate the background tiles for the nametable addresses
+        from start up to (but not including) end."""
+        if end - start >= NAMETABLE_SIZE:
+            self.allBgDirty = True
+            return
+        # Fold the range into offsets within a single nametable. Every
+        # nametable is invalidated at those offsets, which is cheaper
+        # to track than working out which ones are actually mapped to
+        # the address.
+        startOffset = (start - NAMETABLE_BASE) % NAMETABLE_SIZE
+        endOffset = startOffset + (end - start)
+        if endOffset > NAMETABLE_SIZE:
+            # we wrapped around into the next nametable
+            self.flushBgOffsets(0, endOffset - NAMETABLE_SIZE)
+            endOffset = NAMETABLE_SIZE
+        self.flushBgOffsets(startOffset, endOffset)
+
+    def flushBgOffsets(self, startOffset, endOffset):
+        if startOffset < ATTRIBUTE_TABLE_OFFSET:
+            self.dirtyBgRanges.append(
+                (startOffset, min(endOffset, ATTRIBUTE_TABLE_OFFSET)))
+        # Each attribute byte covers a 4x4 block of tiles
+        for attributeEntry in xrange(max(startOffset, ATTRIBUTE_TABLE_OFFSET) - ATTRIBUTE_TABLE_OFFSET,
+                                     endOffset - ATTRIBUTE_TABLE_OFFSET):
+            attributeRow = attributeEntry // 8
+            attributeColumn = attributeEntry % 8
+            for tileRow in xrange(attributeRow * 4, min(attributeRow * 4 + 4, VISIBLE_SCANLINES / 8)):
+                rowStart = tileRow * 32 + attributeColumn * 4
+                self.dirtyBgRanges.append((rowStart, rowStart + 4))
 
     def dumpPtab(self, base):
         """Returns a string of bytes representing the specified half of the pattern table. The bytes are stored in a large atlas texture of dimension 8*256 by 8."""
-        # this might be a bit slow for now, but it shouldn't be called
-        # much, at least for early games. If I want to figure out the
-        # details, it should be possible to directly dump the memory
-        # into the string, maybe given some sort of transformation.
-        out = bytearray(256*8*8)
-        for tile in xrange(256):
-            for y in xrange(8):
-                (lowbyte, highbyte) = self.readPtab(base, y, tile)
-                for x in xrange(8):
-                    lowbit = (lowbyte >> (7-x)) & 1
-                    highbit = (highbyte >> (7-x)) & 1
-                    pixel = lowbit + 2 * highbit
-                    out[x + 8*256*y + 8*tile] = pixel
-        return str(out)
+        return self.cache.ptabAtlas(base).tobytes()
 
     def dumpLocalPalettes(self, base):
-        """Returns a list of floats representing the local palette starting at the base."""
-        out = [0.0 for i in range(16*4)]
-        for i in range(16):
-            if (i % 4) == 0:
-                continue
-            paletteIndex = ord(self.cpu.mem.ppuRead(base + i))
-            out[4*i:(4*i)+3] = [float(x)/255.0 for x in palette.palette(paletteIndex)] # rgb
-            out[(4*i)+3] = 1.0 # alpha
-        return out
+        """Returns an array of 16*4 floats representing the local palette
+        starting at the base, as RGBA entries. The array is cached
+        until palette RAM changes, so callers shouldn't modify it."""
+        return self.cache.localPalettes(base)
+
+    def dumpLocalPalettesRGBA(self, base):
+        """Like dumpLocalPalettes, but returns a 16x4 array of RGBA bytes."""
+        return self.cache.localPalettesRGBA(base)
 
 
     # Find the cycle where a sprite 0 hit occurs this frame. If there
@@ -594,7 +709,7 @@ class PPU(object):
                 print "No sprite 0 hit"
             return -1
 
-        spritetop = ord(self.oam[0]) + 1
+        spritetop = self.oam[0] + 1
         # TODO account for 8x16 sprites
 
         if spritetop >= 0xf0:
@@ -603,9 +718,9 @@ class PPU(object):
                 print "No sprite 0 hit"
             return -1
 
-        tileIndex = ord(self.oam[1])
-        attributes = ord(self.oam[2])
-        spriteX = ord(self.oam[3])
+        tileIndex = self.oam[1]
+        attributes = self.oam[2]
+        spriteX = self.oam[3]
         horizontalMirror = bool(attributes & 0x40)
         verticalMirror = bool(attributes & 0x80)
         # Note: palette is irrelevant for sprite 0 hits
@@ -1,5 +1,31 @@
+import numpy as np
+
+import mem
 import palette
 
+# Number of entries in a set of four local palettes
+LOCAL_PALETTE_ENTRIES = 16
+
+PATTERN_TABLE_TILES = 256
+PATTERN_TABLE_SIZE = 0x1000 # bytes in each half of the pattern table
+TILE_BYTES = 16
+CHR_BANK_TILES = mem.PPU_PAGE_SIZE / TILE_BYTES
+
+def decodeTiles(raw):
+    """Decode an array of raw pattern table bytes into an array of
+    color indexes (0-3), indexed by [tile, y, x]."""
+    # Each tile is 16 bytes: eight bytes of the low bit plane (one
+    # per row), then eight of the high bit plane. The most
+    # significant bit of each byte is the leftmost pixel.
+    # [tile, plane, y] -> [tile, plane, y, x]
+    planes = np.unpackbits(raw.reshape(-1, 2, 8, 1), axis=3)
+
+    # TODO decide where to handle grayscale
+    # if self.grayscale:
+    #     colorindex &= 0x30
+
+    return planes[:, 0] + 2 * planes[:, 1]
+
 class PPUCache(object):
     """Caches images to be used by the PPU."""
 
@@ -7,123 +33,154 @@ class PPUCache(object):
         self.ptabCache = {}
         self.bgTileCache = {}
         self.spriteCache = {}
+        self.atlasCache = {}
+        # Maps (table name, base) to (palette version, dumped palettes)
+        self.paletteCache = {}
         self.ppu = ppu
         self.mem = ppu.cpu.mem
+        # CHR version that the pattern table caches were built from
+        self.ptabVersion = self.mem.chrVersion
+
+    def flushPtabCaches(self):
+        """Clear everything built from the pattern tables."""
+        self.ptabCache = {}
+        self.bgTileCache = {}
+        self.spriteCache = {}
+        self.atlasCache = {}
+        self.ptabVersion = self.mem.chrVersion
+
+    def checkPtabVersion(self):
+        if self.ptabVersion != self.mem.chrVersion:
+            self.flushPtabCaches()
+
+    def ptabTiles(self, base):
+        """Get every tile in the specified half of the pattern table,
+        decoded into a 256x8x8 array of color indexes (0-3), indexed by
+        [tile, y, x]. Caches results until the pattern tables change,
+        either from a CHR bank switch or a write to CHR RAM.
+
+        Args:
+            base: 0 or 1, corresponding to the relevant PPUCTRL bit.
+
+        """
+        self.checkPtabVersion()
+        if base not in self.ptabCache:
+            self.ptabCache[base] = self._fetchPtabTiles(base)
+        return self.ptabCache[base]
 
     def ptabTile(self, base, tile):
-        """Get the tile from the specified pattern table entry as a byte
-        array. Caches results, assuming that pattern tables are stored
-        in ROM and never remapped.
+        """Get the tile from the specified pattern table entry as an 8x8
+        array of color indexes (0-3), indexed by [y, x].
 
         Args:
             base: 0 or 1, corresponding to the relevant PPUCTRL bit.
             tile: A byte specifying the tile, corresponding to the
                   nametable entry.
-        Returns:
-            The PIL palette-mode image for the tile.
 
         """
-        cacheIndex = tile + (base << 8)
-        if cacheIndex not in self.ptabCache:
-            self.ptabCache[cacheIndex] = self._fetchPtabTile(base, tile)
-        return self.ptabCache[cacheIndex]
-
-    def _fetchPtabTile(self, base, tile):
-        # finding pattern table entry:
-        #
-        # bits 0 through 2 are the "fine y offset", the y position
-        # within a tile (y position % 8, I guess)
-        #
-        # bit 3 is the bitplane: we'll need to read once with it
-        # set and once with it unset to get two bits of color
-        #
-        # bits 4 through 7 are the column of the tile (column / 8)
-        #
-        # bits 8 through b are the tile row (row / 8)
-        #
-        # bit c is the same as self.bgPatternTableAddr
-        #
-        # bits d through f are 0 (pattern tables go from 0000 to 1fff)
-
-        entryStart = (
-            (0    << 0 ) + # 0-2: fine y offset
-            (0    << 3 ) + # 3: dataplane
-            (tile << 4 ) + # 4-11: column and row
-            (base << 12)) # 12: pattern table base
-        # bits d through f are 0 (pattern tables go from 0000 to 1fff)
-
-        contents = bytearray(64)
-        for finey in range(8):
-            lowplane = entryStart | finey
-            highplane = lowplane | 8
-            lowbyte = ord(self.mem.ppuRead(lowplane))
-            highbyte = ord(self.mem.ppuRead(highplane))
-            for finex in range(8):
-                # most significant bit is leftmost bit
-                finexbit = 7 - finex
-
-                pixelbit0 = (lowbyte >> finexbit) & 0x1
-                pixelbit1 = (highbyte >> finexbit) & 0x1
-                colorindex = pixelbit0 + pixelbit1 * 2
-
-                # TODO decide where to handle grayscale
-                # if self.grayscale:
-                #     colorindex &= 0x30
-
-                contents[finex + finey * 8] = colorindex # TODO confirm contents index
-
-        return contents
-
-    def bgTile(self, base, tile, bg, paletteData):
-        """Get the specified tile as a byte string, given palette data."""
+        return self.ptabTiles(base)[tile]
+
+    def _fetchPtabTiles(self, base):
+        pages = self.mem.ppuPages
+        firstPage = (base * PATTERN_TABLE_SIZE) >> mem.PPU_PAGE_SHIFT
+        raw = np.concatenate([
+            np.frombuffer(pages[firstPage + i], dtype='uint8')
+            for i in xrange(PATTERN_TABLE_SIZE >> mem.PPU_PAGE_SHIFT)])
+        return decodeTiles(raw)
+
+    def chrAtlas(self):
+        """Decode every CHR bank, mapped or not, into an atlas of color
+        indexes. Each 1 KB bank is a strip 8 rows by 8*64 columns, with
+        bank n at rows 8*n through 8*n+7 and its tile t at columns 8*t
+        through 8*t+7. Not cached: it only needs rebuilding when CHR RAM
+        is written (see Memory.chrDataVersion)."""
+        banks = self.mem.chrBanks
+        raw = np.concatenate([np.frombuffer(bank, dtype='uint8') for bank in banks])
+        tiles = decodeTiles(raw).reshape(len(banks), CHR_BANK_TILES, 8, 8)
+        # [bank, tile, y, x] -> [bank, y, tile, x]
+        return tiles.transpose(0, 2, 1, 3).reshape(len(banks) * 8, CHR_BANK_TILES * 8)
+
+    def localPalettes(self, base):
+        """Get the four local palettes starting at the given PPU address as
+        a flat array of 16 RGBA float entries. Entry 0 of each palette
+        is left fully transparent. Cached until palette RAM changes."""
+        return self._cachedPalettes('float', base, palette.FLOAT_RGBA_PALETTE).ravel()
+
+    def localPalettesRGBA(self, base):
+        """Get the four local palettes starting at the given PPU address as
+        a 16x4 array of RGBA bytes. Entry 0 of each palette is left
+        fully transparent. Cached until palette RAM changes."""
+        return self._cachedPalettes('rgba', base, palette.RGBA_PALETTE)
+
+    def _cachedPalettes(self, tableName, base, table):
+        cacheIndex = (tableName, base)
+        version = self.ppu.paletteVersion
+        cached = self.paletteCache.get(cacheIndex)
+        if cached is None or cached[0] != version:
+            cached = (version, self._fetchPalettes(base, table))
+            self.paletteCache[cacheIndex] = cached
+        return cached[1]
+
+    def _fetchPalettes(self, base, table):
+        # Palette RAM only stores six bits per entry, so mask off
+        # anything above that before indexing the table.
+        indices = np.frombuffer(self.ppu.paletteRam, dtype='uint8',
+                                count=LOCAL_PALETTE_ENTRIES,
+                                offset=base & 0x1f) & 0x3f
+        out = table[indices]
+        # The first entry of each local palette is transparent: the
+        # universal background gets drawn behind it.
+        out[::4] = 0
+        return out
+
+    def bgTile(self, base, tile, bg, paletteData, emphasis = 0):
+        """Get the specified tile as a byte string of RGBA pixels, given
+        palette data."""
         # TODO bg is probably not a relevant argument anymore
-        cacheIndex = (base, tile, bg, paletteData[0], paletteData[1], paletteData[2])
+        cacheIndex = (base, tile, bg, paletteData[0], paletteData[1], paletteData[2], emphasis)
+        self.checkPtabVersion()
         if cacheIndex not in self.bgTileCache:
-            self.bgTileCache[cacheIndex] = self._pglFetchBgTile(base, tile, bg, paletteData)
+            self.bgTileCache[cacheIndex] = self._fetchBgTile(base, tile, paletteData, emphasis)
         return self.bgTileCache[cacheIndex]
 
-    def _pglFetchBgTile(self, base, tile, bg, paletteData):
-        indexedTileContents = self.ptabTile(base, tile)
-        palettebytes = palette.smallPaletteBytes(bg, paletteData)
-
-        img_bytes = bytearray(8*8*4)
-        for (i, colorIndex) in enumerate(indexedTileContents):
-            if colorIndex == 0:
-                img_bytes[i*4 : (i+1)*4] = '\x00\x00\x00\x00' # transparent
-            else:
-                img_bytes[i*4 : (i+1)*4] = palette.RGBA_PALETTE_BYTEENTRIES[paletteData[colorIndex-1]]
-
-        return str(img_bytes)
+    def _fetchBgTile(self, base, tile, paletteData, emphasis):
+        lookup = palette.rgbaLookup(paletteData, emphasis)
+        return lookup[self.ptabTile(base, tile)].tobytes()
 
-    def spriteTexture(self, base, tile, flipH, flipV, paletteData):
+    def spriteTexture(self, base, tile, flipH, flipV, paletteData, emphasis = 0):
         """Get the specified sprite as a byte string to be used in a texture."""
         # FIXME the name is kind of inaccurate now
-        cacheIndex = (base, tile, flipH, flipV, paletteData[0], paletteData[1], paletteData[2])
+        cacheIndex = (base, tile, flipH, flipV, paletteData[0], paletteData[1], paletteData[2], emphasis)
+        self.checkPtabVersion()
         if cacheIndex not in self.spriteCache:
-            self.spriteCache[cacheIndex] = self._fetchSpriteTexture(base, tile, flipH, flipV, paletteData)
+            self.spriteCache[cacheIndex] = self._fetchSpriteTexture(base, tile, flipH, flipV, paletteData, emphasis)
         return self.spriteCache[cacheIndex]
 
-    def _fetchSpriteTexture(self, base, tile, flipH, flipV, paletteData):
+    def _fetchSpriteTexture(self, base, tile, flipH, flipV, paletteData, emphasis):
         indexedSpriteContents = self.ptabTile(base, tile)
-
-        # TODO this palette-application code should probably just go in palette.py
-
-        xIndices = range(8)
+        # Flipping is just a reversed view of the tile
         if flipH:
-            xIndices.reverse()
-        yIndices = range(8)
+            indexedSpriteContents = indexedSpriteContents[:, ::-1]
         if flipV:
-            yIndices.reverse()
-
-        img_bytes = bytearray(8*8*4)
-        i = 0
-        for y in yIndices:
-            for x in xIndices:
-                colorIndex = indexedSpriteContents[x + y*8]
-                if colorIndex == 0:
-                    img_bytes[i*4 : (i+1)*4] = '\x00\x00\x00\x00' # transparent
-                else:
-                    img_bytes[i*4 : (i+1)*4] = palette.RGBA_PALETTE_BYTEENTRIES[paletteData[colorIndex-1]]
-                i += 1
-
-        return str(img_bytes)
+            indexedSpriteContents = indexedSpriteContents[::-1, :]
+        lookup = palette.rgbaLookup(paletteData, emphasis)
+        return lookup[indexedSpriteContents].tobytes()
+
+    def ptabAtlas(self, base):
+        """Get the specified half of the pattern table as an atlas of
+        color indexes, 8 rows by 8*256 columns, with tile n occupying
+        columns 8*n through 8*n+7."""
+        tiles = self.ptabTiles(base)
+        # [tile, y, x] -> [y, tile, x] -> [y, tile*8 + x]
+        return tiles.transpose(1, 0, 2).reshape(8, 8 * PATTERN_TABLE_TILES)
+
+    def rgbaAtlas(self, base, paletteData, emphasis = 0):
+        """Get the specified half of the pattern table as an 8x2048x4
+        array of RGBA bytes laid out like ptabAtlas, drawn with one local
+        palette."""
+        cacheIndex = (base, paletteData[0], paletteData[1], paletteData[2], emphasis)
+        self.checkPtabVersion()
+        if cacheIndex not in self.atlasCache:
+            lookup = palette.rgbaLookup(paletteData, emphasis)
+            self.atlasCache[cacheIndex] = lookup[self.ptabAtlas(base)]
+        return self.atlasCache[cacheIndex]
@@ -1,5 +1,7 @@
 #include "portaudio.h"
 
+#include "ApuMixer.hpp"
+#include "BlipBuffer.hpp"
 #include "PulseWave.hpp"
 
 #include <cstdio>
@@ -8,10 +10,11 @@
 
 // Default: testing with first pitch in Donkey Kong:
 // divider 427 (260.747815 Hz), 50% duty
-const float TEST_DUTY = 0.5;
+const unsigned int TEST_DUTY = 2;
 const unsigned int TEST_DIVIDER = 427;
 
 const int SAMPLE_RATE = 44100;
+const unsigned int FRAMES_PER_BUFFER = 256;
 
 const int DURATION = 3;
 
@@ -31,7 +34,11 @@ paTestData;
 
 static paTestData sdata;
 
-static PulseWave pulse((double) SAMPLE_RATE);
+static PulseWave pulse;
+static BlipBuffer blip(CPU_FREQUENCY / SAMPLE_RATE);
+static ApuMixer mixer;
+static float lastMix = 0.0;
+static float mono[FRAMES_PER_BUFFER];
 
 static int patestCallback( const void *inputBuffer, void *outputBuffer,
                            unsigned long framesPerBuffer,
@@ -44,11 +51,31 @@ static int patestCallback( const void *inputBuffer, void *outputBuffer,
     unsigned int i;
     (void) inputBuffer; /* Prevent unused variable warning. */
 
+    blip.begin(framesPerBuffer);
+    double start = blip.startCycle();
+    double end = start + framesPerBuffer * CPU_FREQUENCY / SAMPLE_RATE;
+    // The pulse on its own, as APU::synthesize would mix it
+    pulse.startRun(start);
+    double at = start;
+    while (true) {
+      float mix = mixer.output(pulse.output(), 0, 0, 0, 0);
+      if (mix != lastMix) {
+        blip.addDelta(at, mix - lastMix);
+        lastMix = mix;
+      }
+      at = pulse.nextChange();
+      if (at >= end) {
+        break;
+      }
+      pulse.step();
+    }
+    pulse.endRun(end);
+    blip.read(mono, framesPerBuffer);
     for( i=0; i<framesPerBuffer; i++ )
     {
+      data->out = mono[i];
       *out++ = data->out;
       *out++ = data->out;
-      data->out = pulse.tick() / 15.0;
       data->t += ((double)1.0/(double)SAMPLE_RATE);
     }
     return 0;
@@ -60,15 +87,20 @@ int main(int argc, char **argv) {
   if (argc >= 2) {
     divider = std::stoi(argv[1]);
   }
-  float duty = TEST_DUTY;
+  // 0-3, as in the register: 12.5%, 25%, 50% or 75%
+  unsigned int duty = TEST_DUTY;
   if (argc >= 3) {
-    duty = std::stof(argv[2]);
+    duty = std::stoi(argv[2]) & 0x3;
   }
 
 
   pulse.setDivider(divider);
   pulse.setDuty(duty);
   pulse.setEnabled(1);
+  // Hold the note: there's no frame counter to run the length counter
+  // down, but it has to be nonzero
+  pulse.setLengthCounterHalt(1);
+  pulse.setLengthCounter(1);
 
   sdata.t = 0.0;
 
@@ -83,7 +115,7 @@ int main(int argc, char **argv) {
                               2,          /* stereo output */
                               paFloat32,  /* 32 bit floating point output */
                               SAMPLE_RATE,
-                              256,        /* frames per buffer, i.e. the number
+                              FRAMES_PER_BUFFER, /* frames per buffer, i.e. the number
                                              of sample frames that PortAudio will
                                              request from the callback. Many apps
                                              may want to use
@@ -52,7 +52,6 @@ class NESRom(object):
             print "CHR ROM size: %d" % chrromsize
         else:
             print "CHR RAM"
-            print >> sys.stderr, ("WARNING: CHR RAM not implemented")
 
         print "Flags 6 (partially implemented): %s" % format(ord(header[6]), '08b')
         if ord(header[6]) & 2:
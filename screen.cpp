@@ -14,6 +14,7 @@
 using namespace std;
 
 #include "screen.hpp"
+#include "framequeue.hpp"
 #include "palette.hpp"
 
 #define INNER_STRINGIZE(x) #x
@@ -87,11 +88,11 @@ Screen::Screen(ScrollType st)
 
   glfwSetInputMode(window, GLFW_STICKY_KEYS, 1);
 
-  // bind a vertex array
-  GLuint va;
-  glGenVertexArrays(1, &va);
+  // one vertex array per shader program
+  glGenVertexArrays(1, &spriteVao);
+  glGenVertexArrays(1, &bgVao);
   checkGlErrors(0);
-  glBindVertexArray(va);
+  glBindVertexArray(spriteVao);
   checkGlErrors(0);
 
   initShaders();
@@ -99,11 +100,69 @@ Screen::Screen(ScrollType st)
 
   glGenBuffers(1, &bgVbo);
   glGenBuffers(1, &spriteVbo);
-  glGenTextures(1, &bgPtabName);
-  glGenTextures(1, &spritePtabName);
+  glGenTextures(1, &chrName);
+  glGenTextures(1, &tileIndexName);
+  glGenTextures(1, &paletteIndexName);
 
   checkGlErrors(0);
 
+  // Allocate the textures the background shader reads the tile and
+  // palette indexes through. Since the index buffers are
+  // column-major, each texture is tileRows() wide and tileColumns()
+  // tall.
+  GLuint indexNames[] = {tileIndexName, paletteIndexName};
+  GLenum indexTextures[] = {TILE_INDEX_TEXTURE, PALETTE_INDEX_TEXTURE};
+  for (int i = 0; i < 2; i++) {
+    glActiveTexture(indexTextures[i]);
+    glBindTexture(GL_TEXTURE_2D, indexNames[i]);
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST);
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST);
+    glTexImage2D(GL_TEXTURE_2D, 0, GL_R8UI, tileRows(), tileColumns(),
+                 0, GL_RED_INTEGER, GL_UNSIGNED_BYTE, NULL);
+  }
+  checkGlErrors(0);
+
+  // The background's vertex layout never changes, so set it up once
+  glBindVertexArray(bgVao);
+  glBindBuffer(GL_ARRAY_BUFFER, bgVbo);
+  glVertexAttribPointer(bgPosAttrib, 2, GL_PIXEL_COORD, GL_FALSE,
+                        sizeof(bgVertex),
+                        (const GLvoid *) offsetof(bgVertex, x_pos));
+  glEnableVertexAttribArray(bgPosAttrib);
+  glVertexAttribIPointer(bgScrollOffsetAttrib, 2, GL_SCROLL_COORD,
+                         sizeof(bgVertex),
+                         (const GLvoid *) offsetof(bgVertex, ss_x_offset));
+  glEnableVertexAttribArray(bgScrollOffsetAttrib);
+  checkGlErrors(0);
+
+  // Sprites get a fixed slot of VERTICES_PER_TILE vertices per OAM
+  // entry, which we overwrite in place as OAM changes
+  glBindVertexArray(spriteVao);
+  glBindBuffer(GL_ARRAY_BUFFER, spriteVbo);
+  glBufferData(GL_ARRAY_BUFFER,
+               OAM_ENTRIES * VERTICES_PER_TILE * sizeof(glVertex),
+               NULL, GL_DYNAMIC_DRAW);
+  int stride = sizeof(glVertex);
+  glVertexAttribPointer(posAttrib, 2, GL_PIXEL_COORD, GL_FALSE, stride,
+                        (const GLvoid *) offsetof(glVertex, x_pos));
+  glEnableVertexAttribArray(posAttrib);
+  glVertexAttribPointer(priorityAttrib, 1, GL_FLOAT, GL_FALSE, stride,
+                        (const GLvoid *) offsetof(glVertex, priority));
+  glEnableVertexAttribArray(priorityAttrib);
+  glVertexAttribPointer(tileAttrib, 1, GL_PTAB_TILE_COORD, GL_FALSE, stride,
+                        (const GLvoid *) offsetof(glVertex, tile));
+  glEnableVertexAttribArray(tileAttrib);
+  glVertexAttribPointer(uvAttrib, 2, GL_PTAB_UV_COORD, GL_FALSE, stride,
+                        (const GLvoid *) offsetof(glVertex, u));
+  glEnableVertexAttribArray(uvAttrib);
+  glVertexAttribPointer(paletteNAttrib, 1, GL_UNSIGNED_BYTE, GL_FALSE, stride,
+                        (const GLvoid *) offsetof(glVertex, palette));
+  glEnableVertexAttribArray(paletteNAttrib);
+  glVertexAttribIPointer(visibleRowsAttrib, 1, GL_UNSIGNED_BYTE, stride,
+                         (const GLvoid *) offsetof(glVertex, visible_rows));
+  glEnableVertexAttribArray(visibleRowsAttrib);
+  checkGlErrors(0);
+
   lastBgPalette = -1;
   lastSpritePalette = -1;
 
@@ -117,27 +176,48 @@ Screen::Screen(ScrollType st)
   // There is a more c++ style way to get the array lengths here. Eh.
   memset(bgPalettes, 0, LOCAL_PALETTES_LENGTH * sizeof(float));
   memset(spritePalettes, 0, LOCAL_PALETTES_LENGTH * sizeof(float));
-  memset(oam, 0, OAM_SIZE);
-
-  vector<float> zeroPtab(PATTERN_TABLE_LENGTH, 0);
-  setBgPatternTable(zeroPtab);
-  setSpritePatternTable(zeroPtab);
+  // Python hands OAM over with setOamBuffer
+  oam = NULL;
+  oamDirty = true;
+  lastOamVersion = 0;
+  allSpritesStale = true;
+  // Nothing's been uploaded yet
+  bgQuadsStale = true;
+  indexTexturesStale = true;
+  bgTilesVersion = 0;
+  lastBgTilesVersion = 0;
+  paletteVersion = 0;
+  bgUniforms.valid = false;
+  spriteUniforms.valid = false;
+  skippedUploads = 0;
+  haveDrawnFrame = false;
+
+  // Start with one blank pattern table's worth of CHR
+  vector<unsigned char> zeroChr(CHR_PAGES * CHR_BANK_WIDTH * 8, 0);
+  setChrBanks(zeroChr.data(), CHR_PAGES);
+  bgPatternTable = 0;
+  spritePatternTable = 0;
+  for (int i = 0; i < CHR_PAGES; i++) {
+    chrPages[i] = i;
+  }
 
   // set up state
 
   setupFrame();
 
-  // there's probably a cleaner c++ way to do this
-  tileIndices.resize(tileColumns());
-  paletteIndices.resize(tileColumns());
-  for (int i = 0; i < tileColumns(); i++) {
-    tileIndices[i].resize(tileRows());
-    paletteIndices[i].resize(tileRows());
-  }
+  // Python hands these over with setIndexBuffers
+  tileIndices = NULL;
+  paletteIndices = NULL;
 
   setUniversalBg(0);
 
-  spriteVertices.reserve(OAM_ENTRIES * 6);
+  spriteVertices.resize(OAM_ENTRIES * VERTICES_PER_TILE);
+  for (int pass = 0; pass < SPRITE_PASSES; pass++) {
+    spriteFirsts[pass].reserve(OAM_ENTRIES);
+    spriteCounts[pass].reserve(OAM_ENTRIES);
+  }
+  // A scroll region takes at most three quads
+  bgQuads.reserve(MAX_SCROLL_REGIONS * 3 * VERTICES_PER_TILE);
 }
 
 ntab_coord Screen::tileRows() {
@@ -193,48 +273,35 @@ GLint safeGetUniformLocation(GLuint program, const GLchar *name) {
 }
 
 // doesn't return an error message, just exits the program on error
-void Screen::initShaders(void) {
-  // get shaders
-  ifstream vertFile(VERTEX_SHADER_FILE);
-  if (!vertFile) {
-    cerr << "Couldn't open vertex shader file\n";
+GLuint compileShader(GLenum type, const char *file) {
+  ifstream srcFile(file);
+  if (!srcFile) {
+    cerr << "Couldn't open shader file " << file << "\n";
     die();
   }
-  stringstream vertBuffer;
-  vertBuffer << vertFile.rdbuf();
+  stringstream srcBuffer;
+  srcBuffer << srcFile.rdbuf();
   // This approach makes the string turn into the empty string for some reason
-  // const char *vertSrc = vertBuffer.str().c_str();
-  string vertStr = vertBuffer.str();
-  const char *vertSrc = vertStr.c_str();
+  // const char *src = srcBuffer.str().c_str();
+  string srcStr = srcBuffer.str();
+  const char *src = srcStr.c_str();
   // TODO error-check and make sure the file isn't too big
-  int vertSrcLen = (int) vertStr.length();
-  ifstream fragFile(FRAGMENT_SHADER_FILE);
-  if (!fragFile) {
-    cerr << "Couldn't open fragment shader file\n";
-    die();
-  }
-  stringstream fragBuffer;
-  fragBuffer << fragFile.rdbuf();
-  string fragStr = fragBuffer.str();
-  const char *fragSrc = fragStr.c_str();
-  int fragSrcLen = (int) fragStr.length();
-
+  int srcLen = (int) srcStr.length();
 
-  // compile shaders
-  GLuint vertexShader = glCreateShader(GL_VERTEX_SHADER);
-  glShaderSource(vertexShader, 1, &vertSrc, &vertSrcLen);
-  glCompileShader(vertexShader);
+  GLuint shader = glCreateShader(type);
+  glShaderSource(shader, 1, &src, &srcLen);
+  glCompileShader(shader);
   // check compilation
   GLint status;
-  glGetShaderiv(vertexShader, GL_COMPILE_STATUS, &status);
+  glGetShaderiv(shader, GL_COMPILE_STATUS, &status);
   if (!status) {
-    cerr << "Error compiling vertex shader:\n";
+    cerr << "Error compiling shader " << file << ":\n";
     GLint logLen = 0;
-    glGetShaderiv(vertexShader, GL_INFO_LOG_LENGTH, &logLen);
+    glGetShaderiv(shader, GL_INFO_LOG_LENGTH, &logLen);
     if (logLen > 1) {
       GLchar *log = (GLchar*) malloc(logLen);
       GLint readLogLen = 0;
-      glGetShaderInfoLog(vertexShader, logLen, &readLogLen, log);
+      glGetShaderInfoLog(shader, logLen, &readLogLen, log);
       // FIXME should probably only print logLen chars here just to be safe
       cout << log;
     } else {
@@ -242,42 +309,30 @@ void Screen::initShaders(void) {
     }
     die();
   }
+  return shader;
+}
 
-  GLuint fragmentShader = glCreateShader(GL_FRAGMENT_SHADER);
-  glShaderSource(fragmentShader, 1, &fragSrc, &fragSrcLen);
-  glCompileShader(fragmentShader);
-  glGetShaderiv(fragmentShader, GL_COMPILE_STATUS, &status);
-  if (!status) {
-    cerr << "Error compiling fragment shader:\n";
-    GLint logLen = 0;
-    glGetShaderiv(fragmentShader, GL_INFO_LOG_LENGTH, &logLen);
-    if (logLen > 1) {
-      GLchar *log = (GLchar*) malloc(logLen);
-      GLint readLogLen = 0;
-      glGetShaderInfoLog(fragmentShader, logLen, &readLogLen, log);
-      // FIXME should probably only print logLen chars here just to be safe
-      cout << log;
-    } else {
-      cerr << "Couldn't get log message\n";
-    }
-    die();
-  }
+// doesn't return an error message, just exits the program on error
+GLuint Screen::loadProgram(const char *vertexFile, const char *fragmentFile) {
+  GLuint vertexShader = compileShader(GL_VERTEX_SHADER, vertexFile);
+  GLuint fragmentShader = compileShader(GL_FRAGMENT_SHADER, fragmentFile);
 
   // link shader program
-  shader = glCreateProgram();
-  glAttachShader(shader, vertexShader);
-  glAttachShader(shader, fragmentShader);
-  glLinkProgram(shader);
+  GLuint program = glCreateProgram();
+  glAttachShader(program, vertexShader);
+  glAttachShader(program, fragmentShader);
+  glLinkProgram(program);
 
-  glGetProgramiv(shader, GL_LINK_STATUS, &status);
+  GLint status;
+  glGetProgramiv(program, GL_LINK_STATUS, &status);
   if (!status) {
     cerr << "Error linking shader:\n";
     GLint logLen = 0;
-    glGetProgramiv(shader, GL_INFO_LOG_LENGTH, &logLen);
+    glGetProgramiv(program, GL_INFO_LOG_LENGTH, &logLen);
     if (logLen > 1) {
       GLchar *log = (GLchar*) malloc(logLen);
       GLint readLogLen = 0;
-      glGetProgramInfoLog(shader, logLen, &readLogLen, log);
+      glGetProgramInfoLog(program, logLen, &readLogLen, log);
       // FIXME should probably only print logLen chars here just to be safe
       cout << log;
     } else {
@@ -285,6 +340,36 @@ void Screen::initShaders(void) {
     }
     die();
   }
+  checkGlErrors(0);
+  return program;
+}
+
+// doesn't return an error message, just exits the program on error
+void Screen::initShaders(void) {
+  bgShader = loadProgram(BG_VERTEX_SHADER_FILE, BG_FRAGMENT_SHADER_FILE);
+
+  glUseProgram(bgShader);
+  checkGlErrors(0);
+
+  bgPosAttrib = safeGetAttribLocation(bgShader, "pos");
+  bgScrollOffsetAttrib = safeGetAttribLocation(bgShader, "scrollOffset");
+
+  bgChrBanksUniform = safeGetUniformLocation(bgShader, "chrBanks");
+  bgPatternTableBaseUniform = safeGetUniformLocation(bgShader, "patternTableBase");
+  bgChrPagesUniform = safeGetUniformLocation(bgShader, "chrPages");
+  bgLocalPalettesUniform = safeGetUniformLocation(bgShader, "localPalettes");
+  bgTileIndicesUniform = safeGetUniformLocation(bgShader, "tileIndices");
+  bgPaletteIndicesUniform = safeGetUniformLocation(bgShader, "paletteIndices");
+  bgScrollSizeUniform = safeGetUniformLocation(bgShader, "scrollSize");
+
+  // The texture units never change, and neither does the scroll size
+  glUniform1i(bgChrBanksUniform, CHR_TEXID);
+  glUniform1i(bgTileIndicesUniform, TILE_INDEX_TEXID);
+  glUniform1i(bgPaletteIndicesUniform, PALETTE_INDEX_TEXID);
+  glUniform2i(bgScrollSizeUniform, scrollWidth(), scrollHeight());
+  checkGlErrors(0);
+
+  shader = loadProgram(VERTEX_SHADER_FILE, FRAGMENT_SHADER_FILE);
 
   glUseProgram(shader);
   checkGlErrors(0);
@@ -295,9 +380,15 @@ void Screen::initShaders(void) {
   tileAttrib = safeGetAttribLocation(shader, "tile");
   uvAttrib = safeGetAttribLocation(shader, "v_uv");
   paletteNAttrib = safeGetAttribLocation(shader, "v_palette_n");
+  visibleRowsAttrib = safeGetAttribLocation(shader, "v_visible_rows");
 
-  patternTableUniform = safeGetUniformLocation(shader, "patternTable");
+  chrBanksUniform = safeGetUniformLocation(shader, "chrBanks");
+  patternTableBaseUniform = safeGetUniformLocation(shader, "patternTableBase");
+  chrPagesUniform = safeGetUniformLocation(shader, "chrPages");
   localPalettesUniform = safeGetUniformLocation(shader, "localPalettes");
+
+  glUniform1i(chrBanksUniform, CHR_TEXID);
+  checkGlErrors(0);
 }
 
 void Screen::setupFrame() {
@@ -335,51 +426,34 @@ void Screen::setSpritePalettes(float *localPaletteInput) {
          LOCAL_PALETTES_LENGTH * sizeof(float));
 }
 
-void Screen::setTileIndices(vector<vector<unsigned char> > tiles) {
+/* Register the tile and palette index buffers. Each must hold
+ * tileColumns() * tileRows() bytes in column-major order, and must
+ * stay alive (and in place) until the next drawToBuffer is done with
+ * them. We read them directly instead of copying them.
+ */
+void Screen::setIndexBuffers(unsigned char *tiles, unsigned char *palettes) {
   tileIndices = tiles;
-}
-
-void Screen::setTileIndices(unsigned char *tiles, unsigned int len) {
-  // this is probably slower than it needs to be, but let's just make
-  // it work for now
-  assert(len == tileColumns() * tileRows());
-  tileIndices.resize(tileColumns());
-  for (int x = 0; x < tileColumns(); x++) {
-    tileIndices[x].resize(tileRows());
-    for (int y = 0; y < tileRows(); y++) {
-      tileIndices[x][y] = tiles[(x * tileRows()) + y];
-    }
-  }
-}
-
-void Screen::setPaletteIndices(vector<vector<unsigned char> > palettes) {
   paletteIndices = palettes;
 }
 
-void Screen::setPaletteIndices(unsigned char *indices, unsigned int len) {
-  // this is probably slower than it needs to be, but let's just make
-  // it work for now
-  assert(len == tileColumns() * tileRows());
-  paletteIndices.resize(tileColumns());
-  for (int x = 0; x < tileColumns(); x++) {
-    paletteIndices[x].resize(tileRows());
-    for (int y = 0; y < tileRows(); y++) {
-      paletteIndices[x][y] = indices[(x * tileRows()) + y];
-    }
-  }
-}
-
-// assume the size is equal to 8*8*PATTERN_TABLE_TILES (TODO fix magic number)
-void Screen::setBgPatternTable(float *bgPtabInput) {
-  glBindBuffer(GL_ARRAY_BUFFER, bgVbo);
-  glActiveTexture(BG_PATTERN_TABLE_TEXTURE);
-  glBindTexture(GL_TEXTURE_2D, bgPtabName);
-  glTexImage2D(GL_TEXTURE_2D, 0, GL_RED, 8*PATTERN_TABLE_TILES, 8,
-               0, GL_RED, GL_FLOAT, bgPtabInput);
+// Copy one of the index buffers into its (already allocated) texture
+void Screen::uploadIndexTexture(GLenum texture, GLuint name,
+                                const unsigned char *indices) {
+  glActiveTexture(texture);
+  glBindTexture(GL_TEXTURE_2D, name);
+  glPixelStorei(GL_UNPACK_ALIGNMENT, 1);
+  glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, tileRows(), tileColumns(),
+                  GL_RED_INTEGER, GL_UNSIGNED_BYTE, indices);
   checkGlErrors(0);
 }
 
-void Screen::setBgPatternTable(vector<float> bgPtabInput) {
+/* Upload every CHR bank, decoded to color indexes, as one integer
+ * texture. Each 1 KB bank is CHR_BANK_WIDTH pixels wide and 8 tall,
+ * and they're stacked top to bottom. This only needs to happen again
+ * when the banks' contents change (CHR RAM writes): bank switches and
+ * PPUCTRL pattern table changes only change uniforms.
+ */
+void Screen::setChrBanks(const unsigned char *chr, int nBanks) {
   /* Note: according to stackoverflow, glTexImage2D allows the memory
      to be freed after the call, so I don't have to worry about
      copying the input over to somewhere stable. I can't find the part
@@ -387,30 +461,59 @@ void Screen::setBgPatternTable(vector<float> bgPtabInput) {
 
      http://stackoverflow.com/questions/26499361/opengl-what-does-glteximage2d-do
   */
-
-  // TODO fix magic number
-  assert(bgPtabInput.size() == 8*8*PATTERN_TABLE_TILES);
-  setBgPatternTable(bgPtabInput.data());
-}
-
-void Screen::setSpritePatternTable(float *spritePtabInput) {
-  glBindBuffer(GL_ARRAY_BUFFER, spriteVbo);
-  glActiveTexture(SPRITE_PATTERN_TABLE_TEXTURE);
-  glBindTexture(GL_TEXTURE_2D, spritePtabName);
-  glTexImage2D(GL_TEXTURE_2D, 0, GL_RED, 8*PATTERN_TABLE_TILES, 8,
-               0, GL_RED, GL_FLOAT, spritePtabInput);
+  glActiveTexture(CHR_TEXTURE);
+  glBindTexture(GL_TEXTURE_2D, chrName);
+  // Integer textures can't be filtered
+  glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST);
+  glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST);
+  glPixelStorei(GL_UNPACK_ALIGNMENT, 1);
+  glTexImage2D(GL_TEXTURE_2D, 0, GL_R8UI, CHR_BANK_WIDTH, 8 * nBanks,
+               0, GL_RED_INTEGER, GL_UNSIGNED_BYTE, chr);
   checkGlErrors(0);
 }
 
-void Screen::setSpritePatternTable(vector<float> spritePtabInput) {
-  assert(spritePtabInput.size() == 8*8*PATTERN_TABLE_TILES);
-  setSpritePatternTable(spritePtabInput.data());
-}
-
-void Screen::setOam(unsigned char *oamBytes) {
+/* Register the OAM buffer, which must be OAM_SIZE bytes and stay
+ * alive until the next drawToBuffer is done with it. Bump oamVersion
+ * in the frame state after changing its contents; pointing at a
+ * different buffer with the same contents doesn't need a rebuild.
+ */
+void Screen::setOamBuffer(unsigned char *oamBytes) {
   // Not bothering to write the struct interface, because we'll only
   // actually use this by taking byte-array input from the NES.
-  memcpy(oam, oamBytes, OAM_SIZE);
+  oam = (struct oamEntry *) oamBytes;
+}
+
+/* Take in the state for the next frame, all at once. This replaces
+ * calling setUniversalBg, setMask, setBgPalettes, setSpritePalettes
+ * and startScrollRegion individually. The caller still has to call
+ * drawToBuffer.
+ */
+void Screen::submitFrame(const frameState *state) {
+  setUniversalBg(state->universalBg);
+  setMask((unsigned char) state->maskState);
+  setBgPalettes((float *) state->bgPalettes);
+  setSpritePalettes((float *) state->spritePalettes);
+  bgPatternTable = state->bgPatternTable & 1;
+  spritePatternTable = state->spritePatternTable & 1;
+  for (int i = 0; i < CHR_PAGES; i++) {
+    chrPages[i] = state->chrPages[i];
+  }
+  if (state->oamVersion != lastOamVersion) {
+    oamDirty = true;
+    lastOamVersion = state->oamVersion;
+  }
+  paletteVersion = state->paletteVersion;
+  bgTilesVersion = state->bgTilesVersion;
+
+  // drawBg checks that there's at least one scroll region, if it's
+  // drawing anything
+  assert(state->nScrollRegions <= MAX_SCROLL_REGIONS);
+  scrollChanges.clear();
+  for (unsigned int i = 0; i < state->nScrollRegions; i++) {
+    const scrollChange &region = state->scrollRegions[i];
+    startScrollRegion(region.ss_x_offset, region.ss_y_offset,
+                      region.ps_x_start, region.ps_y_top);
+  }
 }
 
 void Screen::setMask(unsigned char m) {
@@ -460,19 +563,23 @@ void Screen::setScrollType(ScrollType st) {
 }
 
 
+int Screen::uploadsSkipped() {
+  return skippedUploads;
+}
+
 void Screen::drawToBuffer() {
   // State we need by the time we finish this:
   // For all:
   // - universalBg needs to be set to the universal background palette index
   // For background:
   // - bgPalettes needs to be set to a buffer with the local palettes
-  // - BG_PATTERN_TABLE_TEXTURE needs to be populated with the background pattern table
+  // - CHR_TEXTURE needs to be populated with the CHR banks, and bgPatternTable and chrPages set
   // - we need data for the actual tiles (tileIndices and paletteIndices from the python, set by the ppu)
   //   (so maybe keep the ppu setting that, and then move it from python to c++)
   // - scroll coordinates need to be set (currently assuming they're consistent in a frame)
   // For sprites:
   // - spritePalettes needs to be set to a buffer with the local palettes
-  // - SPRITE_PATTERN_TABLE_TEXTURE needs to be poulated with the sprite pattern table
+  // - spritePatternTable needs to be set
   // - oam needs to be set to the OAM contents
 
   assert(universalBg < N_PALETTES);
@@ -490,11 +597,24 @@ void Screen::drawToBuffer() {
   glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST);
   glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST);
 
-  if (maskState & MASK_MASK_BKG) {
+  skippedUploads = 0;
+
+  // Sprites behind the background go first, so opaque background
+  // pixels cover them
+  bool spritesShown = (maskState & MASK_MASK_SPRITE) && oam;
+  if (spritesShown) {
+    updateSprites();
+    glUseProgram(shader);
+    setProgramUniforms(spriteUniforms, patternTableBaseUniform,
+                       chrPagesUniform, localPalettesUniform,
+                       spritePatternTable, spritePalettes);
+    drawSprites(true);
+  }
+  if ((maskState & MASK_MASK_BKG) && tileIndices && paletteIndices) {
     drawBg();
   }
-  if (maskState & MASK_MASK_SPRITE) {
-    drawSprites();
+  if (spritesShown) {
+    drawSprites(false);
   }
   // Drawing is done. Now set up the next frame.
 
@@ -515,6 +635,54 @@ int Screen::draw() {
   return 0;
 }
 
+void Screen::releaseContext() {
+  glfwMakeContextCurrent(NULL);
+}
+
+/* Draw frames from the queue until it closes. This owns the GL
+ * context the whole time, so nothing else may make GL calls on this
+ * screen while it runs.
+ */
+void Screen::renderLoop(FrameQueue *queue) {
+  glfwMakeContextCurrent(window);
+  frameSnapshot *frame;
+  while ((frame = queue->beginRead()) != NULL) {
+    // Everything python changes is either in the frame state or
+    // versioned there, except CHR. So if neither changed, this frame
+    // looks just like the last one: leave that one up.
+    if (haveDrawnFrame && !frame->hasChr &&
+        memcmp(&frame->state, &lastDrawnState, sizeof(frameState)) == 0) {
+      queue->endRead(false, 0);
+      continue;
+    }
+    int skippedChr = 1;
+    if (frame->hasChr) {
+      setChrBanks(frame->chr.data(), frame->nChrBanks);
+      skippedChr = 0;
+    }
+    setIndexBuffers(frame->tileIndices.data(), frame->paletteIndices.data());
+    setOamBuffer(frame->oam);
+    submitFrame(&frame->state);
+    drawToBuffer();
+    memcpy(&lastDrawnState, &frame->state, sizeof(frameState));
+    haveDrawnFrame = true;
+    // GL has copied everything it needs out of the snapshot by now,
+    // so the emulator can have it back while we wait on the swap.
+    queue->endRead(true, uploadsSkipped() + skippedChr);
+    glfwSwapBuffers(window);
+  }
+  glfwMakeContextCurrent(NULL);
+}
+
+/* Handle window events. Returns nonzero if the window was closed.
+ * Unlike draw, this doesn't touch the GL context, so it's safe to call
+ * while renderLoop runs on another thread.
+ */
+int Screen::pollWindow() {
+  glfwPollEvents();
+  return glfwWindowShouldClose(window) ? 1 : 0;
+}
+
 /*
  * So for accurate behavior, our background drawing will actually have
  * to work something like this:
@@ -541,66 +709,6 @@ int Screen::draw() {
  *   z-coordinate so that the new tiles overlap the old ones.
  */
 
-void Screen::drawVertices(
-  vector<glVertex> &vertices,
-  GLuint vbo,
-  GLuint ptabName,
-  GLenum ptabTex,
-  int ptabTexId,
-  float *palettes
-  ) {
-
-  glBindBuffer(GL_ARRAY_BUFFER, vbo);
-
-  // From python implementation comments:
-  // We need to do this here (anytime before the draw call) and I
-  // don't understand why. The order is important for some reason.
-  glActiveTexture(ptabTex);
-  glBindTexture(GL_TEXTURE_2D, ptabName);
-
-  // do we need to call these again? unclear. python code did it but
-  // I don't know why.
-  glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST);
-  glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST);
-
-  checkGlErrors(0);
-
-  int stride = sizeof(glVertex);
-  glBufferData(GL_ARRAY_BUFFER, vertices.size() * sizeof(glVertex),
-               vertices.data(), GL_DYNAMIC_DRAW);
-  checkGlErrors(0);
-  glVertexAttribPointer(posAttrib, 2, GL_PIXEL_COORD, GL_FALSE, stride,
-                        (const GLvoid *) offsetof(glVertex, x_pos));
-  glEnableVertexAttribArray(posAttrib);
-  checkGlErrors(0);
-  glVertexAttribPointer(priorityAttrib, 1, GL_FLOAT, GL_FALSE, stride,
-                        (const GLvoid *) offsetof(glVertex, priority));
-  glEnableVertexAttribArray(priorityAttrib);
-  checkGlErrors(0);
-  glVertexAttribPointer(tileAttrib, 1, GL_PTAB_TILE_COORD, GL_FALSE, stride,
-                        (const GLvoid *) offsetof(glVertex, tile));
-  glEnableVertexAttribArray(tileAttrib);
-  checkGlErrors(0);
-  glVertexAttribPointer(uvAttrib, 2, GL_PTAB_UV_COORD, GL_FALSE, stride,
-                        (const GLvoid *) offsetof(glVertex, u));
-  glEnableVertexAttribArray(uvAttrib);
-  checkGlErrors(0);
-  glVertexAttribPointer(paletteNAttrib, 1, GL_UNSIGNED_BYTE, GL_FALSE, stride,
-                        (const GLvoid *) offsetof(glVertex, palette));
-  glEnableVertexAttribArray(paletteNAttrib);
-  checkGlErrors(0);
-
-  glUniform1i(patternTableUniform, ptabTexId);
-  checkGlErrors(0);
-
-  // FIXME magic number 16
-  glUniform4fv(localPalettesUniform, 16, palettes);
-  checkGlErrors(0);
-
-  glDrawArrays(GL_TRIANGLES, 0, vertices.size());
-  checkGlErrors(0);
-}
-
 void Screen::drawBg() {
 
   /*
@@ -608,14 +716,6 @@ void Screen::drawBg() {
    * several different coordinate spaces. I'll give them some names
    * here.
    *
-   * /Pattern table space/ represents the contents of the NES's
-   * pattern tables, which store the images to be displayed for each
-   * tile. We represent pattern tables with three dimensions: the tile
-   * coordinate distinguishes between entries in a pattern table, and
-   * the u and v coordinates correspond to the horizontal and vertical
-   * location within a tile. The fragment shader does the job of
-   * converting coordinates in this space to actual colors.
-   *
    * /Pixel space/ represents the NES's screen in pixel units. It
    * ranges from (x = 0, y = 0) to (x = 256, y = 240).
    *
@@ -656,41 +756,70 @@ void Screen::drawBg() {
    *
    * 1. Divide pixel space into scroll regions.
    *
-   * 2. For each scroll region, look at the corresponding area in
-   * scroll space, and look at the tile boundaries, between the
-   * corresponding tiles in nametable space. Create one pixel-space
-   * rectangle in the vertex vector (six vertices) for each tile. Clip
-   * the rectangles on the top and left; don't bother for the bottom
-   * and right. For the tile containing the start of the scroll
-   * region, we may need to make two rectangles. Each vertex in these
-   * rectangles has u and v coordinates, corresponding to its location
-   * in the unclipped tile, and a tile coordinate from the tile's
-   * contents in nametable space. So each vertex has a pixel-space
-   * coordinate and a pattern-table-space coordinate.
+   * 2. For each scroll region, cover its part of pixel space with
+   * rectangles: one for the partial scanline at its start (if it
+   * doesn't start at the left edge), one for the full scanlines in
+   * the middle, and one for the partial scanline at its end (if the
+   * next region starts partway through a scanline). Usually that's
+   * just the middle one. Every vertex carries the region's
+   * scroll-space offset.
+   *
+   * 3. The vertex shader maps the rectangles' pixel-space coordinates
+   * to GL space.
    *
-   * 3. The vertex shader sees the pixel-space coordinates of the
-   * polygons comprising the tiles, and maps them to GL space.
+   * 4. The fragment shader adds the scroll offset to its pixel-space
+   * coordinate to get a scroll-space coordinate, then looks up the
+   * tile and palette indexes in nametable space (from textures we
+   * upload every frame), the pixel in the CHR banks, and finally the
+   * color in the local palettes.
    *
-   * 4. The fragment shader sees the pattern-table-space coordinates
-   * and maps them to actual colors (with the help of palettes).
+   * So none of the per-tile work happens on the CPU, and a mid-frame
+   * scroll change only costs a few more vertices.
    *
    */
 
-  // For this function, I'll be using hungarian notation with prefix
-  // ss to represent screen-space coords, ps to represent pixel-space
-  // coords, and nts to represent nametable-space coords.
+  // The quads only depend on the scroll regions, so they usually
+  // don't change from frame to frame
+  if (bgQuadsStale || scrollChanges.size() != bgQuadRegions.size() ||
+      memcmp(scrollChanges.data(), bgQuadRegions.data(),
+             scrollChanges.size() * sizeof(scrollChange)) != 0) {
+    buildBgQuads();
+  } else {
+    skippedUploads++;
+  }
 
-  // TODO: actually do something with the z coord here. We need to
-  // increase it as we change scroll regions, pass it into the shader,
-  // and make the necessary changes for the shader to use it.
-  float priority = 0.0;
+  // The index buffers only need sending when the PPU has written
+  // them (it bumps bgTilesVersion when it does)
+  if (indexTexturesStale || bgTilesVersion != lastBgTilesVersion) {
+    uploadIndexTexture(TILE_INDEX_TEXTURE, tileIndexName, tileIndices);
+    uploadIndexTexture(PALETTE_INDEX_TEXTURE, paletteIndexName, paletteIndices);
+    lastBgTilesVersion = bgTilesVersion;
+    indexTexturesStale = false;
+  } else {
+    skippedUploads += 2;
+  }
 
-  // Clear our vertex collection, but request that its memory not be
-  // deallocated. In practice, it looks like memory won't be
-  // deallocated under most compilers anyway, but (according to
-  // cplusplus.com) the spec doesn't guarantee either way.
-  bgVertices.reserve(bgVertices.size());
-  bgVertices.clear();
+  glUseProgram(bgShader);
+  glBindVertexArray(bgVao);
+  glActiveTexture(CHR_TEXTURE);
+  glBindTexture(GL_TEXTURE_2D, chrName);
+  checkGlErrors(0);
+
+  setProgramUniforms(bgUniforms, bgPatternTableBaseUniform,
+                     bgChrPagesUniform, bgLocalPalettesUniform,
+                     bgPatternTable, bgPalettes);
+
+  glDrawArrays(GL_TRIANGLES, 0, bgQuads.size());
+  checkGlErrors(0);
+}
+
+// Cover each scroll region with quads, and send them to bgVbo
+void Screen::buildBgQuads() {
+  // For this function, I'll be using hungarian notation with prefix
+  // ss to represent screen-space coords and ps to represent
+  // pixel-space coords.
+
+  bgQuads.clear();
 
   // The first element of the scroll changes vector needs to contain
   // the initial scroll state of the frame. Assert that there is a
@@ -704,21 +833,18 @@ void Screen::drawBg() {
        it != scrollChanges.end();
        it++) {
 
-    // pixel-space boundary coordinates of scroll region
+    // pixel-space boundary coordinates of scroll region. Unlike the
+    // start coordinates, the end coordinates are exclusive: the
+    // region ends just before (psRegionXEnd, psRegionYBottom).
     pixel_coord psRegionXStart = it->ps_x_start;
     pixel_coord psRegionYTop = it->ps_y_top;
     pixel_coord psRegionXEnd, psRegionYBottom;
     if (it+1 == scrollChanges.end()) {
-      psRegionYBottom = VISIBLE_SCANLINES - 1;
-      psRegionXEnd = VISIBLE_COLUMNS - 1;
+      psRegionYBottom = VISIBLE_SCANLINES;
+      psRegionXEnd = 0;
     } else {
-      if ((it+1)->ps_x_start > 0) {
-        psRegionYBottom = (it+1)->ps_y_top;
-        psRegionXEnd = (it+1)->ps_x_start - 1;
-      } else {
-        psRegionYBottom = (it+1)->ps_y_top - 1;
-        psRegionXEnd = VISIBLE_COLUMNS - 1;
-      }
+      psRegionYBottom = (it+1)->ps_y_top;
+      psRegionXEnd = (it+1)->ps_x_start;
       // While we're here, check to make sure the scroll regions are
       // strictly increasing over pixel space, lexicographically
       assert(((it+1)->ps_y_top > it->ps_y_top)
@@ -727,144 +853,149 @@ void Screen::drawBg() {
               &&
               ((it+1)->ps_x_start > it->ps_x_start)));
     }
-    // We'd also better still be on the screen. This puts bounds on
-    // the start coordinates; between that and asserting that start
-    // coordinates are strictly increasing (lexicographically), we
-    // have a bound on how long this loop is allowed to continue, so
-    // we'll catch errors that'd make it go very long.
+    // We'd also better still be on the screen.
     assert(psRegionXStart < VISIBLE_COLUMNS);
     assert(psRegionYTop < VISIBLE_SCANLINES);
-
     assert(psRegionXEnd < VISIBLE_COLUMNS);
-    assert(psRegionYBottom < VISIBLE_SCANLINES);
+    assert(psRegionYBottom <= VISIBLE_SCANLINES);
 
     // scroll-space offset coordinates of scroll region
     scroll_coord ssScrollX = it->ss_x_offset;
     scroll_coord ssScrollY = it->ss_y_offset;
-    scroll_coord ssFineScrollX = ssScrollX % 8;
-    scroll_coord ssFineScrollY = ssScrollY % 8;
-
-
-    // Iterate through every tile represented in our scroll region.
-    // psTileTop and psTileLeft represent the top-left coordinates of
-    // the tile /before/ clipping.
-
-    // Start at the pixel-space boundaries of the scroll region and
-    // subtract the fine scroll. This will put us at the boundary of
-    // the first tile to appear on the screen.
-    for (pixel_coord psTileTop =
-           psRegionYTop - (pixel_coord) ssFineScrollY;
-         psTileTop < psRegionYBottom;
-         psTileTop += 8) {
-
-      scroll_coord ssTileTop =
-        (psTileTop + ssScrollY) % scrollHeight();
-      assert(0 <= ssTileTop < scrollHeight());
-      // Use div to make sure we do truncating division, no matter
-      // what type we've defined scroll_coord as. We can't just divide
-      // ssTileTop by 8 because ssTileTop will not be tile-aligned if
-      // we're at the top of the region and the region top is not
-      // aligned.
-      ntab_coord ntsTileY = (ntab_coord) div(ssTileTop, 8).quot;
-
-
-      // The x-coordinate starts similarly to the y-coordinate, except
-      // that it always starts at the left of the screen (and goes to
-      // the right).
-      for (pixel_coord psTileLeft =
-             - (pixel_coord) ssFineScrollX;
-           psTileLeft < VISIBLE_COLUMNS;
-           psTileLeft += 8) {
-
-        int ssTileLeft =
-          (psTileLeft + ssScrollX) % scrollWidth();
-        assert(0 <= ssTileLeft < scrollWidth());
-        // FIXME: similar to the y boundary, this will be misaligned
-        // if we're at the region top and our x-start is misaligned.
-        assert(ssTileLeft % 8 == 0);
-        ntab_coord ntsTileX = (ntab_coord) (ssTileLeft / 8);
-
-
-
-        /* TODO: clip the top and left of the tile, according to the
-         * following rules:
-         *
-         * - If we're above the top of the scroll region, and entirely
-         *   to the left (i.e. our pixel-space x is >= the start
-         *   coord's x), then clip y to the start coord's y, and clip
-         *   v accordingly.
-         *
-         * - If we're above /or at/ the top, and entirely to the right
-         *   (our rightmost pixel space x is < the start coord's x),
-         *   then clip y to the start coord's y plus 1, and clip v
-         *   accordingly.
-         *
-         * - If we're above or at the top, and our x boundaries
-         *   straddle the start, then we actually need to spilt this
-         *   into two rectangles.
-         *
-         */
-
-
-        // Calculate rectangle boundaries. Top and left may not be
-        // tile-aligned, but bottom and right must be.
-        pixel_coord psRectLeft = psTileLeft;
-        pixel_coord psRectRight = psTileLeft + 8;
-        pixel_coord psRectTop = psTileTop;
-        pixel_coord psRectBottom = psTileTop + 8 - (pixel_coord) (ssTileLeft % 8);
-
-        // bottom-right of uv coordinates is always 1,1. Top-right is
-        // clipped if rectangle is clipped.
-        ptab_tile_coord tile = tileIndices[ntsTileX][ntsTileY];
-        ptab_uv_coord u_left = 0.0 + (psRectLeft - psTileLeft) / 8.0;
-        ptab_uv_coord u_right = 1.0;
-        ptab_uv_coord v_top = 0.0 + (psRectTop - psTileTop) / 8.0;
-        ptab_uv_coord v_bottom = 1.0;
-
-        int palette_index = paletteIndices[ntsTileX][ntsTileY];
-
-
-        appendRect(
-          bgVertices,
-          psRectLeft, psRectRight, psRectTop, psRectBottom,
-          priority, // TODO we don't do anything with priority so far
-          tile, u_left, u_right, v_top, v_bottom,
-          palette_index);
-      } // loop over x coordinates
-    } // loop over y coordinates
+
+    if (psRegionYTop == psRegionYBottom) {
+      // The whole region is within one scanline
+      appendBgQuad(psRegionXStart, psRegionXEnd,
+                   psRegionYTop, psRegionYTop + 1,
+                   ssScrollX, ssScrollY);
+      continue;
+    }
+
+    // Full scanlines run from psFullTop up to (not including)
+    // psRegionYBottom
+    pixel_coord psFullTop = psRegionYTop;
+    if (psRegionXStart > 0) {
+      appendBgQuad(psRegionXStart, VISIBLE_COLUMNS,
+                   psRegionYTop, psRegionYTop + 1,
+                   ssScrollX, ssScrollY);
+      psFullTop++;
+    }
+    if (psRegionYBottom > psFullTop) {
+      appendBgQuad(0, VISIBLE_COLUMNS,
+                   psFullTop, psRegionYBottom,
+                   ssScrollX, ssScrollY);
+    }
+    if (psRegionXEnd > 0) {
+      appendBgQuad(0, psRegionXEnd,
+                   psRegionYBottom, psRegionYBottom + 1,
+                   ssScrollX, ssScrollY);
+    }
   } // loop over scrollChanges
 
-  // We've set up the bgVertices vector, so now send over all those
-  // vertices to opengl.
+  glBindBuffer(GL_ARRAY_BUFFER, bgVbo);
+  glBufferData(GL_ARRAY_BUFFER, bgQuads.size() * sizeof(bgVertex),
+               bgQuads.data(), GL_DYNAMIC_DRAW);
+  checkGlErrors(0);
 
-  drawVertices(bgVertices,
-               bgVbo, bgPtabName, BG_PATTERN_TABLE_TEXTURE,
-               BG_PATTERN_TABLE_TEXID, bgPalettes);
+  bgQuadRegions = scrollChanges;
+  bgQuadsStale = false;
+}
 
+/* Set a shader program's pattern table, CHR page and palette uniforms,
+ * skipping any that haven't changed since they were last set. The
+ * program has to be in use already.
+ */
+void Screen::setProgramUniforms(programUniforms &sent,
+                                GLint patternTableBaseUniform,
+                                GLint chrPagesUniform,
+                                GLint localPalettesUniform,
+                                int patternTable, float *palettes) {
+  // Switching pattern tables or CHR banks only changes these
+  if (!sent.valid || sent.patternTable != patternTable) {
+    glUniform1i(patternTableBaseUniform, patternTable);
+    sent.patternTable = patternTable;
+  } else {
+    skippedUploads++;
+  }
+  if (!sent.valid || memcmp(sent.chrPages, chrPages, sizeof(chrPages)) != 0) {
+    glUniform1iv(chrPagesUniform, CHR_PAGES, chrPages);
+    memcpy(sent.chrPages, chrPages, sizeof(chrPages));
+  } else {
+    skippedUploads++;
+  }
+  if (!sent.valid || sent.paletteVersion != paletteVersion) {
+    // FIXME magic number 16
+    glUniform4fv(localPalettesUniform, 16, palettes);
+    sent.paletteVersion = paletteVersion;
+  } else {
+    skippedUploads++;
+  }
+  sent.valid = true;
+  checkGlErrors(0);
 }
 
-void Screen::drawSprites() {
-  glBindBuffer(GL_ARRAY_BUFFER, spriteVbo);
+void Screen::appendBgQuad(
+    pixel_coord x_left, pixel_coord x_right,
+    pixel_coord y_top, pixel_coord y_bottom,
+    scroll_coord ss_x_offset, scroll_coord ss_y_offset
+    ) {
+  bgVertex bottomLeft = {x_left, y_bottom, ss_x_offset, ss_y_offset};
+  bgVertex bottomRight = {x_right, y_bottom, ss_x_offset, ss_y_offset};
+  bgVertex topLeft = {x_left, y_top, ss_x_offset, ss_y_offset};
+  bgVertex topRight = {x_right, y_top, ss_x_offset, ss_y_offset};
 
-  glActiveTexture(SPRITE_PATTERN_TABLE_TEXTURE);
-  glBindTexture(GL_TEXTURE_2D, spritePtabName);
+  // first triangle
+  bgQuads.push_back(bottomLeft);
+  bgQuads.push_back(bottomRight);
+  bgQuads.push_back(topRight);
+  // second triangle
+  bgQuads.push_back(bottomLeft);
+  bgQuads.push_back(topRight);
+  bgQuads.push_back(topLeft);
+}
 
-  // still don't remember why/whether these glTexParameteri calls
-  // are necessary
-  glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST);
-  glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST);
+/* Bring spriteVertices and spriteVbo up to date with OAM, if it
+ * changed. Only the entries whose OAM bytes or visible rows changed
+ * get rebuilt and re-sent.
+ */
+void Screen::updateSprites() {
+  if (!oamDirty) {
+    skippedUploads++;
+    return;
+  }
 
-  spriteVertices.resize(0);
+  // Work out which rows of each sprite make the 8-sprites-per-scanline
+  // cut. Lower OAM entries get first dibs on each scanline.
+  // TODO 8x16 sprites
+  unsigned char visibleRows[OAM_ENTRIES];
+  int spritesOnScanline[VISIBLE_SCANLINES] = {0};
+  for (int oam_i = 0; oam_i < OAM_ENTRIES; oam_i++) {
+    visibleRows[oam_i] = 0;
+    if (oam[oam_i].y_minus_one >= SPRITE_OFFSCREEN_Y) {
+      continue;
+    }
+    pixel_coord y_top = oam[oam_i].y_minus_one + 1;
+    for (int row = 0; row < 8 && y_top + row < VISIBLE_SCANLINES; row++) {
+      if (++spritesOnScanline[y_top + row] <= MAX_SPRITES_PER_SCANLINE) {
+        // The shader sees rows of the tile, not of the screen
+        int tileRow = (oam[oam_i].attributes & OAM_FLIP_VERTICAL) ? 7 - row : row;
+        visibleRows[oam_i] |= 1 << tileRow;
+      }
+    }
+  }
+
+  glBindBuffer(GL_ARRAY_BUFFER, spriteVbo);
 
   for (int oam_i = 0; oam_i < OAM_ENTRIES; oam_i++) {
-    // TODO deal with maximum sprites per scanline
-    oamEntry sprite = oam[oam_i];
-    if (sprite.y_minus_one >= 0xef) {
-      // The sprite is wholly off the screen; ignore it
+    if (!allSpritesStale &&
+        memcmp(&oam[oam_i], &lastOam[oam_i * sizeof(oamEntry)],
+               sizeof(oamEntry)) == 0 &&
+        visibleRows[oam_i] == lastVisibleRows[oam_i]) {
       continue;
     }
-    // preceding check ensures this won't overflow
-    unsigned char spritetop = sprite.y_minus_one + 1;
+    oamEntry sprite = oam[oam_i];
+    memcpy(&lastOam[oam_i * sizeof(oamEntry)], &sprite, sizeof(oamEntry));
+    lastVisibleRows[oam_i] = visibleRows[oam_i];
 
     pixel_coord x_left = sprite.x;
     pixel_coord x_right = sprite.x + 8;
@@ -909,63 +1040,106 @@ void Screen::drawSprites() {
       }
     }
 
-    appendRect(
-      spriteVertices,
+    glVertex *slot = &spriteVertices[oam_i * VERTICES_PER_TILE];
+    writeRect(
+      slot,
       x_left, x_right,
       y_top, y_bottom,
       0.1, // TODO priority
       tile,
       u_left, u_right,
       v_top, v_bottom,
-      palette_index);
+      palette_index,
+      visibleRows[oam_i]);
+    glBufferSubData(GL_ARRAY_BUFFER,
+                    oam_i * VERTICES_PER_TILE * sizeof(glVertex),
+                    VERTICES_PER_TILE * sizeof(glVertex), slot);
+  }
+  checkGlErrors(0);
+  allSpritesStale = false;
+
+  // Lower OAM entries are drawn on top, so list them back to front.
+  // Sprites that aren't on the screen at all get left out.
+  // (Real hardware decides between overlapping sprites before looking
+  // at priority, so a low-numbered sprite behind the background can
+  // hide a higher-numbered one in front of it. We don't do that.)
+  for (int pass = 0; pass < SPRITE_PASSES; pass++) {
+    spriteFirsts[pass].clear();
+    spriteCounts[pass].clear();
+  }
+  for (int oam_i = OAM_ENTRIES - 1; oam_i >= 0; oam_i--) {
+    if (!visibleRows[oam_i]) {
+      continue;
+    }
+    int pass = (oam[oam_i].attributes & OAM_PRIORITY) ? 0 : 1;
+    spriteFirsts[pass].push_back(oam_i * VERTICES_PER_TILE);
+    spriteCounts[pass].push_back(VERTICES_PER_TILE);
+  }
+
+  oamDirty = false;
+}
 
+/* Draw either the sprites behind the background or the ones in front
+ * of it, from the vertices updateSprites left in spriteVbo.
+ */
+void Screen::drawSprites(bool behindBg) {
+  int pass = behindBg ? 0 : 1;
+  if (spriteFirsts[pass].empty()) {
+    return;
   }
 
-  drawVertices(spriteVertices,
-               spriteVbo, spritePtabName,
-               SPRITE_PATTERN_TABLE_TEXTURE,
-               SPRITE_PATTERN_TABLE_TEXID,
-               spritePalettes);
+  // drawToBuffer has already set the uniforms for this frame
+  glUseProgram(shader);
+  glBindVertexArray(spriteVao);
+
+  glActiveTexture(CHR_TEXTURE);
+  glBindTexture(GL_TEXTURE_2D, chrName);
+  checkGlErrors(0);
+
+  glMultiDrawArrays(GL_TRIANGLES, spriteFirsts[pass].data(),
+                    spriteCounts[pass].data(), spriteFirsts[pass].size());
+  checkGlErrors(0);
 }
 
-void Screen::appendRect(
-    vector<glVertex> &vertices,
+void Screen::writeRect(
+    glVertex *vertices,
     pixel_coord x_left, pixel_coord x_right,
     pixel_coord y_top, pixel_coord y_bottom,
     float priority,
     ptab_tile_coord tile,
     ptab_uv_coord u_left, ptab_uv_coord u_right,
     ptab_uv_coord v_top, ptab_uv_coord v_bottom,
-    unsigned char palette_index
+    unsigned char palette_index,
+    unsigned char visible_rows
     ) {
   glVertex bottomLeft =
     {x_left, y_bottom, priority,
-     tile, u_left, v_bottom, palette_index};
+     tile, u_left, v_bottom, palette_index, visible_rows};
   glVertex bottomRight =
     {x_right, y_bottom, priority,
-     tile, u_right, v_bottom, palette_index};
+     tile, u_right, v_bottom, palette_index, visible_rows};
   glVertex topLeft =
     {x_left, y_top, priority,
-     tile, u_left, v_top, palette_index};
+     tile, u_left, v_top, palette_index, visible_rows};
   glVertex topRight =
     {x_right, y_top, priority,
-     tile, u_right, v_top, palette_index};
+     tile, u_right, v_top, palette_index, visible_rows};
 
   // first triangle
-  vertices.push_back(bottomLeft);
-  vertices.push_back(bottomRight);
-  vertices.push_back(topRight);
+  vertices[0] = bottomLeft;
+  vertices[1] = bottomRight;
+  vertices[2] = topRight;
   // second triangle
-  vertices.push_back(bottomLeft);
-  vertices.push_back(topRight);
-  vertices.push_back(topLeft);
+  vertices[3] = bottomLeft;
+  vertices[4] = topRight;
+  vertices[5] = topLeft;
 }
 
 // Polls for keys, returns their state in a one-byte bitfield (masks
 // defined in header)
 unsigned char Screen::pollKeys() {
-  // Currently, we're polling events here and in draw(). Is that a
-  // problem? Not sure.
+  // Currently, we're polling events here and in draw() or
+  // pollWindow(). Is that a problem? Not sure.
   glfwPollEvents();
 
   if(glfwGetKey(window, GLFW_KEY_ESCAPE) == GLFW_PRESS) {
@@ -1037,72 +1211,3 @@ int initWindow(GLFWwindow **window_p) {
 }
 
 // ctypes interface
-
-extern "C" {
-
-  Screen *ex_constructScreen(int st) {
-    return new Screen((ScrollType) st);
-  }
-
-  void ex_setUniversalBg(Screen *sc, int bg) {
-    sc->setUniversalBg(bg);
-  }
-
-  // localPaletteInput must point to an array of exactly
-  // LOCAL_PALETTES_LENGTH elements. I don't check this here because
-  // FFIs are hard, but the python interface does check.
-  void ex_setBgPalettes(Screen *sc, float *localPaletteInput) {
-    sc->setBgPalettes(localPaletteInput);
-  }
-
-  void ex_setSpritePalettes(Screen *sc, float *localPaletteInput) {
-    sc->setSpritePalettes(localPaletteInput);
-  }
-
-  void ex_setBgPatternTable(Screen *sc, float *ptab) {
-    sc->setBgPatternTable(ptab);
-  }
-
-  void ex_setSpritePatternTable(Screen *sc, float *ptab) {
-    sc->setSpritePatternTable(ptab);
-  }
-
-  void ex_setTileIndices(Screen *sc, unsigned char *indices,
-                         unsigned int len) {
-    sc->setTileIndices(indices, len);
-  }
-
-  void ex_setPaletteIndices(Screen *sc, unsigned char *indices,
-                            unsigned int len) {
-    sc->setPaletteIndices(indices, len);
-  }
-
-  void ex_setOam(Screen *sc, unsigned char *oamBytes) {
-    sc->setOam(oamBytes);
-  }
-
-  void ex_setMask(Screen *sc, unsigned char m) {
-    sc->setMask(m);
-  }
-
-  void ex_startScrollRegion(Screen *sc,
-                            int x_offset, int y_offset,
-                            int x_start, int y_top) {
-    sc->startScrollRegion(
-      (scroll_coord) x_offset, (scroll_coord) y_offset,
-      (pixel_coord) x_start, (pixel_coord) y_top);
-  }
-
-  void ex_drawToBuffer(Screen *sc) {
-    sc->drawToBuffer();
-  }
-
-  int ex_draw(Screen *sc) {
-    return sc->draw();
-  }
-
-  unsigned char ex_pollKeys(Screen *sc) {
-    return sc->pollKeys();
-  }
-
-}
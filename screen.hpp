@@ -33,8 +33,20 @@ typedef struct glVertex {
   ptab_uv_coord u;
   ptab_uv_coord v;
   unsigned char palette;
+  // Bit n is set if row n of the tile is drawn. Rows past the
+  // 8-sprites-per-scanline limit are left out.
+  unsigned char visible_rows;
 } glVertex;
 
+// The background is drawn as a few quads per scroll region; the
+// fragment shader looks up the tiles itself.
+typedef struct bgVertex {
+  pixel_coord x_pos;
+  pixel_coord y_pos;
+  scroll_coord ss_x_offset;
+  scroll_coord ss_y_offset;
+} bgVertex;
+
 typedef struct oamEntry {
   unsigned char y_minus_one;
   unsigned char tile;
@@ -65,6 +77,12 @@ const unsigned char OAM_FLIP_HORIZONTAL = 0x40;
 const unsigned char OAM_FLIP_VERTICAL = 0x80;
 
 const int OAM_ENTRIES = 64;
+// Sprites with a y_minus_one this high are entirely off the screen
+const unsigned char SPRITE_OFFSCREEN_Y = 0xef;
+const int MAX_SPRITES_PER_SCANLINE = 8;
+// Sprites are drawn in two passes: the ones behind the background
+// before it, and the rest after it
+const int SPRITE_PASSES = 2;
 const int OAM_SIZE = 256;
 static_assert(OAM_SIZE == OAM_ENTRIES * sizeof(struct oamEntry), "OAM size is wrong");
 
@@ -74,6 +92,8 @@ const char *PROGRAM_NAME = "Missingnes";
 
 const char *VERTEX_SHADER_FILE = "vertex.vert";
 const char *FRAGMENT_SHADER_FILE = "fragment.frag";
+const char *BG_VERTEX_SHADER_FILE = "bg.vert";
+const char *BG_FRAGMENT_SHADER_FILE = "bg.frag";
 
 // some of these came from ppu.py, so they're a bit duplicated
 const pixel_coord SCANLINES = 262;
@@ -90,21 +110,61 @@ const pixel_coord SCREEN_HEIGHT = VISIBLE_SCANLINES;
 
 const int VERTICES_PER_TILE = 6;
 
-// TODO: change to account for differing numbers of nametables
-const int N_NAMETABLES = 2;
-const int SCROLL_SPACE_SIZE =
-  VISIBLE_TILE_ROWS * VISIBLE_TILE_COLUMNS * VERTICES_PER_TILE * N_NAMETABLES;
-
 const int PATTERN_TABLE_TILES = 256;
 const int PATTERN_TABLE_LENGTH = PATTERN_TABLE_TILES * 8 * 8;
 
-const GLenum BG_PATTERN_TABLE_TEXTURE = GL_TEXTURE0;
-const int BG_PATTERN_TABLE_TEXID = 0;
-const GLenum SPRITE_PATTERN_TABLE_TEXTURE = GL_TEXTURE1;
-const int SPRITE_PATTERN_TABLE_TEXID = 1;
+// Number of 1 KB pages in the pattern tables, and tiles in each one
+const int CHR_PAGES = 8;
+const int CHR_BANK_TILES = 64;
+// Width of a CHR bank in the CHR texture: one row of tiles
+const int CHR_BANK_WIDTH = CHR_BANK_TILES * 8;
+
+// Every CHR bank lives in one integer texture
+const GLenum CHR_TEXTURE = GL_TEXTURE0;
+const int CHR_TEXID = 0;
+// Tile and palette indexes for the background
+const GLenum TILE_INDEX_TEXTURE = GL_TEXTURE1;
+const int TILE_INDEX_TEXID = 1;
+const GLenum PALETTE_INDEX_TEXTURE = GL_TEXTURE2;
+const int PALETTE_INDEX_TEXID = 2;
 
 const int LOCAL_PALETTES_LENGTH = 16*4;
 
+// At most one scroll region can start on each scanline, plus the
+// region at the top of the frame
+const int MAX_SCROLL_REGIONS = VISIBLE_SCANLINES + 1;
+
+/* Everything python sends over for a frame, in one block. Python
+ * keeps a copy of this (Screen.frameState, laid out by
+ * FRAME_STATE_DTYPE in screen.py, which has to match) and fills it in
+ * place, then submits it with one call.
+ */
+typedef struct frameState {
+  int universalBg;
+  unsigned int maskState;
+  // Bumped by python whenever OAM changes
+  unsigned int oamVersion;
+  // Bumped by python whenever palette RAM changes
+  unsigned int paletteVersion;
+  // Bumped by python whenever the tile or palette index buffers change
+  unsigned int bgTilesVersion;
+  // Pattern table halves (0 or 1) from PPUCTRL
+  unsigned int bgPatternTable;
+  unsigned int spritePatternTable;
+  // The CHR bank mapped to each pattern table page
+  unsigned int chrPages[CHR_PAGES];
+  unsigned int nScrollRegions;
+  float bgPalettes[LOCAL_PALETTES_LENGTH];
+  float spritePalettes[LOCAL_PALETTES_LENGTH];
+  // Only the first nScrollRegions of these are used
+  scrollChange scrollRegions[MAX_SCROLL_REGIONS];
+} frameState;
+
+static_assert(sizeof(scrollChange) == 16, "scrollChange struct has wrong size");
+static_assert(sizeof(frameState) ==
+              32 + 4*CHR_PAGES + 2*4*LOCAL_PALETTES_LENGTH + 16*MAX_SCROLL_REGIONS,
+              "frameState struct has wrong size");
+
 const float FPS_UPDATE_INTERVAL = 2.0; // in seconds
 const int MAX_FPS = 60;
 const float SECONDS_PER_FRAME = 1.0 / MAX_FPS;
@@ -143,6 +203,17 @@ enum ScrollType {
   SCROLL_NONE = 4        // MirrorMode.oneScreenMirroring
 };
 
+// What a shader program's pattern table and palette uniforms were last
+// set to, so we only set them again when they change
+typedef struct programUniforms {
+  bool valid;
+  int patternTable;
+  GLint chrPages[CHR_PAGES];
+  unsigned int paletteVersion;
+} programUniforms;
+
+class FrameQueue;
+
 class Screen {
 public:
   Screen(ScrollType st);
@@ -150,17 +221,12 @@ public:
   void setUniversalBg(int);
   void setBgPalettes(vector<float>);
   void setBgPalettes(float*);
-  void setBgPatternTable(vector<float>);
-  void setBgPatternTable(float*);
+  void setChrBanks(const unsigned char *, int nBanks);
   void setSpritePalettes(vector<float>);
   void setSpritePalettes(float*);
-  void setSpritePatternTable(vector<float>);
-  void setSpritePatternTable(float*);
-  void setTileIndices(vector<vector<unsigned char> >);
-  void setTileIndices(unsigned char *, unsigned int len);
-  void setPaletteIndices(vector<vector<unsigned char> >);
-  void setPaletteIndices(unsigned char *, unsigned int len);
-  void setOam(unsigned char *);
+  void setIndexBuffers(unsigned char *tiles, unsigned char *palettes);
+  void setOamBuffer(unsigned char *);
+  void submitFrame(const frameState *);
   void setMask(unsigned char);
   void startScrollRegion(scroll_coord x_offset, scroll_coord y_offset,
                          pixel_coord x_start, pixel_coord y_top);
@@ -169,29 +235,62 @@ public:
   void testRenderLoop();
   void drawToBuffer();
   int draw();
+  // How many uploads the last drawToBuffer skipped because their
+  // data hadn't changed
+  int uploadsSkipped();
+
+  // For drawing on a separate render thread: the thread that made the
+  // screen gives up the GL context, and the render thread runs
+  // renderLoop until the queue closes. The window itself stays with
+  // the first thread, which should call pollWindow and pollKeys.
+  void releaseContext();
+  void renderLoop(FrameQueue *);
+  int pollWindow();
 
   unsigned char pollKeys();
 
+  ntab_coord tileRows();
+  ntab_coord tileColumns();
+
 private:
   GLFWwindow *window;
+  // Sprites use shader, the background uses bgShader
   GLuint shader;
+  GLuint bgShader;
+  // Each program gets its own vertex array, so their attributes don't
+  // get mixed up
+  GLuint spriteVao;
+  GLuint bgVao;
   // shader attribute locations
   GLint posAttrib;
   GLint priorityAttrib;
   GLint tileAttrib;
   GLint uvAttrib;
   GLint paletteNAttrib;
+  GLint visibleRowsAttrib;
+  GLint bgPosAttrib;
+  GLint bgScrollOffsetAttrib;
 
   // shader uniform locations
-  GLint patternTableUniform;
+  GLint chrBanksUniform;
+  GLint patternTableBaseUniform;
+  GLint chrPagesUniform;
   GLint localPalettesUniform;
+  GLint bgChrBanksUniform;
+  GLint bgPatternTableBaseUniform;
+  GLint bgChrPagesUniform;
+  GLint bgLocalPalettesUniform;
+  GLint bgTileIndicesUniform;
+  GLint bgPaletteIndicesUniform;
+  GLint bgScrollSizeUniform;
 
   // buffers
   GLuint bgVbo;
   GLuint spriteVbo;
   // textures
-  GLuint bgPtabName;
-  GLuint spritePtabName;
+  GLuint chrName;
+  GLuint tileIndexName;
+  GLuint paletteIndexName;
 
 
   // PPU state trackers (unused here?)
@@ -199,23 +298,72 @@ private:
   int lastSpritePalette;
 
   // state
-  vector<vector<unsigned char> > tileIndices;
-  vector<vector<unsigned char> > paletteIndices;
 
-  vector<struct glVertex> bgVertices;
+  // Tile and palette indexes for the whole scroll space. These point
+  // into buffers owned by python (Screen.tileIndices and
+  // Screen.paletteIndices), which the PPU updates in place. Both are
+  // column-major: entry (x, y) is at [x * tileRows() + y].
+  unsigned char *tileIndices;
+  unsigned char *paletteIndices;
+
+  vector<struct bgVertex> bgQuads;
+  // The scroll regions bgQuads (and bgVbo) were built from
+  vector<scrollChange> bgQuadRegions;
+  bool bgQuadsStale;
+  // bgTilesVersion from the frame state, and the one the index
+  // textures were last uploaded for
+  unsigned int bgTilesVersion;
+  unsigned int lastBgTilesVersion;
+  bool indexTexturesStale;
 
   float bgPalettes[LOCAL_PALETTES_LENGTH];
 
   int universalBg;
 
-  struct oamEntry oam[OAM_ENTRIES];
-
+  // Points into python's OAM bytearray (PPU.oam), which is written
+  // in place.
+  struct oamEntry *oam;
+  // Set when OAM has changed since spriteVertices was last built.
+  // Sprite vertices only depend on OAM: the sprite palettes and
+  // pattern table are looked up in the shader.
+  bool oamDirty;
+  unsigned int lastOamVersion;
+  // Set when every sprite needs rebuilding, not just the ones that
+  // changed since lastOam
+  bool allSpritesStale;
+  // OAM and visible rows as of the last time spriteVertices was
+  // built, to find which entries changed
+  unsigned char lastOam[OAM_SIZE];
+  unsigned char lastVisibleRows[OAM_ENTRIES];
+
+  // VERTICES_PER_TILE vertices for each OAM entry, in OAM order.
+  // spriteVbo mirrors this, and only changed entries get re-sent.
   vector<struct glVertex> spriteVertices;
+  // First vertex and vertex count of each sprite to draw in each
+  // pass (for glMultiDrawArrays), in back-to-front order
+  vector<GLint> spriteFirsts[SPRITE_PASSES];
+  vector<GLsizei> spriteCounts[SPRITE_PASSES];
 
   float spritePalettes[LOCAL_PALETTES_LENGTH];
+  // paletteVersion from the frame state
+  unsigned int paletteVersion;
 
   unsigned char maskState;
 
+  // Pattern table halves and CHR bank mapping from the frame state
+  int bgPatternTable;
+  int spritePatternTable;
+  GLint chrPages[CHR_PAGES];
+  programUniforms bgUniforms;
+  programUniforms spriteUniforms;
+
+  // Counted up by drawToBuffer
+  int skippedUploads;
+
+  // The frame renderLoop last drew, so it can skip identical ones
+  frameState lastDrawnState;
+  bool haveDrawnFrame;
+
   vector<scrollChange> scrollChanges;
 
   ScrollType scrollType;
@@ -223,34 +371,40 @@ private:
   // methods
 
   void initShaders();
+  GLuint loadProgram(const char *vertexFile, const char *fragmentFile);
   void setupFrame();
 
-  ntab_coord tileRows();
-  ntab_coord tileColumns();
   scroll_coord scrollWidth();
   scroll_coord scrollHeight();
 
   void drawBg();
-  void drawSprites();
-
-  void drawVertices(
-    vector<glVertex> &vertices,
-    GLuint vbo,
-    GLuint ptabName,
-    GLenum ptabTex,
-    int ptabTexId,
-    float *palettes
+  void buildBgQuads();
+  void updateSprites();
+  void setProgramUniforms(programUniforms &sent,
+                          GLint patternTableBaseUniform,
+                          GLint chrPagesUniform,
+                          GLint localPalettesUniform,
+                          int patternTable, float *palettes);
+  void drawSprites(bool behindBg);
+  void uploadIndexTexture(GLenum texture, GLuint name,
+                          const unsigned char *indices);
+
+  void appendBgQuad(
+    pixel_coord x_left, pixel_coord x_right,
+    pixel_coord y_top, pixel_coord y_bottom,
+    scroll_coord ss_x_offset, scroll_coord ss_y_offset
     );
 
-  void appendRect(
-    vector<glVertex> &vertices,
+  void writeRect(
+    glVertex *vertices,
     pixel_coord x_left, pixel_coord x_right,
     pixel_coord y_top, pixel_coord y_bottom,
     float priority,
     ptab_tile_coord tile,
     ptab_uv_coord u_left, ptab_uv_coord u_right,
     ptab_uv_coord v_top, ptab_uv_coord v_bottom,
-    unsigned char palette_index
+    unsigned char palette_index,
+    unsigned char visible_rows
     );
 
 };
@@ -4,17 +4,23 @@ to ppu.py's controller, let's say. (or is that the model? should we
 have more separation?)
 
 """
-import ctypes
-from ctypes import CDLL, c_void_p, c_int, c_uint, c_float, c_ubyte, POINTER
-import threading
-import time
 import sys
 
+import numpy as np
+
+import mem
+import pacing
 import palette
 import ppu
 
 PROGRAM_NAME = "Missingnes"
 
+# Rendering backends: draw with OpenGL through libscreen, or draw into
+# a NumPy framebuffer (see softscreen.py)
+RENDERER_OPENGL = "opengl"
+RENDERER_SOFTWARE = "software"
+RENDERERS = [RENDERER_OPENGL, RENDERER_SOFTWARE]
+
 # visible assuming no scrolling
 VISIBLE_TILE_ROWS = ppu.VISIBLE_SCANLINES/8
 VISIBLE_TILE_COLUMNS = ppu.VISIBLE_COLUMNS/8
@@ -25,14 +31,39 @@ SCREEN_HEIGHT = ppu.VISIBLE_SCANLINES
 PATTERN_TABLE_TILES = 256
 PATTERN_TABLE_ENTRIES = 8*8*PATTERN_TABLE_TILES
 
-# BG_PATTERN_TABLE_TEXTURE = GL_TEXTURE0
-# BG_PATTERN_TABLE_TEXID = 0
-# SPRITE_PATTERN_TABLE_TEXTURE = GL_TEXTURE1
-# SPRITE_PATTERN_TABLE_TEXID = 1
-# TODO other texture ids go here
-
 LOCAL_PALETTES_LENGTH = 16*4
 
+# How many frames the emulator can get ahead of the native screen's
+# render thread before submitting a frame blocks
+MAX_FRAMES_AHEAD = 2
+
+# At most one scroll region can start on each scanline, plus the
+# region at the top of the frame
+MAX_SCROLL_REGIONS = SCREEN_HEIGHT + 1
+
+# Matches struct scrollChange in screen.hpp
+SCROLL_REGION_DTYPE = np.dtype([
+    ('xOffset', 'int32'),
+    ('yOffset', 'int32'),
+    ('xStart', 'int32'),
+    ('yTop', 'int32')])
+
+# Everything sent to the native screen each frame, in one block.
+# Matches struct frameState in screen.hpp.
+FRAME_STATE_DTYPE = np.dtype([
+    ('universalBg', 'int32'),
+    ('maskState', 'uint32'),
+    ('oamVersion', 'uint32'),
+    ('paletteVersion', 'uint32'),
+    ('bgTilesVersion', 'uint32'),
+    ('bgPatternTable', 'uint32'),
+    ('spritePatternTable', 'uint32'),
+    ('chrPages', 'uint32', (mem.CHR_PAGES,)),
+    ('nScrollRegions', 'uint32'),
+    ('bgPalettes', 'float32', (LOCAL_PALETTES_LENGTH,)),
+    ('spritePalettes', 'float32', (LOCAL_PALETTES_LENGTH,)),
+    ('scrollRegions', SCROLL_REGION_DTYPE, (MAX_SCROLL_REGIONS,))])
+
 # number of values (elements) per vertex in the vertex buffer
 VERTEX_ELTS = 7
 
@@ -42,8 +73,6 @@ DRAW_BG = True
 DRAW_SPRITES = True
 
 FPS_UPDATE_INTERVAL = 2.0 # in seconds
-MAX_FPS = 60
-SECONDS_PER_FRAME = 1.0 / MAX_FPS
 
 # gain determining seconds per frame (as in a kalman filter)
 SPF_GAIN = 0.2
@@ -66,133 +95,86 @@ def trace(func):
     return out
 
 class CScreen(object):
-    # Is this the best interface structure? Eh, it'll work.
+    """Wraps the cscreen extension module (screenmodule.cpp), which does
+    the actual OpenGL drawing."""
 
     def __init__(self, mirroring):
-        libscreen = CDLL("libscreen.so")
-        libscreen.ex_constructScreen.argtypes = [c_int]
-        libscreen.ex_constructScreen.restype = c_void_p
-
-        libscreen.ex_setUniversalBg.argtypes = [c_void_p, c_int]
-
-        libscreen.ex_drawToBuffer.argtypes = [c_void_p]
-
-        libscreen.ex_setBgPalettes.argtypes = \
-        [c_void_p, (c_float * LOCAL_PALETTES_LENGTH)]
-
-        libscreen.ex_setSpritePalettes.argtypes = \
-        [c_void_p, (c_float * LOCAL_PALETTES_LENGTH)]
-
-        libscreen.ex_setBgPatternTable.argtypes = \
-        [c_void_p, (c_float * PATTERN_TABLE_ENTRIES)]
-
-        libscreen.ex_setSpritePatternTable.argtypes = \
-        [c_void_p, (c_float * PATTERN_TABLE_ENTRIES)]
-
-        libscreen.ex_setTileIndices.argtypes = \
-        [c_void_p, POINTER(c_ubyte), c_uint]
-
-        libscreen.ex_setPaletteIndices.argtypes = \
-        [c_void_p, POINTER(c_ubyte), c_uint]
-
-        libscreen.ex_setOam.argtypes = \
-        [c_void_p, c_ubyte * ppu.OAM_SIZE]
-
-        libscreen.ex_setMask.argtypes = \
-        [c_void_p, c_ubyte]
-
-        libscreen.ex_startScrollRegion.argtypes = \
-        [c_void_p, c_int, c_int, c_int, c_int]
-
-        libscreen.ex_draw.argtypes = [c_void_p]
-        libscreen.ex_draw.restype = c_int
-
-        libscreen.ex_pollKeys.argtypes = [c_void_p]
-        libscreen.ex_pollKeys.restype = c_ubyte
-
-        self.libscreen = libscreen
-
-        self.screen_p = self.libscreen.ex_constructScreen(mirroring)
-
-    def setUniversalBg(self, bg):
-        self.libscreen.ex_setUniversalBg(self.screen_p, bg)
-
-    def setBgPalettes(self, paletteInput):
-        # This takes in a list and handles type conversion itself.
-        assert(len(paletteInput) == LOCAL_PALETTES_LENGTH)
-        c_paletteInput = (c_float * LOCAL_PALETTES_LENGTH) (*paletteInput)
-        self.libscreen.ex_setBgPalettes(self.screen_p, c_paletteInput)
-
-    def setSpritePalettes(self, paletteInput):
-        assert(len(paletteInput) == LOCAL_PALETTES_LENGTH)
-        c_paletteInput = (c_float * LOCAL_PALETTES_LENGTH) (*paletteInput)
-        self.libscreen.ex_setSpritePalettes(self.screen_p, c_paletteInput)
-
-    def setBgPatternTable(self, bgInput):
-        assert(len(bgInput) == PATTERN_TABLE_ENTRIES)
-        c_ptab = (c_float * PATTERN_TABLE_ENTRIES) (*bgInput)
-        self.libscreen.ex_setBgPatternTable(self.screen_p, c_ptab)
-
-    def setSpritePatternTable(self, spriteInput):
-        assert(len(spriteInput) == PATTERN_TABLE_ENTRIES)
-        c_ptab = (c_float * PATTERN_TABLE_ENTRIES) (*spriteInput)
-        self.libscreen.ex_setSpritePatternTable(self.screen_p, c_ptab)
-
-    def setTileIndices(self, indices):
-        intermediate = []
-        for column in indices:
-            intermediate += column
-        c_indices = (c_ubyte * (len(intermediate))) (*intermediate)
-        self.libscreen.ex_setTileIndices(self.screen_p, c_indices, len(intermediate))
-
-    def setPaletteIndices(self, indices):
-        intermediate = []
-        for column in indices:
-            intermediate += column
-        c_indices = (c_ubyte * (len(intermediate))) (*intermediate)
-        self.libscreen.ex_setPaletteIndices(self.screen_p, c_indices, len(intermediate))
-
-    def setOam(self, oamBytes):
-        assert(len(oamBytes) == ppu.OAM_SIZE)
-        c_oamBytes = (c_ubyte * ppu.OAM_SIZE) (*oamBytes)
-        self.libscreen.ex_setOam(self.screen_p, c_oamBytes)
-
-    def setMask(self, m):
-        self.libscreen.ex_setMask(self.screen_p, m)
-
-    def startScrollRegion(self, x_offset, y_offset, x_start, y_top):
-        self.libscreen.ex_startScrollRegion(self.screen_p,
-                                            x_offset, y_offset,
-                                            x_start, y_top)
-
-    def drawToBuffer(self):
-        self.libscreen.ex_drawToBuffer(self.screen_p)
-
-    def draw(self):
-        return self.libscreen.ex_draw(self.screen_p)
-
-    def pollKeys(self):
-        return self.libscreen.ex_pollKeys(self.screen_p)
+        # Only the OpenGL renderer needs the native module, so don't
+        # import it until we need it
+        import cscreen
+        self.cscreen = cscreen
+        self.screen_p = cscreen.construct(mirroring, MAX_FRAMES_AHEAD)
+
+    def setIndexBuffers(self, tileIndices, paletteIndices):
+        # The native screen reads these arrays directly every frame, so
+        # they have to be contiguous. The extension holds on to them.
+        assert(tileIndices.shape == paletteIndices.shape)
+        assert(tileIndices.flags.c_contiguous and paletteIndices.flags.c_contiguous)
+        self.cscreen.setIndexBuffers(self.screen_p, tileIndices, paletteIndices)
+
+    def setOamBuffer(self, oam):
+        assert(len(oam) == ppu.OAM_SIZE)
+        self.cscreen.setOamBuffer(self.screen_p, oam)
+
+    def setChrBanks(self, chrAtlas):
+        # Color indexes for every CHR bank, from PPUCache.chrAtlas
+        assert(chrAtlas.dtype == np.uint8 and chrAtlas.flags.c_contiguous)
+        self.cscreen.setChrBanks(self.screen_p, chrAtlas)
+
+    def submitFrame(self, state):
+        """Queue a frame from a FRAME_STATE_DTYPE array for the render
+        thread to draw. The state, tile indexes, palette indexes and OAM
+        are copied, so they can change as soon as this returns. Returns
+        (draw value, keys)."""
+        assert(state.dtype == FRAME_STATE_DTYPE)
+        return self.cscreen.submitFrame(self.screen_p, state)
+
+    def renderStats(self):
+        """Returns a dict of frame counts from the render thread:
+        submitted, rendered, dropped, queueDepth and maxQueueDepth."""
+        return self.cscreen.renderStats(self.screen_p)
 
 
 class Screen(object):
 
-    def __init__(self, _ppu): # underscore to patch over sloppy naming hiding the ppu module
+    def __init__(self, _ppu, pacer = None): # underscore to patch over sloppy naming hiding the ppu module
 
         self.ppu = _ppu
+        # Paces frames and times them; see pacing.py
+        self.pacer = pacer if pacer is not None else pacing.FramePacer()
+
+        # CHR data version last uploaded to the native screen
+        self.lastChrDataVersion = None
+        # palette RAM version last sent to the native screen
+        self.lastPaletteVersion = None
 
-        self.lastBgPattern = None
-        self.lastSpritePattern = None
+        # Scroll regions for the current frame, as (x offset, y offset,
+        # x start, y top) tuples in the order they start on screen
+        self.scrollRegions = []
 
-        self.tileIndices = [[0 for y in range(self.tileRows())] for x in range(self.tileColumns())]
-        self.paletteIndices = [[0 for y in range(self.tileRows())] for x in range(self.tileColumns())]
+        # Indexed [column, row]. PPU.updateBgTiles writes these in
+        # place, and the native screen reads them without copying.
+        self.tileIndices = np.zeros((self.tileColumns(), self.tileRows()), dtype='uint8')
+        self.paletteIndices = np.zeros((self.tileColumns(), self.tileRows()), dtype='uint8')
 
         self.fpsLastUpdated = None
         self.fpsLastTime = 0
         self.fpsLastDisplayed = 0
         self.secondsPerFrame = None
 
+        self.initBackend()
+
+    def initBackend(self):
+        "Set up whatever actually does the drawing."
+        # Filled in place and submitted once per frame
+        self.frameState = np.zeros((), dtype=FRAME_STATE_DTYPE)
         self.cscreen = CScreen(self.ppu.mirroring)
+        self.cscreen.setIndexBuffers(self.tileIndices, self.paletteIndices)
+        self.cscreen.setOamBuffer(self.ppu.oam)
+
+    def renderStats(self):
+        "Frame counts from the renderer, if it keeps any (see CScreen.renderStats)."
+        return self.cscreen.renderStats()
 
     def tileRows(self):
         return self.ppu.tileRows()
@@ -202,23 +184,27 @@ class Screen(object):
 
     def initFrame(self):
         "Bookkeeping that runs at the end of vblank."
-        self.cscreen.startScrollRegion(self.ppu.scrollX(),
-                                       self.ppu.scrollY(),
-                                       0, 0)
+        self.scrollRegions = [(self.ppu.scrollX(), self.ppu.scrollY(), 0, 0)]
 
     def recordScroll(self, xOffset, yOffset, xStart, yTop):
-        self.cscreen.startScrollRegion(xOffset, yOffset, xStart, yTop)
+        # Same rules as Screen::startScrollRegion: a region starting
+        # where the last one did replaces its offsets.
+        if (self.scrollRegions and
+            self.scrollRegions[-1][2:] == (xStart, yTop)):
+            self.scrollRegions[-1] = (xOffset, yOffset, xStart, yTop)
+        else:
+            self.scrollRegions.append((xOffset, yOffset, xStart, yTop))
 
     def tick(self, frame): # TODO consider turning this into a more general callback that the ppu gets
+        self.pacer.mark(pacing.EMULATE)
         self.draw_to_buffer()
+        self.pacer.mark(pacing.RENDER)
 
-        # TODO reinstate FPS-capping code
-        drawval = self.cscreen.draw()
+        (drawval, keys) = self.cscreen.submitFrame(self.frameState)
         if drawval != 0:
+            print >> sys.stderr, self.pacer.report()
             sys.exit(0)
 
-        # time.sleep(1)
-
         # Handle controller input.
 
         #glfw.poll_events()
@@ -229,8 +215,6 @@ class Screen(object):
         # # forgive me demeter for I have sinned
         ips = self.ppu.cpu.controller.inputState.states
 
-        keys = self.cscreen.pollKeys()
-
         ips[0] = bool(keys & KEY_MASK_A) # A: A
         ips[1] = bool(keys & KEY_MASK_B) # B: S
         ips[2] = bool(keys & KEY_MASK_SELECT) # Select: \
@@ -239,16 +223,16 @@ class Screen(object):
         ips[5] = bool(keys & KEY_MASK_DOWN) # Down: Down
         ips[6] = bool(keys & KEY_MASK_LEFT) # Left: Left
         ips[7] = bool(keys & KEY_MASK_RIGHT) # Right: Right
+        self.pacer.mark(pacing.PRESENT)
 
-        timenow = time.time()
+        self.pacer.wait()
+        self.trackFps(frame)
 
-        if self.secondsPerFrame is not None:
-            # this causes segfaults and I don't know why:
+    def trackFps(self, frame):
+        # Just for display: pacing happens in self.pacer
+        timenow = pacing.monotonicTime()
 
-            # if self.secondsPerFrame < SECONDS_PER_FRAME:
-            #     targetTime = timenow + SECONDS_PER_FRAME - self.secondsPerFrame
-            #     time.sleep(targetTime - timenow)
-            #     timenow = time.time()
+        if self.secondsPerFrame is not None:
             observedSpf = (timenow - self.fpsLastTime) / (frame - self.fpsLastUpdated)
             self.secondsPerFrame = (SPF_GAIN * observedSpf +
                                     (1 - SPF_GAIN) * self.secondsPerFrame)
@@ -259,47 +243,65 @@ class Screen(object):
         self.fpsLastTime = timenow
         if timenow >= self.fpsLastDisplayed + FPS_UPDATE_INTERVAL:
             if self.secondsPerFrame is not None:
-                print "Frame %d (%d FPS)" % (frame, 1.0 / self.secondsPerFrame)
+                stats = self.renderStats()
+                if stats is None:
+                    print "Frame %d (%d FPS)" % (frame, 1.0 / self.secondsPerFrame)
+                else:
+                    print ("Frame %d (%d FPS, %d dropped, %d unchanged, "
+                           "queue %d/%d, %d uploads skipped)") % (
+                        frame, 1.0 / self.secondsPerFrame, stats['dropped'],
+                        stats['unchanged'], stats['queueDepth'],
+                        stats['maxQueueDepth'], stats['lastSkippedUploads'])
+                audio = self.pacer.audioStatus()
+                if audio is not None:
+                    print audio
                 # glfw.set_window_title(self.window,
                 #                       "%s - (%d) %d FPS" % (PROGRAM_NAME, frame, 1.0/self.secondsPerFrame))
             self.fpsLastDisplayed = timenow
 
-        # self.gpuStart.set()
-
 
     def draw_to_buffer(self):
-        self.cscreen.setUniversalBg(self.ppu.universalBg)
+        """Fill in the frame state for the native screen. Tile indexes,
+        palette indexes and OAM aren't copied: the native screen reads
+        them in place."""
+        state = self.frameState
+        state['universalBg'] = self.ppu.universalBg
 
         maskState = self.ppu.maskState
         if not DRAW_BG:
             maskState = maskState & ~(0x1 << 3)
         if not DRAW_SPRITES:
             maskState = maskState & ~(0x1 << 4)
-        self.cscreen.setMask(maskState)
-
-        self.maintainBgPatternTable()
-        self.cscreen.setTileIndices(self.tileIndices)
-        self.cscreen.setPaletteIndices(self.paletteIndices)
-        localPaletteList = self.ppu.dumpLocalPalettes(ppu.BG_PALETTE_BASE)
-        self.cscreen.setBgPalettes(localPaletteList)
-        self.maintainSpritePatternTable()
-        localPaletteList = self.ppu.dumpLocalPalettes(ppu.SPRITE_PALETTE_BASE)
-        self.cscreen.setSpritePalettes(localPaletteList)
-        self.cscreen.setOam([ord(x) for x in self.ppu.oam])
-        self.cscreen.drawToBuffer()
-
-    def maintainBgPatternTable(self):
-        if self.lastBgPattern != self.ppu.bgPatternTableAddr:
-            self.bgPatternTable = self.ppu.dumpPtab(self.ppu.bgPatternTableAddr)
-            # # I can't make GL_R8UI work, so everything has to be floats
-            patternTableFloats = [float(ord(x)) for x in self.bgPatternTable]
-            self.cscreen.setBgPatternTable(patternTableFloats)
-            self.lastBgPattern = self.ppu.bgPatternTableAddr
-
-    def maintainSpritePatternTable(self):
-        if self.lastSpritePattern != self.ppu.spritePatternTableAddr:
-            self.spritePatternTable = self.ppu.dumpPtab(self.ppu.spritePatternTableAddr)
-            # I can't make GL_R8UI work, so everything has to be floats
-            patternTableFloats = [float(ord(x)) for x in self.spritePatternTable]
-            self.cscreen.setSpritePatternTable(patternTableFloats)
-            self.lastSpritePattern = self.ppu.spritePatternTableAddr
+        state['maskState'] = maskState
+        # The native screen only re-sends what these say has changed
+        state['oamVersion'] = self.ppu.oamVersion & 0xffffffff
+        state['paletteVersion'] = self.ppu.paletteVersion & 0xffffffff
+        state['bgTilesVersion'] = self.ppu.bgTilesVersion & 0xffffffff
+
+        regions = self.scrollRegions[:MAX_SCROLL_REGIONS]
+        state['scrollRegions'][:len(regions)] = regions
+        state['nScrollRegions'] = len(regions)
+
+        # Switching pattern tables or CHR banks just changes these
+        state['bgPatternTable'] = self.ppu.bgPatternTableAddr
+        state['spritePatternTable'] = self.ppu.spritePatternTableAddr
+        state['chrPages'] = self.ppu.cpu.mem.chrPageBanks
+
+        self.maintainChr()
+        self.maintainPalettes()
+
+    def maintainPalettes(self):
+        if self.lastPaletteVersion != self.ppu.paletteVersion:
+            self.frameState['bgPalettes'] = \
+                self.ppu.dumpLocalPalettes(ppu.BG_PALETTE_BASE)
+            self.frameState['spritePalettes'] = \
+                self.ppu.dumpLocalPalettes(ppu.SPRITE_PALETTE_BASE)
+            self.lastPaletteVersion = self.ppu.paletteVersion
+
+    def maintainChr(self):
+        # Every CHR bank lives in one texture, so pattern table and bank
+        # switches don't need an upload. Only CHR RAM writes do.
+        chrDataVersion = self.ppu.cpu.mem.chrDataVersion
+        if self.lastChrDataVersion != chrDataVersion:
+            self.cscreen.setChrBanks(self.ppu.cache.chrAtlas())
+            self.lastChrDataVersion = chrDataVersion
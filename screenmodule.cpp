@@ -1,43 +1,290 @@
-// this might be mac-specific
-#include <Python/Python.h>
+// Python.h has to come before any standard headers
+#include <Python.h>
 // #include "screen.h"
 
+#include <thread>
+
 // this seems like a hack - is this really how python wants me to do this?
 #include "screen.cpp"
+#include "framequeue.cpp"
+
+// How many frames the emulator can get ahead of the render thread
+// before submitFrame blocks, unless construct says otherwise
+const int DEFAULT_MAX_FRAMES_AHEAD = 2;
+
+/* What python holds on to for a screen. Every submitted frame copies
+ * the tile index, palette index and OAM buffers, so we hold on to them
+ * here: that keeps python from freeing or resizing them out from
+ * under us.
+ *
+ * The screen draws on its own render thread, which takes frames from
+ * queue. The thread that constructed the screen keeps the window, and
+ * polls it in submitFrame.
+ */
+typedef struct screenHandle {
+  Screen *screen;
+  Py_buffer tileIndices;
+  Py_buffer paletteIndices;
+  Py_buffer oam;
+  FrameQueue *queue;
+  thread *renderThread;
+  // Set when python hands over new buffers, so that the snapshots'
+  // copies of the old ones don't get reused
+  bool buffersReplaced;
+  // CHR from setChrBanks, to go out with the next frame
+  bool chrPending;
+  vector<unsigned char> pendingChr;
+  int pendingChrBanks;
+} screenHandle;
 
-static Screen *sc;
+static const char *SCREEN_CAPSULE_NAME = "cscreen.Screen";
+
+// Stop the render thread and wait for it to finish its frame
+static void stopRendering(screenHandle *handle) {
+  if (!handle->renderThread) {
+    return;
+  }
+  handle->queue->close();
+  Py_BEGIN_ALLOW_THREADS
+  handle->renderThread->join();
+  Py_END_ALLOW_THREADS
+  delete handle->renderThread;
+  handle->renderThread = NULL;
+}
+
+static void destroyScreen(PyObject *capsule) {
+  screenHandle *handle =
+    (screenHandle *) PyCapsule_GetPointer(capsule, SCREEN_CAPSULE_NAME);
+  if (!handle) {
+    return;
+  }
+  stopRendering(handle);
+  PyBuffer_Release(&handle->tileIndices);
+  PyBuffer_Release(&handle->paletteIndices);
+  PyBuffer_Release(&handle->oam);
+  delete handle->screen;
+  delete handle->queue;
+  delete handle;
+}
+
+static screenHandle *getHandle(PyObject *capsule) {
+  return (screenHandle *) PyCapsule_GetPointer(capsule, SCREEN_CAPSULE_NAME);
+}
 
-static PyObject *screenInit(PyObject *self, PyObject *args) {
-  if (!PyArg_ParseTuple(args, "")) {
+static PyObject *screenConstruct(PyObject *self, PyObject *args) {
+  int scrollType;
+  int maxFramesAhead = DEFAULT_MAX_FRAMES_AHEAD;
+  if (!PyArg_ParseTuple(args, "i|i", &scrollType, &maxFramesAhead)) {
     return NULL;
   }
-  sc = (Screen *) malloc(sizeof(Screen));
-  *sc = Screen();
+  if (maxFramesAhead < 1) {
+    PyErr_SetString(PyExc_ValueError, "maxFramesAhead must be at least 1");
+    return NULL;
+  }
+  // Value-initialized, so the buffers and pointers start out zeroed
+  screenHandle *handle = new screenHandle();
+  handle->screen = new Screen((ScrollType) scrollType);
+  handle->queue = new FrameQueue(maxFramesAhead);
+  // Hand the GL context over to the render thread
+  handle->screen->releaseContext();
+  handle->renderThread =
+    new thread(&Screen::renderLoop, handle->screen, handle->queue);
+  return PyCapsule_New(handle, SCREEN_CAPSULE_NAME, destroyScreen);
+}
+
+static PyObject *screenSetIndexBuffers(PyObject *self, PyObject *args) {
+  PyObject *capsule;
+  Py_buffer tiles, palettes;
+  if (!PyArg_ParseTuple(args, "Ow*w*", &capsule, &tiles, &palettes)) {
+    return NULL;
+  }
+  screenHandle *handle = getHandle(capsule);
+  Py_ssize_t expected =
+    handle ? handle->screen->tileColumns() * handle->screen->tileRows() : 0;
+  if (!handle || tiles.len != expected || palettes.len != expected) {
+    if (handle) {
+      PyErr_Format(PyExc_ValueError,
+                   "index buffers must be %zd bytes long", expected);
+    }
+    PyBuffer_Release(&tiles);
+    PyBuffer_Release(&palettes);
+    return NULL;
+  }
+  PyBuffer_Release(&handle->tileIndices);
+  PyBuffer_Release(&handle->paletteIndices);
+  handle->tileIndices = tiles;
+  handle->paletteIndices = palettes;
+  handle->buffersReplaced = true;
   Py_RETURN_NONE;
 }
 
-static PyObject *screenDrawToBuffer(PyObject *self, PyObject *args) {
-  if (!PyArg_ParseTuple(args, "")) {
+static PyObject *screenSetOamBuffer(PyObject *self, PyObject *args) {
+  PyObject *capsule;
+  Py_buffer oam;
+  if (!PyArg_ParseTuple(args, "Ow*", &capsule, &oam)) {
+    return NULL;
+  }
+  screenHandle *handle = getHandle(capsule);
+  if (!handle || oam.len != OAM_SIZE) {
+    if (handle) {
+      PyErr_Format(PyExc_ValueError, "OAM must be %d bytes long", OAM_SIZE);
+    }
+    PyBuffer_Release(&oam);
     return NULL;
   }
-  sc->drawToBuffer();
+  PyBuffer_Release(&handle->oam);
+  handle->oam = oam;
+  handle->buffersReplaced = true;
   Py_RETURN_NONE;
 }
 
-static PyObject *screenDraw(PyObject *self, PyObject *args) {
-  if (!PyArg_ParseTuple(args, "")) {
+// CHR gets copied and sent along with the next frame, so we don't need
+// to hold on to it.
+static PyObject *screenSetChrBanks(PyObject *self, PyObject *args) {
+  PyObject *capsule;
+  Py_buffer chr;
+  if (!PyArg_ParseTuple(args, "Os*", &capsule, &chr)) {
     return NULL;
   }
-  int out = sc->draw();
-  return Py_BuildValue("i", out);
+  screenHandle *handle = getHandle(capsule);
+  const Py_ssize_t bankSize = CHR_BANK_WIDTH * 8;
+  if (!handle || chr.len == 0 || chr.len % bankSize != 0) {
+    if (handle) {
+      PyErr_Format(PyExc_ValueError,
+                   "CHR must be a whole number of %zd-byte banks", bankSize);
+    }
+    PyBuffer_Release(&chr);
+    return NULL;
+  }
+  const unsigned char *chrBytes = (const unsigned char *) chr.buf;
+  handle->pendingChr.assign(chrBytes, chrBytes + chr.len);
+  handle->pendingChrBanks = (int) (chr.len / bankSize);
+  handle->chrPending = true;
+  PyBuffer_Release(&chr);
   Py_RETURN_NONE;
 }
 
+/* Submit a frame: copy the frame state and buffers into a snapshot for
+ * the render thread, then poll the window and the keyboard. Returns
+ * (draw value, keys); a nonzero draw value means the window closed.
+ * This only blocks (without the GIL) if the render thread has fallen
+ * too far behind.
+ */
+static PyObject *screenSubmitFrame(PyObject *self, PyObject *args) {
+  PyObject *capsule;
+  Py_buffer state;
+  if (!PyArg_ParseTuple(args, "Os*", &capsule, &state)) {
+    return NULL;
+  }
+  screenHandle *handle = getHandle(capsule);
+  if (!handle || state.len != (Py_ssize_t) sizeof(frameState)) {
+    if (handle) {
+      PyErr_Format(PyExc_ValueError, "frame state must be %zd bytes long",
+                   (Py_ssize_t) sizeof(frameState));
+    }
+    PyBuffer_Release(&state);
+    return NULL;
+  }
+  if (!handle->tileIndices.buf || !handle->oam.buf) {
+    PyErr_SetString(PyExc_ValueError,
+                    "set the index and OAM buffers before submitting frames");
+    PyBuffer_Release(&state);
+    return NULL;
+  }
+  if (!handle->renderThread) {
+    // The window's already closed
+    PyBuffer_Release(&state);
+    return Py_BuildValue("(iB)", 1, 0);
+  }
+  if (handle->buffersReplaced) {
+    handle->queue->invalidateCopies();
+    handle->buffersReplaced = false;
+  }
+
+  frameSnapshot *frame;
+  Py_BEGIN_ALLOW_THREADS
+  frame = handle->queue->beginWrite();
+  Py_END_ALLOW_THREADS
+  if (frame) {
+    memcpy(&frame->state, state.buf, sizeof(frameState));
+    // Only copy the buffers if they've changed since this snapshot
+    // last had them
+    if (!frame->copiesValid ||
+        frame->bgTilesVersion != frame->state.bgTilesVersion) {
+      const unsigned char *tiles =
+        (const unsigned char *) handle->tileIndices.buf;
+      const unsigned char *palettes =
+        (const unsigned char *) handle->paletteIndices.buf;
+      frame->tileIndices.assign(tiles, tiles + handle->tileIndices.len);
+      frame->paletteIndices.assign(palettes,
+                                   palettes + handle->paletteIndices.len);
+      frame->bgTilesVersion = frame->state.bgTilesVersion;
+    }
+    if (!frame->copiesValid || frame->oamVersion != frame->state.oamVersion) {
+      memcpy(frame->oam, handle->oam.buf, OAM_SIZE);
+      frame->oamVersion = frame->state.oamVersion;
+    }
+    frame->copiesValid = true;
+    frame->hasChr = handle->chrPending;
+    if (handle->chrPending) {
+      swap(frame->chr, handle->pendingChr);
+      frame->nChrBanks = handle->pendingChrBanks;
+      handle->chrPending = false;
+    }
+    handle->queue->endWrite();
+  }
+  PyBuffer_Release(&state);
+
+  Screen *sc = handle->screen;
+  int drawval = sc->pollWindow();
+  unsigned char keys = 0;
+  if (drawval == 0) {
+    keys = sc->pollKeys();
+  } else {
+    stopRendering(handle);
+    glfwTerminate();
+  }
+  return Py_BuildValue("(iB)", drawval, keys);
+}
+
+static PyObject *screenRenderStats(PyObject *self, PyObject *args) {
+  PyObject *capsule;
+  if (!PyArg_ParseTuple(args, "O", &capsule)) {
+    return NULL;
+  }
+  screenHandle *handle = getHandle(capsule);
+  if (!handle) {
+    return NULL;
+  }
+  renderStats stats = handle->queue->stats();
+  return Py_BuildValue("{s:k,s:k,s:k,s:i,s:i,s:k,s:k,s:i}",
+                       "submitted", stats.submitted,
+                       "rendered", stats.rendered,
+                       "dropped", stats.dropped,
+                       "queueDepth", stats.queueDepth,
+                       "maxQueueDepth", stats.maxQueueDepth,
+                       "unchanged", stats.unchanged,
+                       "skippedUploads", stats.skippedUploads,
+                       "lastSkippedUploads", stats.lastSkippedUploads);
+}
 
 static PyMethodDef ScreenMethods[] = {
-  {"init", screenInit, METH_VARARGS, "Create a screen object."},
-  {"drawToBuffer", screenDrawToBuffer, METH_VARARGS, "Render state to internal buffer."},
-  {"draw", screenDraw, METH_VARARGS, "Draw internal buffer to screen."},
+  {"construct", screenConstruct, METH_VARARGS,
+   "Create a screen for the given scroll type (MirrorMode), and start its "
+   "render thread. Optionally takes how many frames submitFrame can get "
+   "ahead of the render thread before it blocks."},
+  {"setIndexBuffers", screenSetIndexBuffers, METH_VARARGS,
+   "Register the writable tile index and palette index buffers."},
+  {"setOamBuffer", screenSetOamBuffer, METH_VARARGS,
+   "Register the writable OAM buffer."},
+  {"setChrBanks", screenSetChrBanks, METH_VARARGS,
+   "Upload every CHR bank, decoded to color indexes (PPUCache.chrAtlas)."},
+  {"submitFrame", screenSubmitFrame, METH_VARARGS,
+   "Queue a frame from a frame state buffer. Returns (draw value, keys)."},
+  {"renderStats", screenRenderStats, METH_VARARGS,
+   "Frame counts from the render thread: submitted, rendered, dropped, "
+   "queueDepth, maxQueueDepth, unchanged, skippedUploads and "
+   "lastSkippedUploads."},
   {NULL, NULL, 0, NULL}
 };
 
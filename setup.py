@@ -1,11 +1,29 @@
-# set up things to link screenmodule
+# Build the cscreen extension module (screenmodule.cpp), which the
+# OpenGL renderer in screen.py draws through. Run
+# "python setup.py build_ext --inplace".
 # TODO set up cflags here too I guess
+import sys
 from distutils.core import setup, Extension
 
+if sys.platform == 'darwin':
+    linkArgs = ['-framework', 'OpenGL', '-framework', 'Cocoa',
+                '-framework', 'IOKit', '-framework', 'CoreVideo']
+    libraries = ['glfw']
+else:
+    linkArgs = ['-pthread']
+    libraries = ['glfw', 'GL']
+
+# screenmodule.cpp includes screen.cpp and framequeue.cpp directly
 module1 = Extension('cscreen',
-                    sources = ['screenmodule.cpp'])
+                    sources = ['screenmodule.cpp'],
+                    depends = ['screen.cpp', 'screen.hpp', 'palette.hpp',
+                               'framequeue.cpp', 'framequeue.hpp'],
+                    language = 'c++',
+                    extra_compile_args = ['-std=c++11', '-pthread'],
+                    libraries = libraries,
+                    extra_link_args = linkArgs)
 
-setup (name = 'screentest',
+setup (name = 'cscreen',
        version = '0.1',
-       description = 'Testing distutils for linking to c functions',
+       description = 'OpenGL screen for Missingnes',
        ext_modules = [module1])
@@ -0,0 +1,254 @@
+"""Draw frames in software with NumPy instead of through OpenGL. This
+builds a 256x240 framebuffer of palette indexes every frame, which
+works without a display or a GPU (and is handy for checking the
+renderer's output from a script).
+
+"""
+import numpy as np
+
+import pacing
+import palette
+import ppu
+import screen
+
+# PPUMASK bits
+MASK_GRAYSCALE = 1 << 0
+MASK_BKG_LEFT = 1 << 1
+MASK_SPRITE_LEFT = 1 << 2
+MASK_BKG = 1 << 3
+MASK_SPRITE = 1 << 4
+MASK_EMPHASIS_SHIFT = 5
+
+# OAM attribute bits
+OAM_PALETTE = 0x3
+OAM_BEHIND_BKG = 1 << 5
+OAM_FLIP_HORIZONTAL = 1 << 6
+OAM_FLIP_VERTICAL = 1 << 7
+
+OAM_ENTRIES = ppu.OAM_SIZE / ppu.OAM_ENTRY_SIZE
+
+# Sprites with a Y coordinate this high are entirely off the screen
+SPRITE_OFFSCREEN_Y = 0xef
+
+# Width of the column on the left of the screen that PPUMASK can hide
+LEFT_COLUMN_WIDTH = 8
+
+class SoftwareScreen(screen.Screen):
+    """Drop-in replacement for Screen that renders with NumPy.
+
+    After each tick, framebuffer holds the frame as an array of palette
+    indexes (0-63) indexed by [y, x], and rgb() converts it to RGB
+    bytes using the frame's emphasis bits.
+
+    """
+
+    def initBackend(self):
+        self.framebuffer = np.zeros((screen.SCREEN_HEIGHT, screen.SCREEN_WIDTH),
+                                    dtype='uint8')
+        self.emphasis = 0
+        # Scratch buffers for the two layers, holding local palette
+        # indexes (4*palette + color). The sprite layer is a tile
+        # wider than the screen so sprites can run off the right edge.
+        self.bgLayer = np.zeros((screen.SCREEN_HEIGHT, screen.SCREEN_WIDTH),
+                                dtype='uint8')
+        self.spriteLayer = np.zeros((screen.SCREEN_HEIGHT,
+                                     screen.SCREEN_WIDTH + 8), dtype='uint8')
+        self.spriteBehind = np.zeros(self.spriteLayer.shape, dtype='bool')
+
+        # The whole scroll space drawn as local palette indexes, along
+        # with the tile and palette indexes it was drawn from (indexed
+        # [row, column]) and the pattern table it used
+        self.bgPlaneCache = None
+        self.planeTiles = None
+        self.planePalettes = None
+        self.planePattern = None
+
+    def renderStats(self):
+        # Frames are drawn as they're submitted, so there's no queue
+        return None
+
+    def tick(self, frame):
+        self.pacer.mark(pacing.EMULATE)
+        self.draw_to_buffer()
+        self.pacer.mark(pacing.RENDER)
+        # No window, so nothing to present and no controller input
+        self.pacer.wait()
+        self.trackFps(frame)
+
+    def draw_to_buffer(self):
+        maskState = self.ppu.maskState
+        if not screen.DRAW_BG:
+            maskState &= ~MASK_BKG
+        if not screen.DRAW_SPRITES:
+            maskState &= ~MASK_SPRITE
+        self.emphasis = maskState >> MASK_EMPHASIS_SHIFT
+
+        bgOpaque = self.drawBg(maskState)
+        spriteOpaque = self.drawSprites(maskState)
+
+        # Palette RAM holds the local palettes that the layers index
+        # into. Entry 0 of each background palette is the universal
+        # background color.
+        paletteRam = np.frombuffer(self.ppu.paletteRam, dtype='uint8')
+        bgLookup = paletteRam[:16].copy()
+        bgLookup[::4] = self.ppu.universalBg
+        spriteLookup = paletteRam[16:32]
+
+        out = bgLookup[self.bgLayer]
+        # A sprite pixel shows unless it's behind an opaque background
+        # pixel. spriteBehind comes from whichever sprite won the
+        # pixel, even if it's behind the background.
+        spriteShows = spriteOpaque & ~(self.spriteBehind[:, :screen.SCREEN_WIDTH]
+                                       & bgOpaque)
+        np.copyto(out, spriteLookup[self.spriteLayer[:, :screen.SCREEN_WIDTH]],
+                  where=spriteShows)
+        out &= 0x3f
+        if maskState & MASK_GRAYSCALE:
+            out &= 0x30
+        self.framebuffer = out
+
+    def rgb(self):
+        """Returns the framebuffer as a 240x256x3 array of RGB bytes."""
+        return palette.RGBA_PALETTES[self.emphasis][self.framebuffer][..., :3]
+
+    def bgPlane(self):
+        """Returns the whole scroll space as an array of local palette
+        indexes, built from tileIndices and paletteIndices. The plane
+        is kept between frames, and only tiles whose tile or palette
+        index changed get redrawn, unless the pattern table changed."""
+        # tileIndices is indexed [column, row]
+        tiles = self.tileIndices.T
+        palettes = self.paletteIndices.T
+        (rows, columns) = tiles.shape
+        pattern = (self.ppu.bgPatternTableAddr, self.ppu.cpu.mem.chrVersion)
+        ptab = self.ppu.cache.ptabTiles(self.ppu.bgPatternTableAddr)
+
+        if (self.bgPlaneCache is None or self.planePattern != pattern or
+            self.planeTiles.shape != tiles.shape):
+            # [row, column, y, x] -> [row, y, column, x]
+            pixels = ptab[tiles] + (palettes * 4)[:, :, np.newaxis, np.newaxis]
+            self.bgPlaneCache = pixels.transpose(0, 2, 1, 3).reshape(rows * 8, columns * 8)
+            self.planePattern = pattern
+        else:
+            (changedRows, changedColumns) = np.nonzero(
+                (tiles != self.planeTiles) | (palettes != self.planePalettes))
+            if len(changedRows):
+                pixels = (ptab[tiles[changedRows, changedColumns]] +
+                          (palettes[changedRows, changedColumns] * 4)[:, np.newaxis, np.newaxis])
+                # A [row, column, y, x] view of the plane
+                tileView = self.bgPlaneCache.reshape(rows, 8, columns, 8).transpose(0, 2, 1, 3)
+                tileView[changedRows, changedColumns] = pixels
+        # The PPU updates the index arrays in place, so keep copies
+        self.planeTiles = tiles.copy()
+        self.planePalettes = palettes.copy()
+        return self.bgPlaneCache
+
+    def blitWrapped(self, dest, plane, yOffset, xOffset):
+        """Fill dest with the part of plane starting at (yOffset, xOffset),
+        wrapping around the edges of the plane. dest can't be bigger
+        than the plane, so this takes at most four slice copies."""
+        (height, width) = plane.shape
+        (destHeight, destWidth) = dest.shape
+        y0 = yOffset % height
+        x0 = xOffset % width
+        topRows = min(destHeight, height - y0)
+        leftColumns = min(destWidth, width - x0)
+        for (destY, srcY, nRows) in ((0, y0, topRows),
+                                     (topRows, 0, destHeight - topRows)):
+            if nRows <= 0:
+                continue
+            for (destX, srcX, nColumns) in ((0, x0, leftColumns),
+                                            (leftColumns, 0, destWidth - leftColumns)):
+                if nColumns <= 0:
+                    continue
+                dest[destY:destY + nRows, destX:destX + nColumns] = \
+                    plane[srcY:srcY + nRows, srcX:srcX + nColumns]
+
+    def drawBg(self, maskState):
+        """Draws the background into bgLayer by cropping each scroll
+        region out of the cached scroll plane, a few slice copies per
+        region. Returns a mask of opaque pixels."""
+        layer = self.bgLayer
+        if not maskState & MASK_BKG:
+            layer[:] = 0
+            return np.zeros(layer.shape, dtype='bool')
+
+        plane = self.bgPlane()
+        regions = self.scrollRegions or [(self.ppu.scrollX(), self.ppu.scrollY(), 0, 0)]
+        for (i, (xOffset, yOffset, xStart, yTop)) in enumerate(regions):
+            # Each region runs until the next one starts. If the next
+            # one starts partway through a scanline, draw that whole
+            # scanline now and let the next region overwrite its part.
+            if i + 1 < len(regions):
+                (nextXStart, nextYTop) = regions[i + 1][2:]
+                yEnd = nextYTop + (1 if nextXStart > 0 else 0)
+            else:
+                yEnd = screen.SCREEN_HEIGHT
+            yEnd = min(yEnd, screen.SCREEN_HEIGHT)
+            if yEnd <= yTop:
+                continue
+            # Pixel (x, y) of the region comes from (x + xOffset,
+            # y + yOffset) in scroll space.
+            self.blitWrapped(layer[yTop:yTop + 1, xStart:], plane,
+                             yTop + yOffset, xStart + xOffset)
+            if yEnd > yTop + 1:
+                self.blitWrapped(layer[yTop + 1:yEnd], plane,
+                                 yTop + 1 + yOffset, xOffset)
+
+        if not maskState & MASK_BKG_LEFT:
+            layer[:, :LEFT_COLUMN_WIDTH] = 0
+        return (layer & 0x3) != 0
+
+    def drawSprites(self, maskState):
+        """Draws sprites into spriteLayer and spriteBehind. Returns a mask
+        of opaque pixels."""
+        layer = self.spriteLayer
+        behind = self.spriteBehind
+        layer[:] = 0
+        behind[:] = False
+        if not maskState & MASK_SPRITE:
+            return np.zeros(self.bgLayer.shape, dtype='bool')
+
+        oam = np.frombuffer(self.ppu.oam, dtype='uint8')
+        oam = oam.reshape(OAM_ENTRIES, ppu.OAM_ENTRY_SIZE)
+        height = 16 if self.ppu.spriteSize else 8
+        tops = oam[:, 0].astype('int') + 1
+        tops[oam[:, 0] >= SPRITE_OFFSCREEN_Y] = screen.SCREEN_HEIGHT
+
+        # covers[sprite, scanline]: whether the sprite is on the
+        # scanline. Only the first MAX_SPRITES sprites in OAM on each
+        # scanline get drawn.
+        scanlines = np.arange(screen.SCREEN_HEIGHT)
+        covers = ((scanlines >= tops[:, np.newaxis]) &
+                  (scanlines < tops[:, np.newaxis] + height))
+        covers &= np.cumsum(covers, axis=0) <= ppu.MAX_SPRITES
+
+        if height == 16:
+            # 8x16 sprites pick their pattern table with bit 0 of the
+            # tile number, and use an even/odd pair of tiles.
+            ptabs = [self.ppu.cache.ptabTiles(0), self.ppu.cache.ptabTiles(1)]
+        else:
+            ptab = self.ppu.cache.ptabTiles(self.ppu.spritePatternTableAddr)
+
+        # Draw back to front, so lower OAM entries end up on top
+        for i in np.flatnonzero(covers.any(axis=1))[::-1]:
+            (y, tile, attributes, x) = oam[i]
+            top = tops[i]
+            if height == 16:
+                pixels = ptabs[tile & 1][[tile & 0xfe, (tile & 0xfe) + 1]].reshape(16, 8)
+            else:
+                pixels = ptab[tile]
+            if attributes & OAM_FLIP_HORIZONTAL:
+                pixels = pixels[:, ::-1]
+            if attributes & OAM_FLIP_VERTICAL:
+                pixels = pixels[::-1, :]
+            bottom = min(top + height, screen.SCREEN_HEIGHT)
+            pixels = pixels[:bottom - top]
+            opaque = (pixels != 0) & covers[i, top:bottom, np.newaxis]
+            np.copyto(layer[top:bottom, x:x + 8],
+                      pixels + 4 * (attributes & OAM_PALETTE), where=opaque)
+            behind[top:bottom, x:x + 8][opaque] = bool(attributes & OAM_BEHIND_BKG)
+
+        if not maskState & MASK_SPRITE_LEFT:
+            layer[:, :LEFT_COLUMN_WIDTH] = 0
+        return (layer[:, :screen.SCREEN_WIDTH] & 0x3) != 0
@@ -5,8 +5,11 @@ in float priority;
 in float tile;
 in vec3 v_uv;
 in float v_palette_n;
+in int v_visible_rows;
 
 out vec2 f_uv;
+flat out int f_tile;
+flat out int f_visible_rows;
 out vec4[4] f_palette;
 
 uniform vec4[16] localPalettes;
@@ -19,8 +22,11 @@ void main()
                       1 - (pos.y / (15.0*8.0)),
                       priority,
                       1.0);
-  f_uv = vec2((tile + v_uv.x)/256.0, v_uv.y);
-  //f_uv = vec2((float(v_uv.x) / 256.0) + float(tile) / 256.0, float(v_uv.y));
+  // uv coordinates within the tile; the fragment shader looks the
+  // tile up in the CHR banks
+  f_uv = v_uv.xy;
+  f_tile = int(tile);
+  f_visible_rows = v_visible_rows;
   for (int i = 0; i < 4; i++) {
     f_palette[i] = localPalettes[i + int(v_palette_n)*4];
   }